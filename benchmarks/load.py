@@ -0,0 +1,316 @@
+"""End-to-end load and latency benchmark against a local mock upstream.
+
+Starts benchmarks.mock_upstream and the proxy (main.py) as subprocesses, runs
+N concurrent clients directly against the mock and then through the proxy,
+and reports time to first byte and first token, inter-chunk gaps,
+end-to-end latency percentiles, the latency the proxy adds, and the proxy's
+CPU time and RSS.
+
+Run from the repository root; options not listed below are passed to the mock
+(see python -m benchmarks.mock_upstream --help):
+
+    python -m benchmarks.load --concurrency 50 --requests 500 [--engine asyncio] [--workers 2] \\
+        [--json results.json] [--token-rate 80 --companion-latency lognormal:0.6,0.4 ...]
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+from typing import Dict, List, Optional
+
+_CLK_TCK = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+
+
+class Result:
+    __slots__ = ('ok', 'status', 'ttfb', 'first_token', 'total', 'gaps', 'companion', 'error')
+
+    def __init__(self):
+        self.ok = False
+        self.status = None
+        self.ttfb = None
+        self.first_token = None
+        self.total = None
+        self.gaps = []
+        self.companion = False
+        self.error = None
+
+
+def percentile(values: List[float], pct: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))]
+
+
+async def one_request(port: int, body: bytes, timeout: float, auth: bytes = b'Bearer bench') -> Result:
+    result = Result()
+    start = time.perf_counter()
+    writer = None
+    try:
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write(b'POST /v1/chat/completions HTTP/1.1\r\nHost: bench\r\nAuthorization: %s\r\n'
+                     b'Content-Type: application/json\r\nContent-Length: %d\r\n\r\n' % (auth, len(body)) + body)
+        head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), timeout)
+        result.ttfb = time.perf_counter() - start
+        result.status = int(head.split(b' ', 2)[1])
+        length = None
+        for line in head.split(b'\r\n'):
+            if line.lower().startswith(b'content-length:'):
+                length = int(line.split(b':', 1)[1])
+        data = b''
+        last = None
+        deadline = start + timeout
+        while True:
+            if length is not None and len(data) >= length:
+                break
+            if length is None and b'data: [DONE]' in data:
+                break
+            chunk = await asyncio.wait_for(reader.read(65536), max(0.001, deadline - time.perf_counter()))
+            if not chunk:
+                break
+            now = time.perf_counter()
+            if result.first_token is None:
+                if b'"content"' in chunk:
+                    result.first_token = now - start
+            elif last is not None:
+                result.gaps.append(now - last)
+            if result.first_token is not None:
+                last = now
+            data += chunk
+        result.total = time.perf_counter() - start
+        result.companion = b'\\u2e3b' in data
+        result.ok = result.status == 200 and (length is not None or b'data: [DONE]' in data)
+        if result.first_token is None and result.ok:
+            result.first_token = result.total
+    except Exception as e:
+        result.error = type(e).__name__
+    finally:
+        if writer is not None:
+            writer.close()
+    return result
+
+
+async def run_load(port: int, args) -> Dict:
+    results = []
+    queue = asyncio.Queue()
+    for i in range(args.requests):
+        queue.put_nowait(i)
+
+    async def client():
+        while True:
+            try:
+                i = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            text = 'Benchmark message number %d, please answer at length.' % (i % args.distinct)
+            body = json.dumps({'model': args.model, 'stream': args.stream,
+                               'messages': [{'role': 'user', 'content': text}]}).encode('utf-8')
+            results.append(await one_request(port, body, args.timeout))
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(args.concurrency)))
+    return summarize(results, time.perf_counter() - start)
+
+
+def summarize(results: List[Result], wall: float) -> Dict:
+    ok = [r for r in results if r.ok]
+    errors = {}
+    for r in results:
+        if not r.ok:
+            key = r.error or 'HTTP %s' % r.status
+            errors[key] = errors.get(key, 0) + 1
+
+    def pcts(values):
+        return {'p50': percentile(values, 50), 'p95': percentile(values, 95), 'p99': percentile(values, 99),
+                'max': max(values) if values else None}
+
+    gaps = [g for r in ok for g in r.gaps]
+    return {
+        'requests': len(results),
+        'ok': len(ok),
+        'errors': errors,
+        'with_companion': sum(1 for r in ok if r.companion),
+        'rps': len(ok) / wall if wall else None,
+        'ttfb': pcts([r.ttfb for r in ok]),
+        'first_token': pcts([r.first_token for r in ok]),
+        'inter_chunk_gap': pcts(gaps),
+        'latency': pcts([r.total for r in ok]),
+    }
+
+
+# -- Process helpers ----------------------------------------------------
+
+def _process_tree(root: int) -> List[int]:
+    """root and its direct children (supervisor workers)."""
+    pids = [root]
+    try:
+        for name in os.listdir('/proc'):
+            if name.isdigit():
+                try:
+                    with open('/proc/%s/stat' % name) as f:
+                        fields = f.read().rsplit(')', 1)[1].split()
+                except OSError:
+                    continue
+                if int(fields[1]) == root:
+                    pids.append(int(name))
+    except OSError:
+        pass
+    return pids
+
+
+def cpu_seconds(root: int) -> Optional[float]:
+    total = 0
+    try:
+        for pid in _process_tree(root):
+            with open('/proc/%d/stat' % pid) as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+            total += int(fields[11]) + int(fields[12])  # utime + stime
+    except OSError:
+        return None
+    return total / _CLK_TCK
+
+
+def rss_bytes(root: int) -> Optional[int]:
+    total = 0
+    try:
+        for pid in _process_tree(root):
+            with open('/proc/%d/status' % pid) as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        total += int(line.split()[1]) * 1024
+    except OSError:
+        return None
+    return total
+
+
+def wait_for_port(port: int, timeout: float = 15.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=0.5).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError('nothing listening on port %d after %ss' % (port, timeout))
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+async def measure_proxy(pid: int, port: int, args, run=run_load) -> Dict:
+    """run(port, args) against the proxy, with the proxy's CPU time and peak RSS added to its summary."""
+    peak = 0
+
+    async def sample_rss():
+        nonlocal peak
+        while True:
+            peak = max(peak, rss_bytes(pid) or 0)
+            await asyncio.sleep(0.2)
+
+    cpu0 = cpu_seconds(pid)
+    sampler = asyncio.ensure_future(sample_rss())
+    try:
+        summary = await run(port, args)
+    finally:
+        sampler.cancel()
+    cpu1 = cpu_seconds(pid)
+    if cpu0 is not None and cpu1 is not None:
+        summary['cpu_seconds'] = cpu1 - cpu0
+        summary['cpu_ms_per_request'] = (cpu1 - cpu0) * 1000 / max(1, summary['ok'])
+    summary['rss_peak_mb'] = peak / (1024 * 1024) if peak else None
+    return summary
+
+
+# -- Report -------------------------------------------------------------
+
+def _ms(value) -> str:
+    return '%8.1f' % (value * 1000) if value is not None else '%8s' % '-'
+
+
+def print_report(direct: Dict, proxied: Dict):
+    print()
+    print('%-22s %8s %8s %8s %8s' % ('(ms)', 'p50', 'p95', 'p99', 'max'))
+    for name, summary in (('direct', direct), ('proxy', proxied)):
+        print('%s: %d/%d ok, %.1f req/s, %d with companion, errors %s' % (
+            name, summary['ok'], summary['requests'], summary['rps'] or 0, summary['with_companion'],
+            summary['errors'] or 'none'))
+        for metric in ('ttfb', 'first_token', 'inter_chunk_gap', 'latency'):
+            p = summary[metric]
+            print('  %-20s %s %s %s %s' % (metric, _ms(p['p50']), _ms(p['p95']), _ms(p['p99']), _ms(p['max'])))
+    print('added by proxy:')
+    for metric in ('first_token', 'latency'):
+        row = []
+        for key in ('p50', 'p95', 'p99'):
+            a, b = proxied[metric][key], direct[metric][key]
+            row.append(_ms(a - b if a is not None and b is not None else None))
+        print('  %-20s %s' % (metric, ' '.join(row)))
+    if proxied.get('cpu_seconds') is not None:
+        print('proxy cpu: %.2fs (%.2f ms/request), peak rss %.1f MB' % (
+            proxied['cpu_seconds'], proxied['cpu_ms_per_request'], proxied['rss_peak_mb'] or 0))
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument('--concurrency', type=int, default=20)
+    ap.add_argument('--requests', type=int, default=200)
+    ap.add_argument('--distinct', type=int, default=0,
+                    help='number of distinct user messages (default: all distinct, so no companion cache hits)')
+    ap.add_argument('--no-stream', dest='stream', action='store_false')
+    ap.add_argument('--model', default='mock/model')
+    ap.add_argument('--timeout', type=float, default=60.0)
+    ap.add_argument('--engine', choices=('threading', 'asyncio'), default='threading')
+    ap.add_argument('--workers', type=int, default=1)
+    ap.add_argument('--warmup', type=int, default=5, help='requests sent through the proxy before measuring')
+    ap.add_argument('--json', help='also write the results to this file')
+    ap.add_argument('--proxy-log', help='write the proxy output to this file (default: discarded)')
+    args, mock_args = ap.parse_known_args()
+    args.distinct = args.distinct or args.requests
+    prompt_file = 'companion_prompt_grammar.txt'
+    if '--companion-prompt-file' in mock_args:
+        prompt_file = mock_args[mock_args.index('--companion-prompt-file') + 1]
+
+    mock_port, proxy_port = free_port(), free_port()
+    mock = subprocess.Popen([sys.executable, '-m', 'benchmarks.mock_upstream', '--port', str(mock_port)] + mock_args)
+    proxy = None
+    try:
+        wait_for_port(mock_port)
+        print('direct: %d requests, concurrency %d' % (args.requests, args.concurrency), flush=True)
+        direct = asyncio.run(run_load(mock_port, args))
+
+        env = dict(os.environ, API_BASE='http://127.0.0.1:%d' % mock_port, PROXY_PORT=str(proxy_port),
+                   COMPANION_PROMPT_FILE=prompt_file, LOG_LEVEL=os.environ.get('LOG_LEVEL', 'WARNING'))
+        env.setdefault('COMPANION_TEMPERATURE', '0.1')
+        proxy_out = open(args.proxy_log, 'w') if args.proxy_log else subprocess.DEVNULL
+        proxy = subprocess.Popen([sys.executable, 'main.py', '--engine', args.engine, '--workers', str(args.workers)],
+                                 env=env, stdout=proxy_out, stderr=subprocess.STDOUT)
+        wait_for_port(proxy_port)
+        if args.warmup:
+            warm = argparse.Namespace(**dict(vars(args), requests=args.warmup, concurrency=1))
+            asyncio.run(run_load(proxy_port, warm))
+        print('proxy (%s, %d worker(s)): %d requests, concurrency %d' % (
+            args.engine, args.workers, args.requests, args.concurrency), flush=True)
+        proxied = asyncio.run(measure_proxy(proxy.pid, proxy_port, args))
+    finally:
+        for proc in (proxy, mock):
+            if proc is not None:
+                proc.terminate()
+                try:
+                    proc.wait(timeout=40)
+                except subprocess.TimeoutExpired:
+                    proc.kill()
+
+    print_report(direct, proxied)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'args': vars(args), 'mock_args': mock_args, 'direct': direct, 'proxy': proxied}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
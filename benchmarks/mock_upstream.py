@@ -0,0 +1,254 @@
+"""Local stand-in for API_BASE /v1/chat/completions, for benchmarking the proxy offline.
+
+Main requests get an SSE stream (or a JSON completion when stream is false)
+generated at a fixed token rate. Companion requests are recognised by the
+companion prompt text and answered after a latency drawn from a
+configurable distribution, with a configurable share of 'OK' answers and
+errors.
+
+Run from the repository root:
+
+    python -m benchmarks.mock_upstream --port 9101 --tokens 200 --token-rate 50 \\
+        --companion-latency lognormal:0.6,0.4 --companion-error-rate 0.02
+"""
+import argparse
+import asyncio
+import json
+import random
+import signal
+import time
+
+_LOREM = ('lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor '
+          'incididunt ut labore et dolore magna aliqua').split()
+
+
+def parse_distribution(spec: str):
+    """Return a sampler for 'fixed:S', 'uniform:A,B', 'normal:MU,SIGMA' or 'lognormal:MEDIAN,SIGMA' (seconds)."""
+    kind, _, args = spec.partition(':')
+    values = [float(v) for v in args.split(',') if v]
+    if kind == 'fixed':
+        return lambda: values[0]
+    if kind == 'uniform':
+        return lambda: random.uniform(values[0], values[1])
+    if kind == 'normal':
+        return lambda: max(0.0, random.gauss(values[0], values[1]))
+    if kind == 'lognormal':
+        import math
+        mu = math.log(values[0])
+        return lambda: random.lognormvariate(mu, values[1])
+    raise ValueError('unknown distribution %r' % spec)
+
+
+def _message_text(message: dict) -> str:
+    content = message.get('content', '')
+    if isinstance(content, list):
+        return ''.join(part.get('text', '') for part in content if isinstance(part, dict))
+    return content if isinstance(content, str) else ''
+
+
+def _batch_texts(req: dict):
+    """The texts of a batched companion check (a JSON array after 'Texts:'), or None."""
+    prompt = _message_text(req['messages'][-1])
+    _, sep, tail = prompt.rpartition('Texts:\n')
+    if not sep:
+        return None
+    try:
+        texts = json.loads(tail)
+    except ValueError:
+        return None
+    return texts if isinstance(texts, list) else None
+
+
+def companion_marker(prompt_file: str) -> str:
+    """Text every companion prompt contains: the template up to {user_text}."""
+    with open(prompt_file) as f:
+        template = f.read().strip()
+    return template.split('{user_text}')[0].strip()[-60:]
+
+
+class MockUpstream:
+    def __init__(self, args):
+        self.args = args
+        self.markers = [companion_marker(f) for f in args.companion_prompt_file or ['companion_prompt_grammar.txt']]
+        self.seen_prefixes = set()
+        self.companion_latency = parse_distribution(args.companion_latency)
+        self.counts = {'main': 0, 'companion': 0, 'companion_batched': 0, 'companion_errors': 0, 'disconnects': 0}
+
+    # -- HTTP plumbing -------------------------------------------------
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                try:
+                    head = await reader.readuntil(b'\r\n\r\n')
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    break
+                lines = head.decode('latin-1').split('\r\n')
+                method, path, _ = lines[0].split(' ', 2)
+                headers = {}
+                for line in lines[1:]:
+                    if ':' in line:
+                        name, value = line.split(':', 1)
+                        headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+                if method != 'POST' or not path.endswith('/chat/completions'):
+                    await self._send(writer, 404, 'text/plain', b'Not Found')
+                    continue
+                await self.chat_completions(json.loads(body.decode('utf-8')), writer)
+                if headers.get('connection', '').lower() == 'close':
+                    break
+        except (ConnectionError, BrokenPipeError):
+            self.counts['disconnects'] += 1
+        finally:
+            writer.close()
+
+    async def _send(self, writer, status: int, ctype: str, body: bytes, extra: bytes = b''):
+        writer.write(b'HTTP/1.1 %d X\r\nContent-Type: %s\r\nContent-Length: %d\r\n%s\r\n'
+                     % (status, ctype.encode(), len(body), extra) + body)
+        await writer.drain()
+
+    async def _write_chunk(self, writer, data: bytes):
+        writer.write(b'%x\r\n%s\r\n' % (len(data), data))
+        await writer.drain()
+
+    # -- Responses -----------------------------------------------------
+
+    async def chat_completions(self, req: dict, writer):
+        messages = req.get('messages') or []
+        # The companion instructions come as one user message or as a system message before the text
+        prompt = ''.join(_message_text(m) for m in messages)
+        if any(marker and marker in prompt for marker in self.markers):
+            await self.companion(req, writer)
+        else:
+            self.counts['main'] += 1
+            tokens = [random.choice(_LOREM) + ' ' for _ in range(self.args.tokens)]
+            await self.respond(req, writer, tokens, self.args.token_rate, first_token_delay=self.args.ttft)
+
+    async def companion(self, req: dict, writer):
+        self.counts['companion'] += 1
+        await asyncio.sleep(self.companion_latency())
+        if random.random() < self.args.companion_error_rate:
+            self.counts['companion_errors'] += 1
+            extra = b''
+            if self.args.companion_retry_after:
+                extra = b'Retry-After: %d\r\n' % self.args.companion_retry_after
+            await self._send(writer, self.args.companion_error_status, 'application/json',
+                             b'{"error": {"message": "mock companion error"}}', extra)
+            return
+        batch = _batch_texts(req)
+        if batch is not None:
+            # A batched check: one answer per text, as a JSON array
+            self.counts['companion_batched'] += len(batch)
+            answers = [''.join(self.companion_answer()) for _ in batch]
+            tokens = [json.dumps(answers)]
+        else:
+            tokens = self.companion_answer()
+        await self.respond(req, writer, tokens, self.args.companion_token_rate, first_token_delay=0)
+
+    def companion_answer(self):
+        if random.random() < self.args.companion_ok_rate:
+            return ['OK']
+        return [random.choice(_LOREM) + ' ' for _ in range(self.args.companion_tokens)]
+
+    def usage(self, req: dict, tokens) -> dict:
+        """Rough token counts; a system message seen before counts as a cached prompt prefix."""
+        messages = req.get('messages') or []
+        prompt_tokens = sum(len(_message_text(m)) for m in messages) // 4
+        cached = 0
+        if messages and messages[0].get('role') == 'system':
+            prefix = _message_text(messages[0])
+            if prefix in self.seen_prefixes:
+                cached = len(prefix) // 4
+            self.seen_prefixes.add(prefix)
+        return {'prompt_tokens': prompt_tokens, 'completion_tokens': len(tokens),
+                'total_tokens': prompt_tokens + len(tokens), 'prompt_tokens_details': {'cached_tokens': cached}}
+
+    async def respond(self, req: dict, writer, tokens, token_rate: float, first_token_delay: float):
+        created = int(time.time())
+        if not req.get('stream'):
+            await asyncio.sleep(first_token_delay + len(tokens) / token_rate)
+            out = {
+                'id': 'mock', 'object': 'chat.completion', 'created': created, 'model': req.get('model'),
+                'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': ''.join(tokens)},
+                             'finish_reason': 'stop'}],
+                'usage': self.usage(req, tokens),
+            }
+            await self._send(writer, 200, 'application/json', json.dumps(out).encode('utf-8'))
+            return
+
+        writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nTransfer-Encoding: chunked\r\n\r\n')
+        await asyncio.sleep(first_token_delay)
+        per_event = max(1, self.args.chunk_tokens)
+        interval = per_event / token_rate
+        groups = [tokens[i:i + per_event] for i in range(0, len(tokens), per_event)]
+        start = time.monotonic()
+        for n, group in enumerate(groups):
+            last = n == len(groups) - 1
+            finish = 'stop' if last and self.args.finish == 'last' else None
+            await self._event(writer, created, req, {'content': ''.join(group)}, finish)
+            # Pace against the start time so slow writes do not stretch the stream
+            delay = start + (n + 1) * interval - time.monotonic()
+            if delay > 0 and not last:
+                await asyncio.sleep(delay)
+        if self.args.finish == 'separate':
+            await self._event(writer, created, req, {}, 'stop')
+        if (req.get('stream_options') or {}).get('include_usage'):
+            obj = {'id': 'mock', 'object': 'chat.completion.chunk', 'created': created, 'model': req.get('model'),
+                   'choices': [], 'usage': self.usage(req, tokens)}
+            await self._write_chunk(writer, b'data: ' + json.dumps(obj).encode('utf-8') + b'\n\n')
+        await self._write_chunk(writer, b'data: [DONE]\n\n')
+        await self._write_chunk(writer, b'')
+
+    async def _event(self, writer, created: int, req: dict, delta: dict, finish):
+        obj = {'id': 'mock', 'object': 'chat.completion.chunk', 'created': created, 'model': req.get('model'),
+               'choices': [{'index': 0, 'delta': delta, 'finish_reason': finish}]}
+        await self._write_chunk(writer, b'data: ' + json.dumps(obj).encode('utf-8') + b'\n\n')
+
+
+def build_parser() -> argparse.ArgumentParser:
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument('--host', default='127.0.0.1')
+    ap.add_argument('--port', type=int, default=9101)
+    ap.add_argument('--tokens', type=int, default=200, help='tokens per main completion')
+    ap.add_argument('--token-rate', type=float, default=100.0, help='main tokens per second')
+    ap.add_argument('--chunk-tokens', type=int, default=1, help='tokens per SSE event')
+    ap.add_argument('--ttft', type=float, default=0.2, help='main time to first token (seconds)')
+    ap.add_argument('--finish', choices=('separate', 'last', 'none'), default='separate',
+                    help='finish_reason in its own event, on the last content event, or omitted')
+    ap.add_argument('--companion-prompt-file', action='append',
+                    help='prompt template used to recognise companion calls (repeat for several companions; '
+                         'default companion_prompt_grammar.txt)')
+    ap.add_argument('--companion-latency', default='lognormal:0.5,0.4',
+                    help='time to first companion token: fixed:S, uniform:A,B, normal:MU,SIGMA, lognormal:MEDIAN,SIGMA')
+    ap.add_argument('--companion-ok-rate', type=float, default=0.7, help='share of companion answers that are OK')
+    ap.add_argument('--companion-error-rate', type=float, default=0.0, help='share of companion calls failing')
+    ap.add_argument('--companion-error-status', type=int, default=500, help='HTTP status of a failing companion call')
+    ap.add_argument('--companion-retry-after', type=int, default=0,
+                    help='Retry-After seconds sent with failing companion calls (0 = none)')
+    ap.add_argument('--companion-tokens', type=int, default=40, help='tokens in a non-OK companion answer')
+    ap.add_argument('--companion-token-rate', type=float, default=150.0)
+    ap.add_argument('--seed', type=int, help='seed the random latencies and answers (replays)')
+    return ap
+
+
+async def serve(args):
+    mock = MockUpstream(args)
+    server = await asyncio.start_server(mock.handle, args.host, args.port, backlog=4096)
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop.set)
+    async with server:
+        await stop.wait()
+    print('mock upstream: %s' % json.dumps(mock.counts), flush=True)
+
+
+def main():
+    args = build_parser().parse_args()
+    if args.seed is not None:
+        random.seed(args.seed)
+    asyncio.run(serve(args))
+
+
+if __name__ == '__main__':
+    main()
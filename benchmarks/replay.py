@@ -0,0 +1,214 @@
+"""Replay captured traffic (CAPTURE_FILE) through the proxy against a local mock upstream.
+
+Reads the JSONL records the proxy's capture mode wrote (rotated and per-worker
+files too), starts benchmarks.mock_upstream shaped after the captured upstream
+timings and the proxy as subprocesses, then sends every captured body at its
+original offset from the first one, divided by --speed, and reports the same
+percentiles as benchmarks.load. --speed 0 sends them back to back from
+--concurrency clients. Requests keep their callers apart with the captured
+auth_id as a stand-in key. With --baseline (an earlier --json) the run fails
+when a p95 regressed by more than --max-regression percent.
+
+Run from the repository root; options not listed below are passed to the mock
+and replace the values derived from the capture:
+
+    python -m benchmarks.replay capture.jsonl [capture.jsonl.1 ...] [--speed 2] [--limit 1000] \\
+        [--engine asyncio] [--json after.json] [--baseline before.json] [--companion-ok-rate 0.5 ...]
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import statistics
+import subprocess
+import sys
+import time
+from typing import Dict, List
+
+from benchmarks.load import _ms, free_port, measure_proxy, one_request, summarize, wait_for_port
+
+
+def load_records(paths: List[str]) -> List[dict]:
+    """Captured requests from paths, oldest first; lines that are not records are skipped."""
+    records = []
+    for path in paths:
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if isinstance(record, dict) and isinstance(record.get('body'), dict) and 'ts' in record:
+                    records.append(record)
+    records.sort(key=lambda r: r['ts'])
+    return records
+
+
+def mock_args_from_capture(records: List[dict]) -> List[str]:
+    """Mock options matching the captured main stream and companion timings (medians)."""
+    first, gaps, events, companion = [], [], [], []
+    for record in records:
+        chunk_ms = record.get('chunk_ms') or []
+        if chunk_ms:
+            first.append(chunk_ms[0])
+            # The last two are the held finish_reason chunk and [DONE]
+            content = chunk_ms[:-2] or chunk_ms[:1]
+            events.append(len(content))
+            gaps.extend(b - a for a, b in zip(content, content[1:]) if b > a)
+        marks = record.get('marks') or {}
+        latency = marks.get('companion_first_delta', marks.get('companion_call_end'))
+        if latency and record.get('companion', {}).get('mark') == 'companion_submitted':
+            companion.append(latency)
+    args = []
+    if first:
+        args += ['--ttft', '%.3f' % (statistics.median(first) / 1000)]
+    if events:
+        args += ['--tokens', str(max(1, int(statistics.median(events))))]
+    if gaps:
+        args += ['--token-rate', '%.1f' % (1000 / max(statistics.median(gaps), 0.1))]
+    if companion:
+        logs = [math.log(ms / 1000) for ms in companion]
+        sigma = statistics.pstdev(logs) if len(logs) > 1 else 0.4
+        args += ['--companion-latency', 'lognormal:%.3f,%.3f' % (statistics.median(companion) / 1000, sigma)]
+    return args
+
+
+async def replay(port: int, records: List[dict], args) -> Dict:
+    results = []
+    lags = []
+    clients = asyncio.Semaphore(args.concurrency if args.speed <= 0 else len(records))
+    t0 = records[0]['ts']
+
+    async def send(record):
+        if args.speed > 0:
+            delay = (record['ts'] - t0) / args.speed - (time.perf_counter() - start)
+            if delay > 0:
+                await asyncio.sleep(delay)
+            elif delay < -0.01:
+                lags.append(-delay)
+        body = json.dumps(record['body']).encode('utf-8')
+        auth = ('Bearer replay-%s' % (record.get('auth_id') or 'anonymous')).encode('latin-1')
+        async with clients:
+            results.append(await one_request(port, body, args.timeout, auth))
+
+    start = time.perf_counter()
+    await asyncio.gather(*(send(record) for record in records))
+    summary = summarize(results, time.perf_counter() - start)
+    # Requests sent more than 10 ms later than scheduled: the driver could not keep up with --speed
+    summary['late_sends'] = len(lags)
+    summary['max_send_lag'] = max(lags) if lags else 0.0
+    return summary
+
+
+def compare(baseline: Dict, current: Dict, max_regression: float) -> bool:
+    """Print p50/p95 changes against an earlier run; False if a p95 regressed by more than max_regression %."""
+    ok = True
+    print('against baseline:')
+    for metric in ('ttfb', 'first_token', 'latency'):
+        row = []
+        for key in ('p50', 'p95'):
+            before, after = baseline[metric][key], current[metric][key]
+            if not before or after is None:
+                row.append('%16s' % '-')
+                continue
+            change = (after - before) * 100 / before
+            row.append('%s (%+5.1f%%)' % (_ms(after - before), change))
+            if key == 'p95' and change > max_regression:
+                ok = False
+        print('  %-20s %s' % (metric, ' '.join(row)))
+    if baseline.get('rps') and current.get('rps'):
+        print('  %-20s %+.1f%%' % ('rps', (current['rps'] - baseline['rps']) * 100 / baseline['rps']))
+    if not ok:
+        print('p95 regressed by more than %.0f%%' % max_regression)
+    return ok
+
+
+def print_report(summary: Dict):
+    print()
+    print('%-22s %8s %8s %8s %8s' % ('(ms)', 'p50', 'p95', 'p99', 'max'))
+    print('replay: %d/%d ok, %.1f req/s, %d with companion, errors %s' % (
+        summary['ok'], summary['requests'], summary['rps'] or 0, summary['with_companion'],
+        summary['errors'] or 'none'))
+    for metric in ('ttfb', 'first_token', 'inter_chunk_gap', 'latency'):
+        p = summary[metric]
+        print('  %-20s %s %s %s %s' % (metric, _ms(p['p50']), _ms(p['p95']), _ms(p['p99']), _ms(p['max'])))
+    if summary['late_sends']:
+        print('%d request(s) sent late, up to %.0f ms' % (summary['late_sends'], summary['max_send_lag'] * 1000))
+    if summary.get('cpu_seconds') is not None:
+        print('proxy cpu: %.2fs (%.2f ms/request), peak rss %.1f MB' % (
+            summary['cpu_seconds'], summary['cpu_ms_per_request'], summary['rss_peak_mb'] or 0))
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument('capture', nargs='+', help='capture files (CAPTURE_FILE and its rotations)')
+    ap.add_argument('--speed', type=float, default=1.0,
+                    help='replay this many times faster than captured (0 = back to back)')
+    ap.add_argument('--concurrency', type=int, default=20, help='clients with --speed 0')
+    ap.add_argument('--limit', type=int, default=0, help='replay only the first N captured requests')
+    ap.add_argument('--timeout', type=float, default=60.0)
+    ap.add_argument('--engine', choices=('threading', 'asyncio'), default='threading')
+    ap.add_argument('--workers', type=int, default=1)
+    ap.add_argument('--json', help='also write the results to this file')
+    ap.add_argument('--baseline', help='results of an earlier run (--json) to compare with')
+    ap.add_argument('--max-regression', type=float, default=10.0,
+                    help='p95 increase over --baseline, in percent, that fails the run')
+    ap.add_argument('--proxy-log', help='write the proxy output to this file (default: discarded)')
+    args, mock_args = ap.parse_known_args()
+    records = load_records(args.capture)
+    if args.limit:
+        records = records[:args.limit]
+    if not records:
+        sys.exit('no captured requests in %s' % ', '.join(args.capture))
+
+    derived = mock_args_from_capture(records)
+    for i in range(0, len(derived), 2):
+        if derived[i] not in mock_args:
+            mock_args += derived[i:i + 2]
+    if '--seed' not in mock_args:
+        mock_args += ['--seed', '0']
+    prompt_file = 'companion_prompt_grammar.txt'
+    if '--companion-prompt-file' in mock_args:
+        prompt_file = mock_args[mock_args.index('--companion-prompt-file') + 1]
+
+    mock_port, proxy_port = free_port(), free_port()
+    mock = subprocess.Popen([sys.executable, '-m', 'benchmarks.mock_upstream', '--port', str(mock_port)] + mock_args)
+    proxy = None
+    try:
+        wait_for_port(mock_port)
+        env = dict(os.environ, API_BASE='http://127.0.0.1:%d' % mock_port, PROXY_PORT=str(proxy_port),
+                   COMPANION_PROMPT_FILE=prompt_file, LOG_LEVEL=os.environ.get('LOG_LEVEL', 'WARNING'),
+                   CAPTURE_FILE='')
+        env.setdefault('COMPANION_TEMPERATURE', '0.1')
+        proxy_out = open(args.proxy_log, 'w') if args.proxy_log else subprocess.DEVNULL
+        proxy = subprocess.Popen([sys.executable, 'main.py', '--engine', args.engine, '--workers', str(args.workers)],
+                                 env=env, stdout=proxy_out, stderr=subprocess.STDOUT)
+        wait_for_port(proxy_port)
+        span = records[-1]['ts'] - records[0]['ts']
+        print('replay (%s, %d worker(s)): %d requests captured over %.1fs, speed %s, mock %s' % (
+            args.engine, args.workers, len(records), span, args.speed or 'max', ' '.join(mock_args)), flush=True)
+        summary = asyncio.run(measure_proxy(proxy.pid, proxy_port, args,
+                                            lambda port, args: replay(port, records, args)))
+    finally:
+        for proc in (proxy, mock):
+            if proc is not None:
+                proc.terminate()
+                try:
+                    proc.wait(timeout=40)
+                except subprocess.TimeoutExpired:
+                    proc.kill()
+
+    print_report(summary)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'args': vars(args), 'mock_args': mock_args, 'proxy': summary}, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if not compare(baseline.get('proxy', baseline), summary, args.max_regression):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+"""Microbenchmark: SSE framing (byte-at-a-time loop vs SSEParser) and relay loops
+(per-event parse and re-encode vs byte passthrough).
+
+Run from the repository root:
+
+    python -m benchmarks.sse_bench [--events 20000] [--repeat 3]
+"""
+import argparse
+import io
+import json
+import time
+
+from proxy.chat_completions import PassthroughScanner, is_finish_reason_event
+from proxy.sse import SSEParser, READ_CHUNK_SIZE
+
+
+def make_stream(n_events: int, crlf: bool = False) -> bytes:
+    """Build an OpenAI-style chat.completions SSE body with n_events content deltas."""
+    nl = b'\r\n' if crlf else b'\n'
+    parts = []
+    for i in range(n_events):
+        obj = {
+            'id': 'gen-bench',
+            'object': 'chat.completion.chunk',
+            'choices': [{'index': 0, 'delta': {'content': 'token%d ' % i}, 'finish_reason': None}],
+        }
+        parts.append(b'data: ' + json.dumps(obj).encode('utf-8') + nl + nl)
+    final = {'choices': [{'index': 0, 'delta': {}, 'finish_reason': 'stop'}]}
+    parts.append(b'data: ' + json.dumps(final).encode('utf-8') + nl + nl)
+    parts.append(b'data: [DONE]' + nl + nl)
+    return b''.join(parts)
+
+
+def legacy_loop(raw) -> int:
+    """The relay loop previously used by ProxyHandler.do_POST."""
+    events = 0
+    buffer = b''
+    while True:
+        chunk = raw.read(1)
+        if not chunk:
+            break
+        buffer += chunk
+        if buffer.endswith(b'\n\n'):
+            line = buffer.decode('utf-8').strip()
+            buffer = b''
+            if line:
+                events += 1
+    return events
+
+
+def parser_loop(raw) -> int:
+    events = 0
+    parser = SSEParser()
+    for chunk in iter(lambda: raw.read1(READ_CHUNK_SIZE), b''):
+        for event in parser.feed(chunk):
+            event.raw.decode('utf-8')
+            events += 1
+    return events
+
+
+def event_relay_loop(raw) -> int:
+    """The per-event relay loop: decode, two json.loads, re-encode for every event."""
+    events = 0
+    parser = SSEParser()
+    for chunk in iter(lambda: raw.read1(READ_CHUNK_SIZE), b''):
+        for event in parser.feed(chunk):
+            line = event.raw.decode('utf-8')
+            if not event.is_done:
+                is_finish_reason_event(event)
+                json.loads(event.data)
+            (line + '\n\n').encode('utf-8')
+            events += 1
+    return events
+
+
+def passthrough_relay_loop(raw) -> int:
+    """Byte passthrough: forward runs unchanged, scan only for finish_reason/[DONE].
+
+    Returns the number of forwarded runs; run() is given the event count instead.
+    """
+    segments = 0
+    scanner = PassthroughScanner()
+    for chunk in iter(lambda: raw.read1(READ_CHUNK_SIZE), b''):
+        for _ in scanner.feed(chunk):
+            segments += 1
+    return segments
+
+
+def run(name: str, loop, body: bytes, repeat: int, n_events: int = None):
+    best_wall = best_cpu = None
+    events = 0
+    for _ in range(repeat):
+        raw = io.BufferedReader(io.BytesIO(body))
+        wall0, cpu0 = time.perf_counter(), time.process_time()
+        events = loop(raw)
+        if n_events is not None:
+            events = n_events
+        wall, cpu = time.perf_counter() - wall0, time.process_time() - cpu0
+        best_wall = wall if best_wall is None else min(best_wall, wall)
+        best_cpu = cpu if best_cpu is None else min(best_cpu, cpu)
+    mb = len(body) / (1024 * 1024)
+    print('%-12s events=%-7d events/s=%12.0f  cpu ms/MB=%9.2f' % (
+        name, events, events / best_wall, best_cpu * 1000 / mb))
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument('--events', type=int, default=20000)
+    ap.add_argument('--repeat', type=int, default=3)
+    args = ap.parse_args()
+
+    body = make_stream(args.events)
+    print('stream: %d bytes, %d events' % (len(body), args.events + 2))
+    run('legacy', legacy_loop, body, args.repeat)
+    run('parser', parser_loop, body, args.repeat)
+
+    crlf_body = make_stream(args.events, crlf=True)
+    run('parser', parser_loop, crlf_body, args.repeat)
+    print('(last row uses \\r\\n framing, which the legacy loop cannot split)')
+
+    print('relay loops:')
+    run('events', event_relay_loop, body, args.repeat)
+    run('passthrough', passthrough_relay_loop, body, args.repeat, n_events=args.events + 2)
+
+
+if __name__ == '__main__':
+    main()
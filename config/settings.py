@@ -19,7 +19,157 @@ COMPANION_TEMPERATURE = os.environ.get('COMPANION_TEMPERATURE')
 
 # Load companion prompt from file
 COMPANION_PROMPT_FILE = os.environ.get('COMPANION_PROMPT_FILE')
-with open(COMPANION_PROMPT_FILE, 'r') as f:
-    COMPANION_PROMPT = f.read().strip()
+COMPANION_PROMPT = None
+if COMPANION_PROMPT_FILE or not os.environ.get('COMPANIONS'):
+    with open(COMPANION_PROMPT_FILE, 'r') as f:
+        COMPANION_PROMPT = f.read().strip()
 
-LOG_LEVEL = os.environ.get('LOG_LEVEL')
\ No newline at end of file
+LOG_LEVEL = os.environ.get('LOG_LEVEL')
+
+# Logging: 'text' or 'json' lines; with LOG_QUEUE_SIZE > 0 a background thread writes them
+# (records that do not fit are dropped). LOG_DEBUG_SAMPLE keeps that share of each DEBUG
+# message; LOG_RATE_LIMIT caps INFO/DEBUG records per message per second (0 = no cap)
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'text')
+LOG_QUEUE_SIZE = int(os.environ.get('LOG_QUEUE_SIZE', '10000'))
+LOG_DEBUG_SAMPLE = float(os.environ.get('LOG_DEBUG_SAMPLE', '1'))
+LOG_RATE_LIMIT = float(os.environ.get('LOG_RATE_LIMIT', '0'))
+
+# Server engine: 'threading' (ThreadingHTTPServer) or 'asyncio'
+SERVER_ENGINE = os.environ.get('SERVER_ENGINE', 'threading')
+
+# Worker processes sharing PROXY_PORT via SO_REUSEPORT (1 = single process)
+WORKERS = int(os.environ.get('WORKERS', '1'))
+# Seconds to let in-flight requests finish on shutdown
+DRAIN_TIMEOUT = float(os.environ.get('DRAIN_TIMEOUT', '30'))
+
+# How often (seconds) to check whether a busy request's client is still connected; a client that
+# left has its upstream stream and companion call cancelled (0 disables the check)
+DISCONNECT_POLL_INTERVAL = float(os.environ.get('DISCONNECT_POLL_INTERVAL', '0.5'))
+
+# Admission control (per worker; 0 = unlimited). Requests beyond MAX_CONCURRENT_REQUESTS wait in a
+# queue of MAX_QUEUED_REQUESTS for up to REQUEST_QUEUE_TIMEOUT seconds; a full queue gets 429, a
+# timed-out wait 503, both with Retry-After: OVERLOAD_RETRY_AFTER. Companion calls are skipped (cached
+# results only) once more than COMPANION_SHED_AT of the request limit is in use or all companion slots are busy
+MAX_CONCURRENT_REQUESTS = int(os.environ.get('MAX_CONCURRENT_REQUESTS', '256'))
+MAX_QUEUED_REQUESTS = int(os.environ.get('MAX_QUEUED_REQUESTS', '256'))
+REQUEST_QUEUE_TIMEOUT = float(os.environ.get('REQUEST_QUEUE_TIMEOUT', '10'))
+OVERLOAD_RETRY_AFTER = int(os.environ.get('OVERLOAD_RETRY_AFTER', '2'))
+MAX_CONCURRENT_COMPANION_CALLS = int(os.environ.get('MAX_CONCURRENT_COMPANION_CALLS', '128'))
+COMPANION_SHED_AT = float(os.environ.get('COMPANION_SHED_AT', '0.8'))
+
+# Streaming relay: 'passthrough' forwards upstream bytes unchanged and only parses
+# finish_reason/[DONE] events; 'events' parses and re-frames every event
+STREAM_RELAY_MODE = os.environ.get('STREAM_RELAY_MODE', 'passthrough')
+
+# Opt-in: messages at least this long are split into segments checked in parallel (0 = off)
+COMPANION_SEGMENT_MIN_CHARS = int(os.environ.get('COMPANION_SEGMENT_MIN_CHARS', '0'))
+COMPANION_SEGMENT_MAX_CHARS = int(os.environ.get('COMPANION_SEGMENT_MAX_CHARS', '400'))
+COMPANION_SEGMENT_MAX_PARALLEL = int(os.environ.get('COMPANION_SEGMENT_MAX_PARALLEL', '8'))
+
+# Companion request layout: 'single' (default) sends the formatted prompt as one user message; 'split'
+# (opt-in) sends the prompt file's instructions (the text before {user_text}) as a system message ahead
+# of the user text, so providers can cache that prefix. COMPANION_CACHE_HINTS adds cache_control to the instructions.
+# COMPANION_STREAM_USAGE asks for token usage (stream_options.include_usage) to record cached tokens
+COMPANION_PROMPT_LAYOUT = os.environ.get('COMPANION_PROMPT_LAYOUT', 'single')
+COMPANION_CACHE_HINTS = os.environ.get('COMPANION_CACHE_HINTS', '0') == '1'
+COMPANION_STREAM_USAGE = os.environ.get('COMPANION_STREAM_USAGE', '1') == '1'
+# End a companion call once its answer is exactly 'OK': 'auto' for prompts that ask for an exact "OK" reply,
+# 1 or 0 to force it (COMPANION_<NAME>_OK_EXIT per companion)
+COMPANION_OK_EXIT = os.environ.get('COMPANION_OK_EXIT', 'auto')
+
+# Opt-in batching: companion checks arriving within COMPANION_BATCH_MAX_WAIT_MS of each other (same model
+# and API key) are sent as one upstream call of up to COMPANION_BATCH_MAX_SIZE texts (0 or 1 = off)
+COMPANION_BATCH_MAX_SIZE = int(os.environ.get('COMPANION_BATCH_MAX_SIZE', '0'))
+COMPANION_BATCH_MAX_WAIT_MS = float(os.environ.get('COMPANION_BATCH_MAX_WAIT_MS', '20'))
+
+# Single-flight: identical requests (same body after companion history stripping, same API key) in flight
+# together share their companion calls; COALESCE_MAIN_STREAMS=1 also shares one upstream main stream among them
+COALESCE_COMPANIONS = os.environ.get('COALESCE_COMPANIONS', '1') == '1'
+COALESCE_MAIN_STREAMS = os.environ.get('COALESCE_MAIN_STREAMS', '0') == '1'
+
+# Local prefilter (opt-in, empty = off): checks (in order) that skip the companion call for text it cannot
+# improve. Built in:
+# length (fewer than MIN_WORDS words, more than MAX_CHARS characters; 0 = no limit), code (code blocks,
+# stack traces, URLs, JSON, markup), script (letters mostly outside SCRIPTS, e.g. 'latin'; empty = any)
+# and recent_ok (text answered 'OK' recently, remembering RECENT_OK texts; exact matches unless
+# RECENT_OK_NORMALIZE=1 ignores case, spacing and a final period). COMPANION_<NAME>_PREFILTERS,
+# _MIN_WORDS and _SCRIPTS override them per companion
+COMPANION_PREFILTERS = os.environ.get('COMPANION_PREFILTERS', '')
+COMPANION_PREFILTER_MIN_WORDS = int(os.environ.get('COMPANION_PREFILTER_MIN_WORDS', '2'))
+COMPANION_PREFILTER_MAX_CHARS = int(os.environ.get('COMPANION_PREFILTER_MAX_CHARS', '0'))
+COMPANION_PREFILTER_SCRIPTS = os.environ.get('COMPANION_PREFILTER_SCRIPTS', '')
+COMPANION_PREFILTER_RECENT_OK = int(os.environ.get('COMPANION_PREFILTER_RECENT_OK', '1024'))
+COMPANION_PREFILTER_RECENT_OK_NORMALIZE = os.environ.get('COMPANION_PREFILTER_RECENT_OK_NORMALIZE', '0') == '1'
+
+# Companion output budget: scales with the message length within these bounds
+COMPANION_MIN_TOKENS = int(os.environ.get('COMPANION_MIN_TOKENS', '64'))
+COMPANION_MAX_TOKENS = int(os.environ.get('COMPANION_MAX_TOKENS', '1024'))
+
+# Companion deadlines. COMPANION_TIMEOUT is the hard limit for a companion call.
+# COMPANION_WAIT_POLICY decides how long a response waits for companion output:
+# 'adaptive' (recent per-model latency percentile * margin, clamped to MIN..MAX),
+# 'fixed' (always COMPANION_WAIT_MAX) or 'none' (only output that is already ready).
+# Budgets count from the start of the request.
+COMPANION_TIMEOUT = float(os.environ.get('COMPANION_TIMEOUT', '8'))
+COMPANION_WAIT_POLICY = os.environ.get('COMPANION_WAIT_POLICY', 'adaptive')
+COMPANION_WAIT_PERCENTILE = float(os.environ.get('COMPANION_WAIT_PERCENTILE', '95'))
+COMPANION_WAIT_MARGIN = float(os.environ.get('COMPANION_WAIT_MARGIN', '1.2'))
+COMPANION_WAIT_MIN = float(os.environ.get('COMPANION_WAIT_MIN', '0.5'))
+COMPANION_WAIT_MAX = float(os.environ.get('COMPANION_WAIT_MAX', '5'))
+COMPANION_LATENCY_WINDOW = int(os.environ.get('COMPANION_LATENCY_WINDOW', '200'))
+# What happens to a companion call still running when the response is finished:
+# 'cache' lets it finish and caches the result, 'cancel' stops it
+COMPANION_LATE_POLICY = os.environ.get('COMPANION_LATE_POLICY', 'cache')
+
+# Several companions per request: COMPANIONS=grammar,spanish runs them concurrently and appends their
+# outputs in that order. Each NAME is configured by COMPANION_<NAME>_PROMPT_FILE and optionally
+# COMPANION_<NAME>_MODEL (default: the request's model), COMPANION_<NAME>_TEMPERATURE and
+# COMPANION_<NAME>_TIMEOUT (defaults: COMPANION_TEMPERATURE, COMPANION_TIMEOUT). Unset, the only
+# companion is COMPANION_PROMPT_FILE
+COMPANIONS = [name.strip() for name in os.environ.get('COMPANIONS', '').split(',') if name.strip()]
+
+
+def companion_setting(name: str, key: str, default=None):
+    return os.environ.get('COMPANION_%s_%s' % (name.upper(), key), default)
+
+
+# Companion circuit breaker per (API_BASE, model); COMPANION_BREAKER_MIN_CALLS=0 disables it.
+# It opens when at least ERROR_RATE of the last WINDOW calls (once there are MIN_CALLS) failed, timed
+# out or took longer than SLOW_SECONDS to answer (0 = no latency limit), and at once on a 429. While open,
+# companion calls are skipped for COOLDOWN seconds (or the 429's Retry-After), doubling after each
+# failed trial call up to MAX_COOLDOWN
+COMPANION_BREAKER_WINDOW = int(os.environ.get('COMPANION_BREAKER_WINDOW', '20'))
+COMPANION_BREAKER_MIN_CALLS = int(os.environ.get('COMPANION_BREAKER_MIN_CALLS', '5'))
+COMPANION_BREAKER_ERROR_RATE = float(os.environ.get('COMPANION_BREAKER_ERROR_RATE', '0.5'))
+COMPANION_BREAKER_SLOW_SECONDS = float(os.environ.get('COMPANION_BREAKER_SLOW_SECONDS', '5'))
+COMPANION_BREAKER_COOLDOWN = float(os.environ.get('COMPANION_BREAKER_COOLDOWN', '10'))
+COMPANION_BREAKER_MAX_COOLDOWN = float(os.environ.get('COMPANION_BREAKER_MAX_COOLDOWN', '300'))
+
+# In-memory companion result cache (0 entries disables it)
+COMPANION_CACHE_SIZE = int(os.environ.get('COMPANION_CACHE_SIZE', '2048'))
+COMPANION_CACHE_MAX_BYTES = int(os.environ.get('COMPANION_CACHE_MAX_BYTES', str(16 * 1024 * 1024)))
+COMPANION_CACHE_TTL = float(os.environ.get('COMPANION_CACHE_TTL', '3600'))
+
+# Optional persistent companion cache (SQLite file); empty disables it
+COMPANION_DISK_CACHE_PATH = os.environ.get('COMPANION_DISK_CACHE_PATH', '')
+COMPANION_DISK_CACHE_MAX_BYTES = int(os.environ.get('COMPANION_DISK_CACHE_MAX_BYTES', str(256 * 1024 * 1024)))
+COMPANION_DISK_CACHE_TTL = float(os.environ.get('COMPANION_DISK_CACHE_TTL', str(7 * 24 * 3600)))
+
+# Upstream connection pooling
+UPSTREAM_POOL_SIZE = int(os.environ.get('UPSTREAM_POOL_SIZE', '32'))
+UPSTREAM_POOL_HOSTS = int(os.environ.get('UPSTREAM_POOL_HOSTS', '4'))
+UPSTREAM_IDLE_TIMEOUT = float(os.environ.get('UPSTREAM_IDLE_TIMEOUT', '90'))
+UPSTREAM_HEALTH_CHECK_INTERVAL = float(os.environ.get('UPSTREAM_HEALTH_CHECK_INTERVAL', '15'))
+# Request timelines: recent ones kept in memory for GET /traces (0 disables tracing);
+# requests slower than TRACE_SLOW_MS are also kept apart and appended to TRACE_SLOW_LOG (JSONL) if set
+TRACE_BUFFER_SIZE = int(os.environ.get('TRACE_BUFFER_SIZE', '200'))
+TRACE_SLOW_MS = float(os.environ.get('TRACE_SLOW_MS', '5000'))
+TRACE_SLOW_LOG = os.environ.get('TRACE_SLOW_LOG', '')
+# Traffic capture for benchmarks/replay.py: sanitized requests and their timings appended to CAPTURE_FILE
+# (JSONL, empty = off), rotated at CAPTURE_MAX_BYTES keeping CAPTURE_BACKUPS files; CAPTURE_SAMPLE is
+# the share of requests captured, CAPTURE_QUEUE_SIZE the records waiting for the writer before drops
+CAPTURE_FILE = os.environ.get('CAPTURE_FILE', '')
+CAPTURE_MAX_BYTES = int(os.environ.get('CAPTURE_MAX_BYTES', str(100 * 1024 * 1024)))
+CAPTURE_BACKUPS = int(os.environ.get('CAPTURE_BACKUPS', '5'))
+CAPTURE_SAMPLE = float(os.environ.get('CAPTURE_SAMPLE', '1'))
+CAPTURE_QUEUE_SIZE = int(os.environ.get('CAPTURE_QUEUE_SIZE', '10000'))
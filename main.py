@@ -1,11 +1,32 @@
+import argparse
+
 from config import settings
 from utils.logger import setup_logger
 from proxy.server import run_server
 
-logger = setup_logger(settings.LOG_LEVEL)
+logger = setup_logger(settings.LOG_LEVEL, settings.LOG_FORMAT, settings.LOG_QUEUE_SIZE, settings.LOG_DEBUG_SAMPLE,
+                      settings.LOG_RATE_LIMIT)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='LiteLLM Splitter Proxy')
+    parser.add_argument('--engine', choices=('threading', 'asyncio'), default=settings.SERVER_ENGINE,
+                        help='server engine (default: SERVER_ENGINE or threading)')
+    parser.add_argument('--workers', type=int, default=settings.WORKERS,
+                        help='number of worker processes sharing PROXY_PORT (default: WORKERS or 1)')
+    return parser.parse_args()
+
 
 if __name__ == '__main__':
+    args = parse_args()
     try:
-        run_server(port=int(settings.PROXY_PORT))
+        if args.workers > 1:
+            from proxy.supervisor import run_workers
+            run_workers(args.workers, args.engine, port=int(settings.PROXY_PORT))
+        elif args.engine == 'asyncio':
+            from proxy.async_server import run_async_server
+            run_async_server(port=int(settings.PROXY_PORT))
+        else:
+            run_server(port=int(settings.PROXY_PORT))
     except Exception as e:
-        logger.exception('Failed to start server: %s', e)
\ No newline at end of file
+        logger.exception('Failed to start server: %s', e)
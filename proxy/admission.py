@@ -0,0 +1,182 @@
+"""Admission control: bounded concurrency for main requests and companion calls.
+
+Main requests take a slot from request_limiter, waiting in a bounded FIFO
+queue when all slots are busy; a full queue or a wait past REQUEST_QUEUE_TIMEOUT
+is answered right away with 429/503 and Retry-After. Companion calls are
+shed first: once main requests pass COMPANION_SHED_AT of their limit, or
+no companion slot is free, new companion calls are skipped and only
+cached companion results are served.
+"""
+import asyncio
+import collections
+import threading
+from typing import Optional
+
+from config import settings
+from .metrics import shed_total, requests_in_flight, requests_queued, companion_calls_in_flight
+
+ADMITTED = 'admitted'
+QUEUE_FULL = 'queue_full'
+QUEUE_TIMEOUT = 'queue_timeout'
+
+
+class _Waiter:
+    __slots__ = ('granted', 'event', 'loop', 'future')
+
+    def __init__(self):
+        self.granted = False
+        self.event = None
+        self.loop = None
+        self.future = None
+
+    def wake(self):
+        if self.event is not None:
+            self.event.set()
+        else:
+            self.loop.call_soon_threadsafe(_resolve, self.future)
+
+
+def _resolve(future: asyncio.Future):
+    if not future.done():
+        future.set_result(None)
+
+
+class Limiter:
+    """Counts work in flight against limit, with up to max_queue waiters served first come, first served.
+
+    A released slot is handed straight to the oldest waiter, so a waiter is
+    never overtaken by a newcomer. Threads wait with acquire(), coroutines
+    with aacquire(); a limit of 0 admits everything but still counts it.
+    """
+
+    def __init__(self, limit: int, max_queue: int = 0):
+        self.limit = limit
+        self.max_queue = max_queue
+        self.active = 0
+        self._waiters = collections.deque()
+        self._lock = threading.Lock()
+
+    @property
+    def queued(self) -> int:
+        return len(self._waiters)
+
+    def saturated(self, share: float = 1.0) -> bool:
+        """Whether more than share of the limit is in use, or anyone is queued."""
+        return self.limit > 0 and (bool(self._waiters) or self.active > self.limit * share)
+
+    def try_acquire(self) -> bool:
+        with self._lock:
+            if self.limit <= 0 or (self.active < self.limit and not self._waiters):
+                self.active += 1
+                return True
+            return False
+
+    def _enqueue(self) -> Optional[_Waiter]:
+        # Called with the lock held, after try_acquire failed
+        if len(self._waiters) >= self.max_queue:
+            return None
+        waiter = _Waiter()
+        self._waiters.append(waiter)
+        return waiter
+
+    def _give_up(self, waiter: _Waiter) -> str:
+        with self._lock:
+            if waiter.granted:
+                return ADMITTED
+            self._waiters.remove(waiter)
+            return QUEUE_TIMEOUT
+
+    def acquire(self, timeout: float) -> str:
+        """Take a slot, waiting up to timeout; returns ADMITTED, QUEUE_FULL or QUEUE_TIMEOUT."""
+        if self.try_acquire():
+            return ADMITTED
+        with self._lock:
+            waiter = self._enqueue()
+            if waiter is None:
+                return QUEUE_FULL
+            waiter.event = threading.Event()
+        if waiter.event.wait(timeout):
+            return ADMITTED
+        return self._give_up(waiter)
+
+    async def aacquire(self, timeout: float) -> str:
+        """Coroutine counterpart of acquire."""
+        if self.try_acquire():
+            return ADMITTED
+        with self._lock:
+            waiter = self._enqueue()
+            if waiter is None:
+                return QUEUE_FULL
+            waiter.loop = asyncio.get_running_loop()
+            waiter.future = waiter.loop.create_future()
+        try:
+            await asyncio.wait_for(waiter.future, timeout)
+            return ADMITTED
+        except asyncio.TimeoutError:
+            return self._give_up(waiter)
+        except asyncio.CancelledError:
+            if self._give_up(waiter) == ADMITTED:
+                self.release()
+            raise
+
+    def release(self):
+        with self._lock:
+            if self._waiters:
+                # Hand the slot over; active stays the same
+                waiter = self._waiters.popleft()
+                waiter.granted = True
+                waiter.wake()
+            else:
+                self.active -= 1
+
+    def stats(self) -> dict:
+        return {'limit': self.limit, 'active': self.active, 'queued': self.queued, 'max_queue': self.max_queue}
+
+
+request_limiter = Limiter(settings.MAX_CONCURRENT_REQUESTS, settings.MAX_QUEUED_REQUESTS)
+companion_limiter = Limiter(settings.MAX_CONCURRENT_COMPANION_CALLS)
+
+requests_in_flight.set_function(lambda: request_limiter.active)
+requests_queued.set_function(lambda: request_limiter.queued)
+companion_calls_in_flight.set_function(lambda: companion_limiter.active)
+
+_shed = {'requests_rejected': 0, 'requests_timed_out': 0, 'companion_skipped': 0}
+_shed_lock = threading.Lock()
+
+
+def admission_stats() -> dict:
+    with _shed_lock:
+        shed = dict(_shed)
+    return {
+        'requests': request_limiter.stats(),
+        'companion_calls': companion_limiter.stats(),
+        'shed': shed,
+    }
+
+
+def record_rejection(outcome: str):
+    with _shed_lock:
+        _shed['requests_rejected' if outcome == QUEUE_FULL else 'requests_timed_out'] += 1
+    shed_total.labels(outcome).inc()
+
+
+def overload_response(outcome: str):
+    """(status, JSON body) for a request refused by admission control."""
+    if outcome == QUEUE_FULL:
+        status, message = 429, 'Proxy is at capacity; retry later'
+    else:
+        status, message = 503, 'Proxy is overloaded; retry later'
+    return status, {'error': {'message': message, 'type': 'overloaded', 'code': outcome}}
+
+
+def admit_companion() -> bool:
+    """Take a companion slot unless main requests are under pressure or all companion slots are busy.
+
+    The caller releases the slot with companion_limiter.release() when the call ends.
+    """
+    if request_limiter.saturated(settings.COMPANION_SHED_AT) or not companion_limiter.try_acquire():
+        with _shed_lock:
+            _shed['companion_skipped'] += 1
+        shed_total.labels('companion_skipped').inc()
+        return False
+    return True
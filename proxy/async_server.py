@@ -0,0 +1,591 @@
+"""asyncio server engine.
+
+Serves the same routes and output as ProxyHandler, but every connection,
+upstream stream and companion call is a coroutine on a single event loop,
+so long-lived streams do not each hold an OS thread.
+"""
+import asyncio
+import http.client
+import io
+import json
+import logging
+import signal
+import socket
+import time
+from email.utils import formatdate
+from http import HTTPStatus
+from typing import Optional
+from urllib.parse import urlparse, parse_qs
+
+from config import settings
+from utils.logger import setup_logger
+from .admission import ADMITTED, request_limiter, record_rejection, overload_response
+from .async_upstream import get_async_upstream_client, UpstreamHTTPError
+from .capture import capture_enabled, capture_request
+from .chat_completions import (
+    INITIAL_ROLE_CHUNK, DONE_CHUNK, strip_companion_history, mask_headers, build_upstream_headers,
+    extract_text_from_response_json, merge_companion_text, companion_chunk, RELAY_DONE, RELAY_FINISH,
+    aiter_relay_segments,
+)
+from .companion_builder import extract_last_user_message
+from .companion_processor import (
+    start_companion_task, companion_trace_mark, warm_companion_cache, companion_deadline, release_companion,
+)
+from .companion_stream import CompanionStream
+from .deadline import Deadline
+from .disconnect import record_disconnect
+from .metrics import (
+    CONTENT_TYPE as METRICS_CONTENT_TYPE, render_metrics, requests_total, upstream_ttfb_seconds, main_stream_seconds,
+    companion_wait_seconds, relayed_bytes_total, active_streams,
+)
+from .server import get_stats
+from .singleflight import request_key, join_main_stream
+from .tracing import start_trace, finish_trace, recent_traces, trace_limit, bind_trace, unbind_trace
+
+logger = setup_logger(settings.LOG_LEVEL, settings.LOG_FORMAT, settings.LOG_QUEUE_SIZE, settings.LOG_DEBUG_SAMPLE,
+                      settings.LOG_RATE_LIMIT)
+
+_MAX_HEADER_BYTES = 64 * 1024
+_SERVER_HEADER = 'LiteLLMSplitterProxy asyncio'
+
+
+async def _wait_companion(companion: Optional[CompanionStream], timeout: float) -> Optional[str]:
+    """Wait up to timeout for the companion result; None if it is missing, failed or late."""
+    if companion is None:
+        return None
+    return await companion.await_result(timeout)
+
+
+class _UpstreamStatusError(Exception):
+    """Upstream returned an HTTP error status (the equivalent of raise_for_status)."""
+
+
+class AsyncProxyHandler:
+    """Handles one client connection; mirrors ProxyHandler's routes and responses."""
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.reader = reader
+        self.writer = writer
+        self.close_connection = True
+        self.command = None
+        self.path = None
+        self.headers = None
+
+    # -- HTTP plumbing -------------------------------------------------
+
+    async def handle(self):
+        try:
+            while True:
+                self.close_connection = True
+                if not await self._read_request_head():
+                    break
+                if self.command == 'POST':
+                    await self.do_POST()
+                elif self.command == 'GET':
+                    await self.do_GET()
+                else:
+                    await self._send_simple(501, b'Unsupported method')
+                if self.close_connection:
+                    break
+        except (ConnectionResetError, BrokenPipeError, asyncio.IncompleteReadError):
+            pass  # Client disconnected between requests - that's fine
+        except Exception:
+            logger.exception('Unhandled error on client connection')
+        finally:
+            try:
+                self.writer.close()
+            except Exception:
+                pass
+
+    async def _read_request_head(self) -> bool:
+        try:
+            head = await self.reader.readuntil(b'\r\n\r\n')
+        except asyncio.IncompleteReadError:
+            return False
+        except asyncio.LimitOverrunError:
+            await self._send_simple(431, b'Request Header Fields Too Large')
+            return False
+        request_line, _, header_bytes = head.partition(b'\r\n')
+        parts = request_line.decode('latin-1').split()
+        if len(parts) != 3:
+            await self._send_simple(400, b'Bad Request')
+            return False
+        self.command, self.path, version = parts
+        self.headers = http.client.parse_headers(io.BytesIO(header_bytes))
+        conntype = (self.headers.get('Connection') or '').lower()
+        self.close_connection = version != 'HTTP/1.1' or conntype == 'close'
+        if (self.headers.get('Expect') or '').lower() == '100-continue':
+            self.writer.write(b'HTTP/1.1 100 Continue\r\n\r\n')
+        return True
+
+    def _response_head(self, status: int, headers) -> bytes:
+        self.status = status
+        try:
+            phrase = HTTPStatus(status).phrase
+        except ValueError:
+            phrase = ''
+        lines = ['HTTP/1.1 %d %s' % (status, phrase),
+                 'Server: %s' % _SERVER_HEADER,
+                 'Date: %s' % formatdate(usegmt=True)]
+        for name, value in headers:
+            lines.append('%s: %s' % (name, value))
+            if name.lower() == 'connection':
+                self.close_connection = value.lower() == 'close'
+        return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+
+    async def _write(self, data: bytes):
+        self.writer.write(data)
+        await self.writer.drain()
+
+    async def _send_simple(self, status: int, body: bytes):
+        await self._write(self._response_head(status, [('Content-Length', str(len(body)))]) + body)
+
+    async def _send_json(self, status: int, obj):
+        out = json.dumps(obj).encode('utf-8')
+        await self._write(self._response_head(status, [
+            ('Content-Type', 'application/json'), ('Content-Length', str(len(out)))]) + out)
+
+    async def _send_companion_chunk(self, companion_text: str, first: bool = True) -> bool:
+        s_chunk = companion_chunk(companion_text, first)
+        try:
+            await self._write(s_chunk)
+            logger.debug('WROTE companion chunk to client (len=%d)', len(s_chunk))
+            return True
+        except Exception as e:
+            logger.exception('Failed to send companion chunk: %s', e)
+            return False
+
+    async def _relay_companion(self, companion: Optional[CompanionStream], offset: int, deadline: Deadline) -> int:
+        """Send companion text past offset as it arrives; returns the new offset.
+
+        Waits for companion output to start until the request's wait deadline,
+        but once it has started relays it to the end (bounded by the hard
+        deadline) instead of cutting the answer off mid-sentence.
+        """
+        if companion is None:
+            return offset
+        while True:
+            budget = deadline.hard_remaining() if offset else deadline.wait_remaining()
+            start = time.perf_counter()
+            text, done = await companion.aread(offset, budget)
+            self.companion_wait += time.perf_counter() - start
+            if text:
+                if offset == 0:
+                    logger.debug('Sending companion chunk')
+                    self.trace.mark('companion_output_start')
+                if not await self._send_companion_chunk(text, first=offset == 0):
+                    return offset
+                offset += len(text)
+            if done or not text:
+                return offset
+
+    async def _await_companion(self, companion: Optional[CompanionStream], timeout: float) -> Optional[str]:
+        start = time.perf_counter()
+        try:
+            return await _wait_companion(companion, timeout)
+        finally:
+            self.companion_wait += time.perf_counter() - start
+            self.trace.mark('companion_wait_end')
+
+    async def _read_json_body(self):
+        length = int(self.headers.get('Content-Length', 0))
+        if length == 0:
+            return None
+        raw = await self.reader.readexactly(length)
+        try:
+            return json.loads(raw.decode('utf-8'))
+        except Exception:
+            logger.exception('Failed to parse JSON body')
+            return None
+
+    # -- Routes --------------------------------------------------------
+
+    async def do_GET(self):
+        parsed = urlparse(self.path)
+        if parsed.path == '/stats':
+            await self._send_json(200, get_stats())
+            return
+        if parsed.path == '/metrics':
+            out = render_metrics()
+            await self._write(self._response_head(200, [
+                ('Content-Type', METRICS_CONTENT_TYPE), ('Content-Length', str(len(out)))]) + out)
+            return
+        if parsed.path == '/traces':
+            # Timelines reveal request timing and models; only serve them to local clients
+            peer = self.writer.get_extra_info('peername')
+            if not peer or peer[0] not in ('127.0.0.1', '::1'):
+                await self._send_json(403, {'error': 'traces are only available locally'})
+                return
+            query = parse_qs(parsed.query)
+            try:
+                limit = trace_limit(query)
+            except ValueError:
+                await self._send_json(400, {'error': 'limit must be a non-negative integer'})
+                return
+            await self._send_json(200, recent_traces(slow=query.get('slow', ['0'])[0] == '1', limit=limit))
+            return
+        await self._send_simple(404, b'Not Found')
+
+    async def do_POST(self):
+        parsed = urlparse(self.path)
+        if parsed.path != '/v1/chat/completions':
+            await self._send_simple(404, b'Not Found')
+            return
+
+        self.trace = start_trace(engine='asyncio')
+        token = bind_trace(self.trace, 'main')
+        # Replay timings, kept only when this request is captured
+        self.capture = capture_enabled()
+        self.arrived, self.started = time.time(), time.perf_counter()
+        self.chunk_times = [] if self.capture else None
+        self.req_json = None
+        self.status = None
+        self.companion_mark = None
+        self.companion_wait = 0.0
+        self._watch_task = None
+        self.client_gone = False
+        self.companion = None
+        self.deadline = None
+        self.upstream_resp = None
+        self.main_sub = None
+        try:
+            outcome = await request_limiter.aacquire(settings.REQUEST_QUEUE_TIMEOUT)
+            if outcome != ADMITTED:
+                await self._reject(outcome)
+                return
+            self.trace.mark('admitted')
+            try:
+                await self._chat_completions()
+            finally:
+                request_limiter.release()
+        finally:
+            self._stop_watching()
+            unbind_trace(token)
+            finish_trace(self.trace)
+            if self.capture and self.req_json is not None:
+                capture_request(self.req_json, self.headers.get('Authorization'), 'asyncio', self.arrived,
+                                self.started, self.status, self.chunk_times, self.companion_mark,
+                                self.companion_wait, self.trace)
+
+    async def _reject(self, outcome: str):
+        record_rejection(outcome)
+        self.trace.mark(outcome)
+        await self.reader.readexactly(int(self.headers.get('Content-Length', 0)))
+        status, body = overload_response(outcome)
+        out = json.dumps(body).encode('utf-8')
+        await self._write(self._response_head(status, [
+            ('Content-Type', 'application/json'), ('Content-Length', str(len(out))),
+            ('Retry-After', str(settings.OVERLOAD_RETRY_AFTER))]) + out)
+        logger.warning('Rejected request: %s', outcome)
+
+    def _stop_watching(self):
+        # Called before the last bytes of a response: a client closing after them is not a disconnect
+        if self._watch_task is not None:
+            self._watch_task.cancel()
+            self._watch_task = None
+
+    async def _watch_disconnect(self):
+        """Poll for the client connection failing while the request is busy upstream or waiting.
+
+        EOF alone does not count: a client may half-close after sending its
+        body and still read the response. A reset or a failed write closes
+        the transport.
+        """
+        while not self.writer.is_closing():
+            await asyncio.sleep(settings.DISCONNECT_POLL_INTERVAL)
+        self._watch_task = None
+        self._on_client_gone()
+
+    def _on_client_gone(self):
+        self.client_gone = True
+        main_aborted = self.upstream_resp is not None
+        if main_aborted:
+            # Closing the connection ends the pending read and stops the upstream stream
+            self.upstream_resp.close()
+        if self.main_sub is not None:
+            # Stops a shared main stream only if this was the last request relaying it
+            main_aborted = self.main_sub.leave() or main_aborted
+        budget = self.deadline.hard_remaining() if self.deadline is not None else 0.0
+        companion_cancelled = release_companion(self.companion, client_gone=True)
+        record_disconnect(main_aborted, companion_cancelled, budget)
+        self.trace.mark('client_disconnected')
+        logger.info('Client disconnected mid-request; cancelled upstream stream: %s, companion call: %s',
+                    main_aborted, companion_cancelled)
+
+    async def _chat_completions(self):
+        trace = self.trace
+        req_json = await self._read_json_body()
+        trace.mark('body_read')
+        if req_json is None:
+            await self._send_simple(400, b'Bad Request')
+            return
+
+        if settings.DISCONNECT_POLL_INTERVAL > 0:
+            self._watch_task = asyncio.ensure_future(self._watch_disconnect())
+
+        strip_companion_history(req_json)
+        self.req_json = req_json
+
+        logger.info('Incoming request for chat.completions')
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('Incoming headers: %s', mask_headers(self.headers))
+
+        stream = bool(req_json.get('stream', False))
+        logger.debug('Stream flag: %s', stream)
+        requests_total.labels('stream' if stream else 'json').inc()
+        trace.set('stream', stream)
+        if 'model' in req_json:
+            logger.debug('Model used for request: %s', req_json['model'])
+
+        sock = self.writer.get_extra_info('socket')
+        if sock is not None:
+            try:
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            except Exception:
+                logger.exception('Failed to set TCP_NODELAY on client socket')
+
+        # Start companion processing as a task on this loop
+        user_text = ''
+        try:
+            user_text = extract_last_user_message(req_json.get('messages') or [])
+        except Exception:
+            logger.exception('Failed to extract last user message')
+            user_text = ''
+        trace.mark('user_message_extracted')
+
+        model = req_json.get('model', 'openai/gpt-4o')
+        trace.set('model', model)
+        deadline = self.deadline = companion_deadline(model)
+        flight_key = None
+        if settings.COALESCE_COMPANIONS or settings.COALESCE_MAIN_STREAMS:
+            flight_key = request_key(req_json, self.headers.get('Authorization'))
+        companion = None
+        if user_text:
+            logger.debug('Starting companion processing task')
+            companion = self.companion = start_companion_task(
+                user_text, self.headers.get('Authorization'), model, deadline, trace,
+                flight_key if settings.COALESCE_COMPANIONS else None)
+            self.companion_mark = companion_trace_mark(companion)
+            trace.mark(self.companion_mark)
+
+        main_headers = build_upstream_headers(self.headers)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('Forwarding headers to upstream: %s', mask_headers(main_headers))
+        main_url = settings.API_BASE + '/v1/chat/completions'
+        body = json.dumps(req_json).encode('utf-8')
+
+        self.companion_wait = 0.0  # seconds this response spent blocked on the companion
+        self.relayed_bytes = 0
+        self.streaming = False
+        try:
+            if stream and settings.COALESCE_MAIN_STREAMS:
+                self.main_sub = join_main_stream(flight_key)
+                if not self.main_sub.leader:
+                    if await self.main_sub.await_started(60):
+                        trace.mark('main_stream_joined')
+                        await self._relay_sse(self.main_sub.achunks(), companion, deadline)
+                        return
+                    # The identical request did not stream: send this one upstream itself
+                    self.main_sub.fall_back()
+                    self.main_sub = None
+
+            client = get_async_upstream_client()
+            start = time.perf_counter()
+            resp = await client.post(main_url, main_headers, body, timeout=60)
+            upstream_ttfb_seconds.labels('main').observe(time.perf_counter() - start)
+            trace.mark('upstream_headers')
+            if self.client_gone:
+                resp.close()
+                return
+            self.upstream_resp = resp
+            try:
+                if stream:
+                    await self._relay_stream(resp, companion, deadline)
+                else:
+                    await self._relay_json(resp, companion, deadline)
+            finally:
+                # A shared stream is closed by its flight
+                if self.upstream_resp is resp:
+                    resp.close()
+                self.upstream_resp = None
+        except (UpstreamHTTPError, OSError, asyncio.TimeoutError, _UpstreamStatusError) as e:
+            if self.client_gone:
+                return
+            trace.set('error', type(e).__name__)
+            logger.exception('Request to main provider failed: %s', e)
+            await self._send_simple(502, b'Main provider error')
+        except Exception as e:
+            if self.client_gone:
+                return
+            trace.set('error', type(e).__name__)
+            logger.exception('Unexpected server error: %s', e)
+            await self._send_simple(500, b'Internal Server Error')
+        finally:
+            release_companion(companion, client_gone=self.client_gone)
+            if self.main_sub is not None:
+                self.main_sub.leave()
+            if self.streaming:
+                active_streams.dec()
+                relayed_bytes_total.inc(self.relayed_bytes)
+            if companion is not None:
+                companion_wait_seconds.observe(self.companion_wait)
+
+    async def _relay_json(self, resp, companion: Optional[CompanionStream], deadline: Deadline):
+        raw = await resp.read()
+        if resp.status_code >= 400:
+            logger.error('Main provider returned HTTP %s: %s', resp.status_code, raw.decode('utf-8', errors='replace'))
+            raise _UpstreamStatusError(resp.status_code)
+        data = json.loads(raw.decode('utf-8'))
+        main_text = extract_text_from_response_json(data) or ''
+
+        # Wait for the companion until the request's wait deadline
+        companion_text = await self._await_companion(companion, deadline.wait_remaining())
+        self._stop_watching()
+        await self._send_json(200, merge_companion_text(data, main_text, companion_text))
+
+    async def _relay_stream(self, resp, companion: Optional[CompanionStream], deadline: Deadline):
+        ctype = (resp.headers.get('content-type') or '').lower()
+        logger.debug('Upstream responded: status=%s content-type=%s', resp.status_code, ctype)
+        if resp.status_code != 200 or 'application/json' in ctype:
+            if self.main_sub is not None:
+                # Identical requests waiting on this one send their own
+                self.main_sub.leave()
+            # Upstream returned a non-streaming JSON payload: handle it like the non-streaming path
+            raw = await resp.read()
+            if resp.status_code != 200:
+                logger.error('Upstream returned HTTP %s during streaming: %s', resp.status_code, raw.decode('utf-8', errors='replace'))
+            try:
+                data = json.loads(raw.decode('utf-8'))
+            except Exception:
+                logger.exception('Failed to parse upstream JSON while falling back to non-streaming')
+                if resp.status_code >= 400:
+                    raise _UpstreamStatusError(resp.status_code)
+                raise
+            # If upstream returned an error, return it directly without companion processing
+            if resp.status_code >= 400:
+                await self._send_json(resp.status_code, data)
+                return
+            main_text = extract_text_from_response_json(data) or ''
+            companion_text = await self._await_companion(companion, deadline.wait_remaining())
+            self._stop_watching()
+            await self._send_json(200, merge_companion_text(data, main_text, companion_text))
+            return
+
+        logger.debug('Main provider responded with status %s', resp.status_code)
+        chunks = resp.iter_chunks()
+        if self.main_sub is not None and not self.client_gone and self.main_sub.flight.start(
+                chunks, resp.close, resp.close):
+            # The flight closes the stream once no identical request is reading it
+            self.upstream_resp = None
+            chunks = self.main_sub.achunks()
+        await self._relay_sse(chunks, companion, deadline)
+
+    async def _relay_sse(self, chunks, companion: Optional[CompanionStream], deadline: Deadline):
+        """Relay the main stream's SSE chunks to the client, with companion output before finish_reason."""
+        await self._write(self._response_head(200, [
+            ('Content-Type', 'text/event-stream'), ('Cache-Control', 'no-cache'), ('Connection', 'keep-alive')]))
+        self.streaming = True
+        active_streams.inc()
+        stream_start = time.perf_counter()
+        try:
+            await self._write(INITIAL_ROLE_CHUNK)
+            logger.debug('WROTE initial assistant role chunk')
+        except Exception:
+            logger.exception('Failed to write initial role chunk')
+
+        companion_offset = 0
+        first_chunk = True
+        chunk_times = self.chunk_times
+        try:
+            # Forward upstream bytes as they arrive; only finish_reason and [DONE] are handled
+            async for kind, out in aiter_relay_segments(chunks, settings.STREAM_RELAY_MODE):
+                if chunk_times is not None:
+                    chunk_times.append(time.perf_counter())
+                if first_chunk:
+                    self.trace.mark('upstream_first_chunk')
+                    first_chunk = False
+                if kind == RELAY_DONE:
+                    self.trace.mark('upstream_done')
+                    companion_offset = await self._relay_companion(companion, companion_offset, deadline)
+                    self._stop_watching()
+                    try:
+                        await self._write(out)
+                        self.relayed_bytes += len(out)
+                        logger.debug('WROTE DONE chunk to client (len=%d)', len(out))
+                    except (BrokenPipeError, ConnectionResetError):
+                        logger.info('Client disconnected before DONE')
+                        return
+                    break
+
+                if kind == RELAY_FINISH:
+                    # Hold the finish_reason chunk while companion content streams out
+                    self.trace.mark('finish_reason_held')
+                    companion_offset = await self._relay_companion(companion, companion_offset, deadline)
+                    self.trace.mark('finish_reason_sent')
+                try:
+                    await self._write(out)
+                    self.relayed_bytes += len(out)
+                    logger.debug('WROTE chunk to client (len=%d)', len(out))
+                except (BrokenPipeError, ConnectionResetError):
+                    logger.warning('Client disconnected while streaming')
+                    return
+        except (BrokenPipeError, ConnectionResetError):
+            logger.warning('Client disconnected while streaming')
+            return
+        except Exception:
+            if not self.client_gone:
+                logger.exception('Error reading from upstream stream')
+        # Relay time excluding the time the finish_reason chunk was held for the companion
+        main_stream_seconds.observe(time.perf_counter() - stream_start - self.companion_wait)
+        self.trace.mark('main_stream_end')
+        if self.client_gone:
+            return
+
+        logger.debug('About to wait for companion result')
+        companion_offset = await self._relay_companion(companion, companion_offset, deadline)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('Companion result: %r', await _wait_companion(companion, 0))
+
+        self._stop_watching()
+        try:
+            await self._write(DONE_CHUNK)
+        except (BrokenPipeError, ConnectionResetError):
+            logger.info('Client disconnected after DONE')
+
+
+_active_handlers = set()
+
+
+async def _client_connected(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    task = asyncio.current_task()
+    _active_handlers.add(task)
+    try:
+        await AsyncProxyHandler(reader, writer).handle()
+    finally:
+        _active_handlers.discard(task)
+
+
+async def serve(host: str, port: int, reuse_port: bool = False):
+    warm_companion_cache()
+    server = await asyncio.start_server(_client_connected, host, port, limit=_MAX_HEADER_BYTES, backlog=1024,
+                                        reuse_port=reuse_port or None)
+    stop = asyncio.Event()
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stop.set)
+    async with server:
+        await stop.wait()
+        # Stop accepting, then let in-flight streams finish
+        server.close()
+        if _active_handlers:
+            _, pending = await asyncio.wait(set(_active_handlers), timeout=settings.DRAIN_TIMEOUT)
+            if pending:
+                logger.warning('Drain timed out after %ss with %d connections still open', settings.DRAIN_TIMEOUT, len(pending))
+    logger.info('Server stopped')
+
+
+def run_async_server(host: str = '0.0.0.0', port: int = None, reuse_port: bool = False):
+    port = port or int(settings.PROXY_PORT)
+    logger.info('Starting LiteLLM Splitter Proxy (asyncio engine) on %s:%s', host, port)
+    try:
+        asyncio.run(serve(host, port, reuse_port))
+    except KeyboardInterrupt:
+        logger.info('Shutting down server')
@@ -0,0 +1,256 @@
+import asyncio
+import collections
+import json
+import logging
+import ssl
+import time
+import weakref
+from typing import AsyncIterator, Dict, Optional, Tuple
+from urllib.parse import urlparse
+
+from config import settings
+from .metrics import upstream_connect_seconds
+from .tracing import record_current_span
+
+logger = logging.getLogger(__name__)
+
+_DEFAULT_PORTS = {'http': 80, 'https': 443}
+_READ_SIZE = 64 * 1024
+
+
+class UpstreamHTTPError(Exception):
+    """Raised when the upstream connection fails or sends a malformed response."""
+
+
+class _Connection:
+    __slots__ = ('key', 'reader', 'writer', 'last_used')
+
+    def __init__(self, key, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.key = key
+        self.reader = reader
+        self.writer = writer
+        self.last_used = time.monotonic()
+
+    def is_dropped(self) -> bool:
+        return self.reader.at_eof() or self.writer.is_closing()
+
+    def close(self):
+        try:
+            self.writer.close()
+        except Exception:
+            pass
+
+
+class AsyncResponse:
+    """Response from AsyncUpstreamClient; the body may be read once, whole or incrementally."""
+
+    def __init__(self, client: 'AsyncUpstreamClient', conn: _Connection, status: int, headers: Dict[str, str],
+                 read_timeout: float):
+        self._client = client
+        self._conn = conn
+        self.status_code = status
+        self.headers = headers  # lower-case keys
+        self._read_timeout = read_timeout
+        self._consumed = False
+        self._reusable = headers.get('connection', '').lower() != 'close'
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        self.close()
+
+    async def _read(self, coro):
+        return await asyncio.wait_for(coro, self._read_timeout)
+
+    async def iter_chunks(self) -> AsyncIterator[bytes]:
+        """Yield body bytes as they arrive from the socket."""
+        reader = self._conn.reader
+        if self.headers.get('transfer-encoding', '').lower() == 'chunked':
+            while True:
+                size_line = await self._read(reader.readline())
+                try:
+                    size = int(size_line.split(b';', 1)[0].strip(), 16)
+                except ValueError:
+                    raise UpstreamHTTPError('Malformed chunk size: %r' % size_line)
+                if size == 0:
+                    # Skip trailers up to the terminating blank line
+                    while (await self._read(reader.readline())) not in (b'\r\n', b'\n', b''):
+                        pass
+                    break
+                data = await self._read(reader.readexactly(size + 2))
+                yield data[:-2]
+        elif 'content-length' in self.headers:
+            remaining = int(self.headers['content-length'])
+            while remaining > 0:
+                data = await self._read(reader.read(min(remaining, _READ_SIZE)))
+                if not data:
+                    raise UpstreamHTTPError('Upstream closed connection mid-body')
+                remaining -= len(data)
+                yield data
+        else:
+            # Body delimited by connection close
+            self._reusable = False
+            while True:
+                data = await self._read(reader.read(_READ_SIZE))
+                if not data:
+                    break
+                yield data
+        self._consumed = True
+
+    async def read(self) -> bytes:
+        parts = []
+        async for chunk in self.iter_chunks():
+            parts.append(chunk)
+        return b''.join(parts)
+
+    async def json(self):
+        return json.loads((await self.read()).decode('utf-8'))
+
+    def close(self):
+        """Return the connection to the pool if the body was fully read, otherwise close it."""
+        conn, self._conn = self._conn, None
+        if conn is None:
+            return
+        if self._consumed and self._reusable:
+            self._client._release(conn)
+        else:
+            conn.close()
+
+
+class AsyncUpstreamClient:
+    """Minimal asyncio HTTP/1.1 client with a keep-alive connection pool per host.
+
+    A client is bound to the event loop it was created on; use
+    get_async_upstream_client() to obtain the one for the running loop.
+    """
+
+    def __init__(self, pool_size: int, idle_timeout: float):
+        self.pool_size = pool_size
+        self.idle_timeout = idle_timeout
+        self._idle = collections.defaultdict(collections.deque)  # key -> idle connections, most recent last
+        self._ssl_context = None
+        self._requests = 0
+        self._connections_opened = 0
+        self._dropped_connections = 0
+
+    def _ssl(self) -> ssl.SSLContext:
+        if self._ssl_context is None:
+            self._ssl_context = ssl.create_default_context()
+        return self._ssl_context
+
+    async def _acquire(self, key: Tuple[str, str, int], connect_timeout: float) -> _Connection:
+        idle = self._idle[key]
+        now = time.monotonic()
+        while idle:
+            conn = idle.pop()
+            if now - conn.last_used > self.idle_timeout or conn.is_dropped():
+                self._dropped_connections += 1
+                conn.close()
+                continue
+            return conn
+        scheme, host, port = key
+        start = time.perf_counter()
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(host, port, ssl=self._ssl() if scheme == 'https' else None,
+                                    server_hostname=host if scheme == 'https' else None,
+                                    limit=_READ_SIZE * 4),
+            connect_timeout)
+        upstream_connect_seconds.labels('async').observe(time.perf_counter() - start)
+        record_current_span('connect', start)
+        self._connections_opened += 1
+        return _Connection(key, reader, writer)
+
+    def _release(self, conn: _Connection):
+        idle = self._idle[conn.key]
+        if len(idle) >= self.pool_size or conn.is_dropped():
+            conn.close()
+            return
+        conn.last_used = time.monotonic()
+        idle.append(conn)
+
+    async def post(self, url: str, headers: Dict[str, str], body: bytes, timeout: float = 60) -> AsyncResponse:
+        """Send a POST request and return once the response headers have been read."""
+        parsed = urlparse(url)
+        port = parsed.port or _DEFAULT_PORTS[parsed.scheme]
+        key = (parsed.scheme, parsed.hostname, port)
+        path = parsed.path or '/'
+        if parsed.query:
+            path += '?' + parsed.query
+        host_header = parsed.hostname if port == _DEFAULT_PORTS[parsed.scheme] else '%s:%s' % (parsed.hostname, port)
+
+        lines = ['POST %s HTTP/1.1' % path, 'Host: %s' % host_header]
+        for name, value in headers.items():
+            if name.lower() not in ('host', 'content-length', 'connection', 'transfer-encoding'):
+                lines.append('%s: %s' % (name, value))
+        lines.append('Content-Length: %d' % len(body))
+        lines.append('Connection: keep-alive')
+        head = ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+
+        self._requests += 1
+        # A pooled connection may have been closed by the upstream while idle;
+        # retry once on a fresh connection in that case.
+        for attempt in (0, 1):
+            reused = bool(self._idle[key])
+            conn = await self._acquire(key, timeout)
+            try:
+                conn.writer.write(head + body)
+                await conn.writer.drain()
+                status_line = await asyncio.wait_for(conn.reader.readline(), timeout)
+                if not status_line:
+                    raise ConnectionResetError('Upstream closed connection')
+                parts = status_line.decode('latin-1').split(None, 2)
+                if len(parts) < 2 or not parts[0].startswith('HTTP/'):
+                    raise UpstreamHTTPError('Malformed status line: %r' % status_line)
+                status = int(parts[1])
+                resp_headers = {}
+                while True:
+                    line = await asyncio.wait_for(conn.reader.readline(), timeout)
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    resp_headers[name.strip().lower()] = value.strip()
+                return AsyncResponse(self, conn, status, resp_headers, timeout)
+            except (ConnectionError, asyncio.IncompleteReadError) as e:
+                conn.close()
+                if attempt or not reused:
+                    raise UpstreamHTTPError('Upstream connection failed: %s' % e) from e
+            except BaseException:
+                conn.close()
+                raise
+
+    def stats(self) -> dict:
+        return {
+            'requests': self._requests,
+            'hits': max(self._requests - self._connections_opened, 0),
+            'misses': self._connections_opened,
+            'pool_size': self.pool_size,
+            'idle_connections': sum(len(d) for d in self._idle.values()),
+            'dropped_connections': self._dropped_connections,
+        }
+
+
+_clients = weakref.WeakKeyDictionary()  # event loop -> AsyncUpstreamClient
+
+
+def get_async_upstream_client() -> AsyncUpstreamClient:
+    """Return the upstream client bound to the running event loop."""
+    loop = asyncio.get_running_loop()
+    client = _clients.get(loop)
+    if client is None:
+        client = AsyncUpstreamClient(pool_size=settings.UPSTREAM_POOL_SIZE,
+                                     idle_timeout=settings.UPSTREAM_IDLE_TIMEOUT)
+        _clients[loop] = client
+    return client
+
+
+def async_pool_stats() -> Optional[dict]:
+    """Aggregate pool stats over all event loops in this process."""
+    clients = list(_clients.values())
+    if not clients:
+        return None
+    total = {}
+    for client in clients:
+        for k, v in client.stats().items():
+            total[k] = v if k == 'pool_size' else total.get(k, 0) + v
+    return total
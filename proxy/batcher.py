@@ -0,0 +1,53 @@
+"""Micro-batching of independent calls that arrive close together on one event loop."""
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Hashable, List
+
+
+class MicroBatcher:
+    """Collects items per key for up to max_wait seconds or max_size items, then runs them as one batch.
+
+    run_batch(key, items) returns one result per item, in order. Submitters
+    await their own result; one that stops waiting (timeout, cancellation)
+    does not cancel the batch, which the other items still depend on. All
+    methods must be called on the same event loop.
+    """
+
+    def __init__(self, run_batch: Callable[[Hashable, List[Any]], Awaitable[List[Any]]],
+                 max_size: int, max_wait: float):
+        self.run_batch = run_batch
+        self.max_size = max_size
+        self.max_wait = max_wait
+        self._pending: Dict[Hashable, list] = {}  # key -> [(item, future)]
+        self._timers: Dict[Hashable, asyncio.TimerHandle] = {}
+
+    async def submit(self, key: Hashable, item: Any, timeout: float):
+        """Add item to the batch for key and wait up to timeout for its result (TimeoutError after)."""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        batch = self._pending.setdefault(key, [])
+        batch.append((item, future))
+        if len(batch) >= self.max_size:
+            self._flush(key)
+        elif len(batch) == 1:
+            self._timers[key] = loop.call_later(self.max_wait, self._flush, key)
+        return await asyncio.wait_for(asyncio.shield(future), timeout)
+
+    def _flush(self, key: Hashable):
+        timer = self._timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+        batch = self._pending.pop(key, None)
+        if batch:
+            asyncio.ensure_future(self._run(key, batch))
+
+    async def _run(self, key: Hashable, batch: list):
+        try:
+            results = await self.run_batch(key, [item for item, _ in batch])
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
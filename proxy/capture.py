@@ -0,0 +1,151 @@
+"""Opt-in traffic capture for offline replay (benchmarks/replay.py).
+
+With CAPTURE_FILE set, each chat completion request is appended to that file
+as one JSON line: its body as forwarded upstream, its arrival time, the
+relay timings of the main stream's chunks and the companion timings from the
+request's trace. Records are sanitized: the Authorization header is only
+kept as a short hash, so replays can tell callers apart without holding
+their keys, and the body's end-user fields are dropped. A background thread
+writes them, rotating the file at CAPTURE_MAX_BYTES; when its queue is full
+records are dropped rather than slowing down requests.
+"""
+import hashlib
+import json
+import logging
+import os
+import queue
+import random
+import threading
+import time
+from typing import Optional
+
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+# Body fields that identify the end user rather than shape the workload
+_DROPPED_FIELDS = ('user', 'metadata')
+
+# Trace marks kept with each record, as milliseconds from the request start
+_TIMING_MARKS = ('admitted', 'upstream_headers', 'upstream_response', 'upstream_first_chunk', 'upstream_done',
+                 'main_stream_end', 'companion_first_delta', 'companion_call_end', 'companion_output_start')
+
+
+def auth_id(auth_header: Optional[str]) -> Optional[str]:
+    """Short stable stand-in for an Authorization header."""
+    if not auth_header:
+        return None
+    return hashlib.sha256(auth_header.encode('utf-8')).hexdigest()[:12]
+
+
+class JsonlWriter:
+    """Appends JSON lines to path from a background thread, rotating at max_bytes (0 = never) with backups old files."""
+
+    def __init__(self, path: str, max_bytes: int, backups: int, queue_size: int):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self._queue = queue.Queue(queue_size)
+        self._thread = None
+        self._lock = threading.Lock()
+        self.written = 0
+        self.dropped = 0
+
+    def write(self, record: dict):
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name='jsonl-writer', daemon=True)
+                    self._thread.start()
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def _rotate(self):
+        for i in range(self.backups - 1, 0, -1):
+            src = '%s.%d' % (self.path, i)
+            if os.path.exists(src):
+                os.replace(src, '%s.%d' % (self.path, i + 1))
+        if self.backups > 0:
+            os.replace(self.path, self.path + '.1')
+        else:
+            os.remove(self.path)
+
+    def _run(self):
+        f = None
+        while True:
+            record = self._queue.get()
+            try:
+                line = (json.dumps(record, ensure_ascii=False) + '\n').encode('utf-8')
+                if f is None:
+                    f = open(self.path, 'ab')
+                if self.max_bytes and f.tell() and f.tell() + len(line) > self.max_bytes:
+                    f.close()
+                    f = None
+                    self._rotate()
+                    f = open(self.path, 'ab')
+                f.write(line)
+                # Flush per record: a replay or a tail may read the file while the proxy runs
+                f.flush()
+                self.written += 1
+            except Exception:
+                logger.exception('Failed to write JSONL record to %s', self.path)
+                if f is not None:
+                    f.close()
+                    f = None
+
+    def stats(self) -> dict:
+        return {'file': self.path, 'written': self.written, 'dropped': self.dropped, 'queued': self._queue.qsize()}
+
+
+def _new_writer(path: str) -> Optional[JsonlWriter]:
+    if not path:
+        return None
+    return JsonlWriter(path, settings.CAPTURE_MAX_BYTES, settings.CAPTURE_BACKUPS, settings.CAPTURE_QUEUE_SIZE)
+
+
+capture_writer = _new_writer(settings.CAPTURE_FILE)
+
+
+def capture_enabled() -> bool:
+    """Whether to capture the request starting now (CAPTURE_FILE set, sampled at CAPTURE_SAMPLE)."""
+    return capture_writer is not None and (settings.CAPTURE_SAMPLE >= 1 or random.random() < settings.CAPTURE_SAMPLE)
+
+
+def capture_request(req_json: dict, auth_header: Optional[str], engine: str, arrived: float, start: float,
+                    status: Optional[int], chunk_times: list, companion_mark: Optional[str], companion_wait: float,
+                    trace):
+    """Queue the capture record of a finished request; times are perf_counter() values, arrived is wall time."""
+    body = {k: v for k, v in req_json.items() if k not in _DROPPED_FIELDS}
+    marks = {}
+    for name, at in sorted(getattr(trace, 'marks', ()), key=lambda m: m[1]):
+        if name in _TIMING_MARKS and name not in marks:
+            marks[name] = round(at * 1000, 1)
+    capture_writer.write({
+        'ts': round(arrived, 3),
+        'engine': engine,
+        'auth_id': auth_id(auth_header),
+        'body': body,
+        'status': status,
+        'duration_ms': round((time.perf_counter() - start) * 1000, 1),
+        'chunk_ms': [round((t - start) * 1000, 1) for t in chunk_times],
+        'marks': marks,
+        'companion': {'mark': companion_mark, 'wait_ms': round(companion_wait * 1000, 1)},
+    })
+
+
+def capture_stats() -> Optional[dict]:
+    return capture_writer.stats() if capture_writer is not None else None
+
+
+def _reset_after_fork():
+    # Workers write files of their own: capture.jsonl becomes capture.<pid>.jsonl
+    global capture_writer
+    if capture_writer is None:
+        return
+    root, ext = os.path.splitext(settings.CAPTURE_FILE)
+    capture_writer = _new_writer('%s.%d%s' % (root, os.getpid(), ext))
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
@@ -0,0 +1,218 @@
+"""Protocol helpers shared by the threaded and asyncio server engines."""
+import json
+import logging
+from typing import Any, AsyncIterator, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from .sse import SSEEvent, SSEParser, SSESplitter, event_bounds
+
+logger = logging.getLogger(__name__)
+
+COMPANION_SEPARATOR = '\n⸻✎⸻\n'
+
+# Sent before any upstream event so clients start rendering incremental content
+INITIAL_ROLE_CHUNK = ('data: ' + json.dumps({'choices': [{'delta': {'role': 'assistant'}}]}) + '\n\n').encode('utf-8')
+
+DONE_CHUNK = b'data: [DONE]\n\n'
+
+
+def strip_companion_history(req_json: Dict[str, Any]):
+    """Strip companion responses from conversation history so the main model
+    doesn't see (and mimic) prior grammar-check outputs."""
+    for msg in req_json.get('messages') or []:
+        if msg.get('role') == 'assistant' and isinstance(msg.get('content'), str):
+            sep_idx = msg['content'].find(COMPANION_SEPARATOR)
+            if sep_idx != -1:
+                msg['content'] = msg['content'][:sep_idx]
+
+
+def mask_headers(headers) -> Dict[str, str]:
+    """Return a copy of headers that is safe to log."""
+    headers_copy = dict(headers)
+    if 'Authorization' in headers_copy:
+        headers_copy['Authorization'] = headers_copy['Authorization'][:20] + '...' if len(headers_copy['Authorization']) > 20 else '***masked***'
+    return headers_copy
+
+
+def build_upstream_headers(headers) -> Dict[str, str]:
+    """Build headers to forward to upstream: preserve useful client headers but override content-type."""
+    main_headers = {}
+    for h in ('Accept', 'User-Agent', 'Connection', 'Authorization'):
+        v = headers.get(h)
+        if v:
+            main_headers[h] = v
+    # Force no compression so clients can stream incrementally
+    main_headers['Accept-Encoding'] = 'identity'
+    # Ensure JSON content-type
+    main_headers['Content-Type'] = 'application/json'
+    return main_headers
+
+
+def extract_text_from_response_json(data: dict) -> Optional[str]:
+    """Extract text content from OpenAI/OpenRouter response format."""
+    try:
+        if 'choices' in data and data['choices']:
+            choice = data['choices'][0]
+            if 'message' in choice and isinstance(choice['message'], dict):
+                return choice['message'].get('content')
+            if 'text' in choice:
+                return choice['text']
+        return data.get('text')
+    except Exception:
+        logger.exception('Error extracting text from response')
+    return None
+
+
+def merge_companion_text(data: dict, main_text: str, companion_text: Optional[str]) -> dict:
+    """Replace the message content of a non-streaming response with main + companion text."""
+    if companion_text:
+        combined = main_text + COMPANION_SEPARATOR + companion_text
+    else:
+        combined = main_text
+
+    # Try to preserve original response structure but replace the message content
+    if 'choices' in data and data['choices']:
+        first = data['choices'][0]
+        if 'message' in first and isinstance(first['message'], dict):
+            first['message']['content'] = combined
+        elif 'text' in first:
+            first['text'] = combined
+        else:
+            # fallback: add message
+            first['message'] = {'role': 'assistant', 'content': combined}
+        data['choices'][0] = first
+    else:
+        data['choices'] = [{'message': {'role': 'assistant', 'content': combined}}]
+    return data
+
+
+def companion_chunk(companion_text: str, first: bool = True) -> bytes:
+    """Build a synthetic SSE chunk carrying companion output; the first one opens with the separator."""
+    appended = COMPANION_SEPARATOR + companion_text if first else companion_text
+    synthetic = {'choices': [{'delta': {'content': appended}}]}
+    return ('data: ' + json.dumps(synthetic) + '\n\n').encode('utf-8')
+
+
+def is_finish_reason_event(event: SSEEvent) -> bool:
+    try:
+        obj = json.loads(event.data)
+        if 'choices' in obj and obj['choices']:
+            return bool(obj['choices'][0].get('finish_reason'))
+    except Exception:
+        pass
+    return False
+
+
+# Kinds of segment handed to the stream relay loop
+RELAY_PASS = 0  # forward unchanged
+RELAY_FINISH = 1  # the finish_reason event; companion output goes out before it
+RELAY_DONE = 2  # the [DONE] event
+
+_FINISH_KEY = b'"finish_reason"'
+_NOT_FINISHED = (b'null', b'""')
+
+
+class PassthroughScanner:
+    """Splits upstream SSE bytes into runs to forward unchanged and the events the relay handles.
+
+    Only the finish_reason and [DONE] events need handling. They are found
+    with bytes.find on marker strings and confirmed by parsing just that
+    event, so ordinary content deltas are never decoded or parsed. An
+    unescaped '"finish_reason"' can only be a JSON key, never part of a
+    content string.
+    """
+
+    def __init__(self):
+        self._splitter = SSESplitter()
+
+    def feed(self, chunk: bytes) -> List[Tuple[int, memoryview]]:
+        data, end = self._splitter.feed(chunk)
+        return self._segments(data, end)
+
+    def flush(self) -> List[Tuple[int, memoryview]]:
+        rest = self._splitter.flush()
+        return self._segments(rest, len(rest))
+
+    def _segments(self, data: bytes, end: int) -> List[Tuple[int, memoryview]]:
+        if not end:
+            return []
+        view = memoryview(data)
+        special = self._special_events(data, end)
+        if not special:
+            return [(RELAY_PASS, view[:end])]
+        out = []
+        pos = 0
+        for start, stop, kind in special:
+            if start > pos:
+                out.append((RELAY_PASS, view[pos:start]))
+            out.append((kind, view[start:stop]))
+            pos = stop
+        if pos < end:
+            out.append((RELAY_PASS, view[pos:end]))
+        return out
+
+    def _special_events(self, data: bytes, end: int) -> List[Tuple[int, int, int]]:
+        found = {}
+        i = data.find(_FINISH_KEY, 0, end)
+        while i != -1:
+            value = data[i + len(_FINISH_KEY):i + len(_FINISH_KEY) + 16].lstrip(b': \t')
+            if not value.startswith(_NOT_FINISHED):
+                start, stop = event_bounds(data, i, end)
+                if start not in found and is_finish_reason_event(SSEEvent(data[start:stop].rstrip(b'\r\n'))):
+                    found[start] = (start, stop, RELAY_FINISH)
+            i = data.find(_FINISH_KEY, i + 1, end)
+        i = data.find(b'[DONE]', 0, end)
+        while i != -1:
+            start, stop = event_bounds(data, i, end)
+            if SSEEvent(data[start:stop].rstrip(b'\r\n')).is_done:
+                found[start] = (start, stop, RELAY_DONE)
+            i = data.find(b'[DONE]', i + 1, end)
+        return [found[k] for k in sorted(found)]
+
+
+class EventScanner:
+    """Per-event counterpart of PassthroughScanner (STREAM_RELAY_MODE=events).
+
+    Parses every event and re-frames it as 'raw + blank line', which also
+    normalises '\\r\\n' framing to '\\n'.
+    """
+
+    def __init__(self):
+        self._parser = SSEParser()
+
+    def feed(self, chunk: bytes) -> List[Tuple[int, bytes]]:
+        return [self._segment(event) for event in self._parser.feed(chunk)]
+
+    def flush(self) -> List[Tuple[int, bytes]]:
+        return [self._segment(event) for event in self._parser.flush()]
+
+    @staticmethod
+    def _segment(event: SSEEvent) -> Tuple[int, bytes]:
+        if event.is_done:
+            kind = RELAY_DONE
+        elif is_finish_reason_event(event):
+            kind = RELAY_FINISH
+        else:
+            kind = RELAY_PASS
+        return kind, event.encode()
+
+
+def make_relay_scanner(mode: str):
+    return EventScanner() if mode == 'events' else PassthroughScanner()
+
+
+def iter_relay_segments(chunks: Iterable[bytes], mode: str) -> Iterator[Tuple[int, bytes]]:
+    """Yield (kind, bytes) segments for the relay loop from upstream body chunks."""
+    scanner = make_relay_scanner(mode)
+    for chunk in chunks:
+        yield from scanner.feed(chunk)
+    yield from scanner.flush()
+
+
+async def aiter_relay_segments(chunks: AsyncIterator[bytes], mode: str) -> AsyncIterator[Tuple[int, bytes]]:
+    """Async counterpart of iter_relay_segments."""
+    scanner = make_relay_scanner(mode)
+    async for chunk in chunks:
+        for segment in scanner.feed(chunk):
+            yield segment
+    for segment in scanner.flush():
+        yield segment
@@ -0,0 +1,180 @@
+"""Circuit breakers for companion calls, one per (API_BASE, companion model).
+
+While a companion provider is failing, rate limiting or answering slowly,
+its breaker opens and requests skip the companion call (and the wait for
+it) instead of holding responses open for a result that will not come.
+After a cooldown - at least as long as a 429's Retry-After, doubling after
+each failed probe - a single trial call is let through; its outcome closes
+the breaker or opens it again.
+"""
+import collections
+import email.utils
+import logging
+import os
+import threading
+import time
+from typing import Optional
+
+from config import settings
+from .metrics import companion_breaker_state, companion_breaker_skipped_total
+
+logger = logging.getLogger(__name__)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+_STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Seconds from a Retry-After header (delta-seconds or HTTP date), or None."""
+    if not value:
+        return None
+    value = value.strip()
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class CircuitBreaker:
+    """Error-rate breaker over the last window calls; slow calls count as failures.
+
+    allow() is called from handler threads and the event loop, the record_*
+    methods from the loop that ran the call, so state changes take a lock.
+    """
+
+    def __init__(self, name: str, window: int, min_calls: int, error_rate: float, cooldown: float,
+                 max_cooldown: float):
+        self.name = name
+        self.min_calls = min_calls
+        self.error_rate = error_rate
+        self.base_cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.state = CLOSED
+        self._outcomes = collections.deque(maxlen=window)  # True for a failed (or slow) call
+        self._cooldown = cooldown
+        self._open_until = 0.0
+        self._probe_started: Optional[float] = None
+        self._lock = threading.Lock()
+        self.opened = 0
+        self.skipped = 0
+        companion_breaker_state.labels(name).set(0)
+
+    def _set_state(self, state: str):
+        # Called with the lock held
+        if state != self.state:
+            logger.warning('Companion circuit for %s is now %s', self.name, state)
+        self.state = state
+        companion_breaker_state.labels(self.name).set(_STATE_VALUES[state])
+
+    def _open(self, cooldown: float):
+        self._open_until = time.monotonic() + min(cooldown, self.max_cooldown)
+        self._probe_started = None
+        self._outcomes.clear()
+        self.opened += 1
+        self._set_state(OPEN)
+
+    def allow(self) -> bool:
+        """Whether a companion call may start now; counts the call as skipped if not."""
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            now = time.monotonic()
+            if self.state == OPEN and now >= self._open_until:
+                self._set_state(HALF_OPEN)
+            # One trial at a time; a trial that never reported back (cancelled) expires with its timeout
+            if self.state == HALF_OPEN and (self._probe_started is None
+                                            or now - self._probe_started > settings.COMPANION_TIMEOUT):
+                self._probe_started = now
+                return True
+            self.skipped += 1
+        companion_breaker_skipped_total.labels(self.name).inc()
+        return False
+
+    def record_success(self, slow: bool = False):
+        with self._lock:
+            if self.state == HALF_OPEN and self._probe_started is not None:
+                if slow:
+                    self._cooldown = min(self._cooldown * 2, self.max_cooldown)
+                    self._open(self._cooldown)
+                else:
+                    self._cooldown = self.base_cooldown
+                    self._probe_started = None
+                    self._set_state(CLOSED)
+                return
+            self._record(slow)
+
+    def record_failure(self, retry_after: Optional[float] = None, rate_limited: bool = False):
+        """A failed call; a 429 (rate_limited) opens the breaker at once, for at least retry_after."""
+        with self._lock:
+            if self.state == HALF_OPEN and self._probe_started is not None:
+                self._cooldown = min(self._cooldown * 2, self.max_cooldown)
+                self._open(max(self._cooldown, retry_after or 0))
+                return
+            if rate_limited:
+                if self.state != OPEN:
+                    self._open(max(self._cooldown, retry_after or 0))
+                return
+            self._record(True)
+
+    def _record(self, failed: bool):
+        # Called with the lock held
+        if self.state != CLOSED:
+            return
+        self._outcomes.append(failed)
+        if len(self._outcomes) >= self.min_calls and sum(self._outcomes) >= self.error_rate * len(self._outcomes):
+            self._open(self._cooldown)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'state': self.state,
+                'recent_calls': len(self._outcomes),
+                'recent_failures': sum(self._outcomes),
+                'reopens_in': round(max(0.0, self._open_until - time.monotonic()), 1) if self.state == OPEN else 0,
+                'opened': self.opened,
+                'skipped': self.skipped,
+            }
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def companion_breaker(model: str) -> Optional[CircuitBreaker]:
+    """The breaker for companion calls to model at API_BASE, or None when COMPANION_BREAKER_MIN_CALLS is 0."""
+    if settings.COMPANION_BREAKER_MIN_CALLS <= 0:
+        return None
+    key = (settings.API_BASE, model)
+    breaker = _breakers.get(key)
+    if breaker is None:
+        with _breakers_lock:
+            breaker = _breakers.get(key)
+            if breaker is None:
+                breaker = _breakers[key] = CircuitBreaker(
+                    model, settings.COMPANION_BREAKER_WINDOW, settings.COMPANION_BREAKER_MIN_CALLS,
+                    settings.COMPANION_BREAKER_ERROR_RATE, settings.COMPANION_BREAKER_COOLDOWN,
+                    settings.COMPANION_BREAKER_MAX_COOLDOWN)
+    return breaker
+
+
+def breaker_stats() -> dict:
+    with _breakers_lock:
+        breakers = list(_breakers.values())
+    return {b.name: b.stats() for b in breakers}
+
+
+def _reset_after_fork():
+    # A worker judges the provider from its own calls
+    global _breakers_lock
+    _breakers.clear()
+    _breakers_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
@@ -1,4 +1,5 @@
-from typing import List, Dict, Any
+import json
+from typing import List, Dict, Any, Optional
 
 from config import settings
 
@@ -23,5 +24,72 @@ def extract_last_user_message(messages: List[Dict[str, Any]]) -> str:
     return ""
 
 
-def build_companion_prompt(user_text: str) -> str:
-    return settings.COMPANION_PROMPT.format(user_text=user_text)
\ No newline at end of file
+def build_companion_prompt(user_text: str, template: Optional[str] = None) -> str:
+    """template (default: COMPANION_PROMPT) with user_text filled in."""
+    return (template or settings.COMPANION_PROMPT).format(user_text=user_text)
+
+
+def _split_template(template: str):
+    """(prefix, suffix) around {user_text}; a template without it is all prefix."""
+    prefix, sep, suffix = template.partition('{user_text}')
+    if not sep:
+        return template.strip(), ''
+    return prefix.strip(), suffix.strip()
+
+
+def _layout(instructions: str, user_content: str) -> List[Dict[str, Any]]:
+    """Messages for a companion call following COMPANION_PROMPT_LAYOUT.
+
+    'split' puts the instructions, identical on every call, in a system
+    message ahead of the varying text, so providers that cache prompt
+    prefixes can reuse them; COMPANION_CACHE_HINTS marks that message with
+    cache_control for providers that only cache on request.
+    'single' sends one user message, as the prompt file reads.
+    """
+    if settings.COMPANION_CACHE_HINTS:
+        system = [{'type': 'text', 'text': instructions, 'cache_control': {'type': 'ephemeral'}}]
+    else:
+        system = instructions
+    return [{'role': 'system', 'content': system}, {'role': 'user', 'content': user_content}]
+
+
+def build_companion_messages(user_text: str, template: Optional[str] = None) -> List[Dict[str, Any]]:
+    if settings.COMPANION_PROMPT_LAYOUT != 'split':
+        return [{'role': 'user', 'content': build_companion_prompt(user_text, template)}]
+    prefix, suffix = _split_template(template or settings.COMPANION_PROMPT)
+    return _layout(prefix, user_text + ('\n\n' + suffix if suffix else ''))
+
+
+_BATCH_HEADER = ('Several independent texts follow as a JSON array. Apply the instructions below to each text '
+                 'on its own, exactly as if it were the only text. Reply with only a JSON array of strings: '
+                 'one reply per text, in the same order, each exactly what you would have replied for that text alone.')
+
+
+def _batch_instructions(template: Optional[str]) -> str:
+    instructions = build_companion_prompt('(each text of the array below)', template)
+    return '%s\n\n---\n%s\n---' % (_BATCH_HEADER, instructions)
+
+
+def build_batch_prompt(texts: List[str], template: Optional[str] = None) -> str:
+    """One companion prompt checking all texts, answered by parse_batch_answers."""
+    return '%s\n\nTexts:\n%s' % (_batch_instructions(template), json.dumps(texts, ensure_ascii=False))
+
+
+def build_batch_messages(texts: List[str], template: Optional[str] = None) -> List[Dict[str, Any]]:
+    if settings.COMPANION_PROMPT_LAYOUT != 'split':
+        return [{'role': 'user', 'content': build_batch_prompt(texts, template)}]
+    return _layout(_batch_instructions(template), 'Texts:\n' + json.dumps(texts, ensure_ascii=False))
+
+
+def parse_batch_answers(reply: str, count: int) -> Optional[List[str]]:
+    """The per-text replies in a batch reply, or None if it is not a JSON array of count strings."""
+    start, end = reply.find('['), reply.rfind(']')
+    if start < 0 or end < start:
+        return None
+    try:
+        answers = json.loads(reply[start:end + 1])
+    except ValueError:
+        return None
+    if not isinstance(answers, list) or len(answers) != count or not all(isinstance(a, str) for a in answers):
+        return None
+    return [a.strip() for a in answers]
@@ -0,0 +1,94 @@
+import collections
+import hashlib
+import threading
+import time
+from typing import Optional
+
+from config import settings
+
+# Rough per-entry bookkeeping overhead (key, OrderedDict node, tuple) counted towards max_bytes
+_ENTRY_OVERHEAD = 200
+
+
+def make_cache_key(prompt: str, model: str, temperature) -> str:
+    """Hash of everything that determines the companion output."""
+    h = hashlib.sha256()
+    for part in (prompt, model or '', str(temperature)):
+        h.update(part.encode('utf-8'))
+        h.update(b'\0')
+    return h.hexdigest()
+
+
+class CompanionCache:
+    """In-memory LRU cache of companion results bounded by entry count, bytes and TTL."""
+
+    def __init__(self, max_entries: int, max_bytes: int, ttl: float):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._entries = collections.OrderedDict()  # key -> (value, size, expires_at)
+        self._lock = threading.Lock()
+        self._bytes = 0
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._expirations = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0 and self.max_bytes > 0
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._misses += 1
+                return None
+            value, size, expires_at = entry
+            if expires_at <= time.monotonic():
+                del self._entries[key]
+                self._bytes -= size
+                self._expirations += 1
+                self._misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self._hits += 1
+            return value
+
+    def put(self, key: str, value: str):
+        if not self.enabled:
+            return
+        size = len(key) + len(value.encode('utf-8')) + _ENTRY_OVERHEAD
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old[1]
+            self._entries[key] = (value, size, time.monotonic() + self.ttl)
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                _, (_, evicted_size, _) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+                self._evictions += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self._hits,
+                'misses': self._misses,
+                'hit_rate': round(self._hits / lookups, 4) if lookups else 0.0,
+                'evictions': self._evictions,
+                'expirations': self._expirations,
+            }
+
+
+companion_cache = CompanionCache(
+    max_entries=settings.COMPANION_CACHE_SIZE,
+    max_bytes=settings.COMPANION_CACHE_MAX_BYTES,
+    ttl=settings.COMPANION_CACHE_TTL,
+)
@@ -1,49 +1,786 @@
 import asyncio
 import json
 import logging
-from typing import Optional
 import os
+import threading
+import time
+from typing import AsyncIterator, Callable, List, Optional, Tuple
 
 from config import settings
+from .async_upstream import get_async_upstream_client
+from .batcher import MicroBatcher
+from .companion_builder import (
+    build_companion_prompt, build_companion_messages, build_batch_prompt, build_batch_messages, parse_batch_answers,
+)
+from .companion_cache import companion_cache, make_cache_key
+from .companion_store import companion_store
+from .companion_stream import CompanionStream, SharedCompanion
+from .companions import COMPANIONS, COMPANION_JOINER, CompanionSpec
+from .admission import admit_companion, companion_limiter
+from .circuit_breaker import companion_breaker, parse_retry_after
+from .deadline import Deadline, LatencyTracker
+from .metrics import (
+    upstream_ttfb_seconds, companion_latency_seconds, companion_timeouts_total, companion_failures_total,
+    companion_cache_hits_total, companion_batch_size, companion_tokens_total, companion_ttfb_by_prefix_cache,
+)
+from .prefilter import RECENT_OK, prefilter, remember_result
+from .segmenter import split_segments, merge_segment_results
+from .singleflight import record_join
+from .sse import SSEEvent, aiter_sse_events
+from .tracing import NULL_TRACE, bind_trace
 
 logger = logging.getLogger(__name__)
 
-async def call_companion_model(prompt: str, auth_header: str, model: str, timeout: float = 8.0) -> Optional[str]:
-    """Call the companion model and return processed text or None on failure."""
-    def _sync_call():
-        import requests
-        url = settings.API_BASE + '/v1/chat/completions'
-        headers = {
-            'Authorization': auth_header,
-            'Content-Type': 'application/json'
-        }
-        payload = {
-            'model': model,
-            'messages': [{'role': 'user', 'content': prompt}],
-            'temperature': float(settings.COMPANION_TEMPERATURE),
-            'max_tokens': 1024,
-            'stream': False
-        }
+
+def _text_from_companion_json(data: dict) -> Optional[str]:
+    if 'choices' in data and data['choices']:
+        choice = data['choices'][0]
+        if 'message' in choice and isinstance(choice['message'], dict):
+            return choice['message'].get('content')
+        if 'text' in choice:
+            return choice['text']
+    return data.get('text') or json.dumps(data)
+
+
+def companion_max_tokens(user_text: str) -> int:
+    """Output budget for checking user_text.
+
+    A correction repeats the text (roughly len/4 tokens) plus short
+    explanations, so allow about twice the input, within configured bounds.
+    """
+    return max(settings.COMPANION_MIN_TOKENS, min(settings.COMPANION_MAX_TOKENS, len(user_text) // 2 + 64))
+
+
+class CompanionHTTPError(RuntimeError):
+    """The companion upstream answered with an error status."""
+
+    def __init__(self, status: int, body: bytes, retry_after: Optional[float] = None):
+        super().__init__('Companion upstream returned HTTP %s: %s' % (status, body[:500]))
+        self.status = status
+        self.retry_after = retry_after
+
+
+# How long a finished companion stream's tail may take before its connection is closed instead
+_TAIL_DRAIN_TIMEOUT = 2.0
+
+_call_stats = {'calls': 0, 'streamed': 0, 'ok_early_exits': 0, 'failures': 0, 'late_cached': 0, 'late_cancelled': 0}
+
+
+def call_stats() -> dict:
+    return dict(_call_stats)
+
+
+# Time from request start to companion result, per companion and model, for sizing wait budgets
+companion_latency = LatencyTracker(settings.COMPANION_LATENCY_WINDOW)
+
+
+def _wait_budget(spec: CompanionSpec, model: str) -> float:
+    """How long to wait for spec's output on model, following COMPANION_WAIT_POLICY.
+
+    'adaptive' waits up to the recent COMPANION_WAIT_PERCENTILE latency
+    times COMPANION_WAIT_MARGIN (clamped to COMPANION_WAIT_MIN..MAX, MAX
+    until there is history); 'fixed' always waits COMPANION_WAIT_MAX; 'none'
+    only includes companion output that is ready when the main answer is.
+    Never longer than the companion's own timeout.
+    """
+    policy = settings.COMPANION_WAIT_POLICY
+    if policy == 'none':
+        return 0.0
+    wait = settings.COMPANION_WAIT_MAX
+    if policy != 'fixed':
+        observed = companion_latency.percentile(spec.latency_key(model), settings.COMPANION_WAIT_PERCENTILE)
+        if observed is not None:
+            wait = min(wait, max(settings.COMPANION_WAIT_MIN, observed * settings.COMPANION_WAIT_MARGIN))
+    return min(wait, spec.timeout)
+
+
+def companion_deadline(model: str) -> Deadline:
+    """Deadline for a request on model: the longest wait budget and hard timeout of its companions.
+
+    Budgets count from the start of the request.
+    """
+    return Deadline(max(_wait_budget(spec, spec.model_for(model)) for spec in COMPANIONS),
+                    max(spec.timeout for spec in COMPANIONS))
+
+
+_usage_stats = {'calls_with_usage': 0, 'prompt_tokens': 0, 'cached_tokens': 0, 'completion_tokens': 0}
+
+
+def usage_stats() -> dict:
+    """Token counts reported by upstream for companion calls; cached_share is the prompt share served from cache."""
+    out = dict(_usage_stats)
+    out['cached_share'] = round(out['cached_tokens'] / out['prompt_tokens'], 3) if out['prompt_tokens'] else None
+    return out
+
+
+def _record_usage(usage: dict, ttfb: float, trace):
+    prompt = usage.get('prompt_tokens') or 0
+    # OpenAI-style prompt_tokens_details, or Anthropic-style cache_read_input_tokens
+    cached = (usage.get('prompt_tokens_details') or {}).get('cached_tokens') or usage.get('cache_read_input_tokens') or 0
+    completion = usage.get('completion_tokens') or 0
+    _usage_stats['calls_with_usage'] += 1
+    _usage_stats['prompt_tokens'] += prompt
+    _usage_stats['cached_tokens'] += cached
+    _usage_stats['completion_tokens'] += completion
+    companion_tokens_total.labels('prompt').inc(prompt)
+    companion_tokens_total.labels('cached').inc(cached)
+    companion_tokens_total.labels('completion').inc(completion)
+    companion_ttfb_by_prefix_cache.labels('hit' if cached else 'miss').observe(ttfb)
+    trace.set('companion_prompt_tokens', prompt)
+    trace.set('companion_cached_tokens', cached)
+
+
+def _parse_stream_event(data: str) -> Tuple[str, bool, Optional[dict]]:
+    """Return (delta content, whether finish_reason is set, usage if present) for one companion stream event."""
+    obj = json.loads(data)
+    content = ''
+    finished = False
+    for choice in obj.get('choices') or []:
+        content += (choice.get('delta') or {}).get('content') or ''
+        finished = finished or bool(choice.get('finish_reason'))
+    return content, finished, obj.get('usage')
+
+
+async def _read_companion_stream(events: AsyncIterator[SSEEvent], on_delta: Optional[Callable[[str], None]],
+                                 trace=NULL_TRACE,
+                                 on_usage: Optional[Callable[[dict], None]] = None,
+                                 ok_exit: bool = False) -> Tuple[str, bool]:
+    """Collect the companion answer from SSE events, passing deltas to on_delta as they arrive.
+
+    Returns (text, drain): the answer is complete at finish_reason, so we stop
+    there and leave the stream's tail to be drained off the hot path. With
+    ok_exit, an exact 'OK' (the grammar prompt's no-changes reply) followed by
+    an event without content or finish is cut short with drain=False, closing
+    the connection so the provider stops generating; any content after it,
+    whitespace included, keeps the call going. Usage reported on the events
+    read goes to on_usage.
+    """
+    parts = []
+    text = ''
+    async for event in events:
+        if event.is_done:
+            break
+        if event.data is None:
+            continue
+        try:
+            content, finished, usage = _parse_stream_event(event.data)
+        except Exception:
+            logger.debug('Skipping unparseable companion event: %r', event.data[:120])
+            continue
+        if usage and on_usage is not None:
+            on_usage(usage)
+        if ok_exit and not content and not finished and text.strip() == 'OK':
+            _call_stats['ok_early_exits'] += 1
+            return text, False
+        if content:
+            if not parts:
+                trace.mark('companion_first_delta')
+            parts.append(content)
+            text = ''.join(parts)
+            if on_delta is not None:
+                on_delta(content)
+        if finished:
+            return text, True
+    return text, True
+
+
+async def _drain_tail(resp, events: AsyncIterator[SSEEvent], on_usage: Callable[[dict], None]):
+    """Read what is left of a finished companion stream so its connection goes back to the pool.
+
+    With stream_options.include_usage the usage event comes after finish_reason, in this tail.
+    """
+    async def _consume():
+        async for event in events:
+            if event.data is not None and not event.is_done and '"usage"' in event.data:
+                try:
+                    usage = json.loads(event.data).get('usage')
+                except ValueError:
+                    continue
+                if usage:
+                    on_usage(usage)
+    try:
+        await asyncio.wait_for(_consume(), _TAIL_DRAIN_TIMEOUT)
+    except Exception:
+        pass
+    finally:
+        resp.close()
+
+
+async def call_companion_model(prompt: str, auth_header: str, model: str, timeout: Optional[float] = None,
+                               max_tokens: int = 1024,
+                               on_delta: Optional[Callable[[str], None]] = None,
+                               trace=NULL_TRACE, store: bool = True,
+                               messages: Optional[list] = None, temperature=None,
+                               ok_exit: bool = False) -> Optional[str]:
+    """Call the companion model and return processed text or None on failure.
+
+    messages defaults to prompt as a single user message; prompt is also the
+    cache key, under which the result is stored when store is set. The call
+    streams; on_delta, if given, receives each piece of text as it arrives.
+    timeout and temperature default to COMPANION_TIMEOUT and COMPANION_TEMPERATURE;
+    ok_exit ends the call at an exact 'OK' answer (see _read_companion_stream).
+    Its phases are marked on trace, its
+    token usage is recorded, and its outcome feeds the model's circuit breaker.
+    """
+    if timeout is None:
+        timeout = settings.COMPANION_TIMEOUT
+    if temperature is None:
+        temperature = settings.COMPANION_TEMPERATURE
+    url = settings.API_BASE + '/v1/chat/completions'
+    headers = {
+        'Authorization': auth_header,
+        'Content-Type': 'application/json'
+    }
+    payload = {
+        'model': model,
+        'messages': messages or [{'role': 'user', 'content': prompt}],
+        'temperature': float(temperature),
+        'max_tokens': max_tokens,
+        'stream': True
+    }
+    if settings.COMPANION_STREAM_USAGE:
+        payload['stream_options'] = {'include_usage': True}
+
+    breaker = companion_breaker(model)
+    ttfb = 0.0
+
+    def on_usage(usage: dict):
+        _record_usage(usage, ttfb, trace)
+
+    async def _call():
+        nonlocal ttfb
+        client = get_async_upstream_client()
+        start = time.perf_counter()
+        resp = await client.post(url, headers, json.dumps(payload).encode('utf-8'), timeout=timeout)
+        ttfb = time.perf_counter() - start
+        upstream_ttfb_seconds.labels('companion').observe(ttfb)
+        trace.mark('companion_headers')
+        tail = None
         try:
-            resp = requests.post(url, headers=headers, json=payload, timeout=timeout)
-            resp.raise_for_status()
-            data = resp.json()
-            if 'choices' in data and data['choices']:
-                choice = data['choices'][0]
-                if 'message' in choice and isinstance(choice['message'], dict):
-                    return choice['message'].get('content')
-                if 'text' in choice:
-                    return choice['text']
-            return data.get('text') or json.dumps(data)
-        except Exception as e:
-            logger.exception('Companion model request failed: %s', e)
-            return None
+            if resp.status_code >= 400:
+                body = await resp.read()
+                raise CompanionHTTPError(resp.status_code, body, parse_retry_after(resp.headers.get('retry-after')))
+            if 'text/event-stream' not in (resp.headers.get('content-type') or ''):
+                # Upstream ignored stream=True and sent the whole completion
+                body = await resp.read()
+                data = json.loads(body.decode('utf-8'))
+                if data.get('usage'):
+                    on_usage(data['usage'])
+                return _text_from_companion_json(data)
+            _call_stats['streamed'] += 1
+            events = aiter_sse_events(resp.iter_chunks())
+            text, drain = await _read_companion_stream(events, on_delta, trace, on_usage, ok_exit)
+            if drain:
+                tail = events
+            return text
+        finally:
+            if tail is not None:
+                asyncio.ensure_future(_drain_tail(resp, tail, on_usage))
+            else:
+                resp.close()
 
+    _call_stats['calls'] += 1
+    trace.mark('companion_call_start')
     try:
-        return await asyncio.get_event_loop().run_in_executor(None, _sync_call)
+        text = await asyncio.wait_for(_call(), timeout)
+        trace.mark('companion_call_end')
+        if breaker is not None:
+            breaker.record_success(slow=0 < settings.COMPANION_BREAKER_SLOW_SECONDS < ttfb)
+        if text is not None and store:
+            _store_result(_cache_key(prompt, model, temperature), text)
+        return text
     except asyncio.TimeoutError:
-        logger.exception('Companion processing timed out')
+        trace.mark('companion_call_timeout')
+        _call_stats['failures'] += 1
+        companion_failures_total.inc()
+        companion_timeouts_total.labels('call').inc()
+        if breaker is not None:
+            breaker.record_failure()
+        logger.warning('Companion processing timed out after %.1fs', timeout)
+        return None
+    except CompanionHTTPError as e:
+        trace.mark('companion_call_failed')
+        _call_stats['failures'] += 1
+        companion_failures_total.inc()
+        # Other 4xx answers are about this request (auth, payload), not the provider's health
+        if breaker is not None and (e.status == 429 or e.status >= 500):
+            breaker.record_failure(e.retry_after, rate_limited=e.status == 429)
+        logger.warning('%s', e)
         return None
+    except Exception as e:
+        trace.mark('companion_call_failed')
+        _call_stats['failures'] += 1
+        companion_failures_total.inc()
+        if breaker is not None:
+            breaker.record_failure()
+        logger.exception('Companion model request failed: %s', e)
+        return None
+
+
+_loop: Optional[asyncio.AbstractEventLoop] = None
+_loop_lock = threading.Lock()
+
+
+def get_companion_loop() -> asyncio.AbstractEventLoop:
+    """Return the background event loop that runs companion calls for the threaded server."""
+    global _loop
+    if _loop is None:
+        with _loop_lock:
+            if _loop is None:
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, name='companion-loop', daemon=True).start()
+                _loop = loop
+    return _loop
+
+
+def _cache_key(prompt: str, model: str, temperature) -> str:
+    return make_cache_key(prompt, model, temperature)
+
+
+def _lookup_result(key: str) -> Optional[str]:
+    """Look a companion result up in memory, then in the persistent store."""
+    cached = companion_cache.get(key)
+    if cached is None and companion_store is not None:
+        try:
+            cached = companion_store.get(key)
+        except Exception:
+            logger.exception('Companion store lookup failed')
+        if cached is not None:
+            companion_cache.put(key, cached)
+    return cached
+
+
+def _store_result(key: str, text: str):
+    companion_cache.put(key, text)
+    if companion_store is not None:
+        try:
+            companion_store.put(key, text)
+        except Exception:
+            logger.exception('Companion store write failed')
+
+
+def warm_companion_cache():
+    """Open the persistent companion store and preload its most recent results into memory."""
+    if companion_store is None:
+        return
+    try:
+        companion_store.open()
+        rows = companion_store.load_recent(companion_cache.max_entries)
+        # Oldest first so the most recently used rows end up most recent in the LRU
+        for key, value in reversed(rows):
+            companion_cache.put(key, value)
+        logger.info('Warm-loaded %d companion results from %s', len(rows), companion_store.path)
     except Exception:
-        logger.exception('Unexpected error calling companion model')
-        return None
\ No newline at end of file
+        logger.exception('Failed to open companion store %s', companion_store.path)
+
+
+_batch_stats = {'batches': 0, 'batched_checks': 0, 'parse_fallbacks': 0}
+
+
+def batch_stats() -> dict:
+    return dict(_batch_stats)
+
+
+def _call_single(spec: CompanionSpec, text: str, auth_header: str, model: str, timeout: float,
+                 on_delta: Optional[Callable[[str], None]] = None, trace=NULL_TRACE):
+    return call_companion_model(build_companion_prompt(text, spec.template), auth_header, model, timeout=timeout,
+                                max_tokens=companion_max_tokens(text), on_delta=on_delta, trace=trace,
+                                messages=build_companion_messages(text, spec.template), temperature=spec.temperature,
+                                ok_exit=spec.ok_exit)
+
+
+async def _run_batch(key: Tuple[CompanionSpec, str, str], items: List[Tuple[str, Deadline]]) -> List[Optional[str]]:
+    """Check the texts of items (text, deadline) with one companion call where possible."""
+    spec, model, auth_header = key
+    texts = [text for text, _ in items]
+    timeout = max(deadline.hard_remaining() for _, deadline in items)
+    if len(items) == 1:
+        return [await _call_single(spec, texts[0], auth_header, model, timeout)]
+    _batch_stats['batches'] += 1
+    _batch_stats['batched_checks'] += len(items)
+    companion_batch_size.observe(len(items))
+    # The replies come back quoted in a JSON array: allow a little for the quoting
+    max_tokens = sum(companion_max_tokens(text) + 16 for text in texts)
+    reply = await call_companion_model(build_batch_prompt(texts, spec.template), auth_header, model, timeout=timeout,
+                                       max_tokens=max_tokens, store=False,
+                                       messages=build_batch_messages(texts, spec.template),
+                                       temperature=spec.temperature)
+    if reply is None:
+        return [None] * len(items)
+    answers = parse_batch_answers(reply, len(items))
+    if answers is None:
+        _batch_stats['parse_fallbacks'] += 1
+        logger.warning('Unparseable reply to a batch of %d companion checks; checking them one by one', len(items))
+        return list(await asyncio.gather(*(
+            _call_single(spec, text, auth_header, model, deadline.hard_remaining()) for text, deadline in items)))
+    for text, answer in zip(texts, answers):
+        _store_result(_cache_key(build_companion_prompt(text, spec.template), model, spec.temperature), answer)
+    return answers
+
+
+# Checks from concurrent requests are grouped per (companion, model, Authorization) so each batch
+# shares one prompt and bills one key
+_batcher = (MicroBatcher(_run_batch, settings.COMPANION_BATCH_MAX_SIZE, settings.COMPANION_BATCH_MAX_WAIT_MS / 1000)
+            if settings.COMPANION_BATCH_MAX_SIZE > 1 else None)
+
+
+async def _check_text(spec: CompanionSpec, text: str, auth_header: str, model: str, deadline: Deadline, trace,
+                      on_delta: Optional[Callable[[str], None]] = None) -> Optional[str]:
+    """One companion check of text: a call of its own, or a place in a batch when batching is on."""
+    if _batcher is None:
+        return await _call_single(spec, text, auth_header, model, deadline.hard_remaining(), on_delta, trace)
+    trace.mark('companion_batched')
+    try:
+        return await _batcher.submit((spec, model, auth_header), (text, deadline), deadline.hard_remaining())
+    except asyncio.TimeoutError:
+        trace.mark('companion_call_timeout')
+        companion_timeouts_total.labels('call').inc()
+        return None
+
+
+_segment_stats = {'segmented_messages': 0, 'segments': 0, 'segments_from_cache': 0}
+
+
+def segment_stats() -> dict:
+    return dict(_segment_stats)
+
+
+async def _segment_result(spec: CompanionSpec, segment: str, auth_header: str, model: str,
+                          limit: asyncio.Semaphore, deadline: Deadline, trace) -> Optional[str]:
+    prompt = build_companion_prompt(segment, spec.template)
+    cached = _lookup_result(_cache_key(prompt, model, spec.temperature))
+    if cached is not None:
+        _segment_stats['segments_from_cache'] += 1
+        companion_cache_hits_total.labels('segment').inc()
+        return cached
+    async with limit:
+        return await _check_text(spec, segment, auth_header, model, deadline, trace)
+
+
+async def run_companion(user_text: str, auth_header: str, model: str,
+                        on_delta: Optional[Callable[[str], None]] = None,
+                        deadline: Optional[Deadline] = None, trace=NULL_TRACE,
+                        spec: Optional[CompanionSpec] = None) -> Optional[str]:
+    """Produce the output of companion spec (default: the first configured) for user_text.
+
+    Long messages are split into segments that are checked in parallel, each
+    memoized on its own, so a resent message with one edited paragraph only
+    pays for that paragraph. Only single-call results stream through
+    on_delta; a segmented or batched result is known once it is complete.
+    Calls are abandoned at the deadline's hard limit.
+    """
+    if spec is None:
+        spec = COMPANIONS[0]
+    if deadline is None:
+        deadline = Deadline(_wait_budget(spec, model), spec.timeout)
+    segments = []
+    if settings.COMPANION_SEGMENT_MIN_CHARS and len(user_text) >= settings.COMPANION_SEGMENT_MIN_CHARS:
+        segments = split_segments(user_text, settings.COMPANION_SEGMENT_MAX_CHARS)
+    if len(segments) <= 1:
+        return await _check_text(spec, user_text, auth_header, model, deadline, trace, on_delta)
+
+    _segment_stats['segmented_messages'] += 1
+    _segment_stats['segments'] += len(segments)
+    limit = asyncio.Semaphore(settings.COMPANION_SEGMENT_MAX_PARALLEL)
+    results = await asyncio.gather(*(_segment_result(spec, seg, auth_header, model, limit, deadline, trace)
+                                     for seg in segments))
+    merged = merge_segment_results(results)
+    if merged is not None:
+        _store_result(_cache_key(build_companion_prompt(user_text, spec.template), model, spec.temperature), merged)
+    return merged
+
+
+def _lookup_message(spec: CompanionSpec, user_text: str, model: str) -> Optional[str]:
+    prompt = build_companion_prompt(user_text, spec.template)
+    logger.debug('Companion prompt to be sent: %s', prompt)
+    cached = _lookup_result(_cache_key(prompt, model, spec.temperature))
+    if cached is not None:
+        companion_cache_hits_total.labels('message').inc()
+    return cached
+
+
+async def _run_into(stream: CompanionStream, spec: CompanionSpec, user_text: str, auth_header: str, model: str,
+                    deadline: Deadline, trace):
+    result = None
+    # This task's context: connections it opens are traced as companion_connect
+    bind_trace(trace, 'companion')
+    try:
+        result = await run_companion(user_text, auth_header, model, on_delta=stream.feed, deadline=deadline,
+                                     trace=trace, spec=spec)
+        remember_result(spec, user_text, result)
+        if result is not None:
+            elapsed = deadline.elapsed()
+            companion_latency.record(spec.latency_key(model), elapsed)
+            companion_latency_seconds.observe(elapsed)
+            if stream.abandoned:
+                # Nobody is waiting any more; the result is still in the cache for a retry
+                _call_stats['late_cached'] += 1
+    except Exception:
+        logger.exception('Companion processing runner failed')
+    finally:
+        stream.finish(result)
+
+
+async def _run_pipeline(stream: CompanionStream, plan: list, user_text: str, auth_header: str, deadline: Deadline,
+                        trace):
+    """Run the companions of plan concurrently and relay their outputs into stream in plan order.
+
+    Each companion has its own deadline: one whose output has not started
+    within its wait budget is left out (and released like a late single
+    companion) and the next one is relayed, so a request waits about as long
+    as its slowest companion rather than the sum of them.
+    """
+    subs = []
+    for spec, model, finished in plan:
+        sub_deadline = Deadline(_wait_budget(spec, model), spec.timeout, start=deadline.start)
+        sub = finished
+        if sub is None:
+            sub = CompanionStream()
+            sub.future = asyncio.ensure_future(
+                _run_into(sub, spec, user_text, auth_header, model, sub_deadline, trace))
+        subs.append((spec, sub, sub_deadline))
+    parts = []
+    try:
+        for spec, sub, sub_deadline in subs:
+            text, done = await sub.aread(0, sub_deadline.wait_remaining())
+            if not text and not done:
+                trace.mark('companion_%s_skipped' % spec.name)
+                release_companion(sub)
+                continue
+            offset = 0
+            while text or not done:
+                if text:
+                    if offset == 0 and parts:
+                        parts.append(COMPANION_JOINER)
+                        stream.feed(COMPANION_JOINER)
+                    parts.append(text)
+                    stream.feed(text)
+                    offset += len(text)
+                if done:
+                    break
+                text, done = await sub.aread(offset, sub_deadline.hard_remaining())
+                if not text and not done:
+                    break  # past its hard deadline
+    except asyncio.CancelledError:
+        for _, sub, _ in subs:
+            if sub.future is not None:
+                sub.future.cancel()
+        raise
+    finally:
+        stream.finish(''.join(parts) or None)
+
+
+def _plan_companions(user_text: str, model: str) -> list:
+    """[spec, model, finished stream or None] per companion; None still needs a call.
+
+    Text the prefilter rejects and cached results are taken as they are. The
+    remaining calls need a companion slot, shared by all of them, and a
+    closed circuit breaker for their model.
+    """
+    plan = []
+    for spec in COMPANIONS:
+        spec_model = spec.model_for(model)
+        reason = prefilter(spec, user_text)
+        if reason is not None:
+            plan.append([spec, spec_model, _prefiltered(reason)])
+            continue
+        cached = _lookup_message(spec, user_text, spec_model)
+        plan.append([spec, spec_model, CompanionStream.finished(cached) if cached is not None else None])
+    missing = [entry for entry in plan if entry[2] is None]
+    if not missing:
+        return plan
+    if not admit_companion():
+        for entry in missing:
+            entry[2] = CompanionStream.skipped('shed')
+        return plan
+    for entry in missing:
+        breaker = companion_breaker(entry[1])
+        if breaker is not None and not breaker.allow():
+            entry[2] = CompanionStream.skipped('circuit_open')
+    if all(entry[2] is not None for entry in plan):
+        companion_limiter.release()
+    return plan
+
+
+def _prefiltered(reason: str) -> CompanionStream:
+    # A recently OK text still gets its 'OK'; anything else gets no companion output
+    stream = CompanionStream.finished('OK' if reason == RECENT_OK else None)
+    stream.skip_reason = 'prefiltered'
+    return stream
+
+
+def _release_slot(future):
+    companion_limiter.release()
+
+
+# Companion calls in flight per single-flight key: [stream, requests still reading it]
+_shared = {}
+_shared_lock = threading.Lock()
+
+
+def _reserve_shared(key: str) -> SharedCompanion:
+    """Join the companion calls in flight for key, or reserve key for calls this request is about to start.
+
+    The lookup and the reservation are one step, so identical requests that
+    arrive while the first one is still planning its calls read its stream
+    instead of starting their own.
+    """
+    with _shared_lock:
+        entry = _shared.get(key)
+        joined = entry is not None
+        if joined:
+            entry[1] += 1
+        else:
+            entry = _shared[key] = [CompanionStream(), 1]
+    if joined:
+        record_join('companion')
+    return SharedCompanion(entry[0], key, joined)
+
+
+def _unshare(key: str, stream: CompanionStream):
+    with _shared_lock:
+        entry = _shared.get(key)
+        if entry is not None and entry[0] is stream:
+            del _shared[key]
+
+
+def _leave_shared(companion: SharedCompanion) -> bool:
+    """Count companion's request out of its shared call; True if it was the last one reading it."""
+    with _shared_lock:
+        companion.released = True
+        entry = _shared.get(companion.key)
+        if entry is None or entry[0] is not companion.stream:
+            return True
+        entry[1] -= 1
+        if entry[1] > 0:
+            return False
+        # Nobody joins a call that is being given up
+        del _shared[companion.key]
+        return True
+
+
+def _finished_plan(plan: list) -> CompanionStream:
+    # Every companion was answered without a call: cache hits, prefilter and shed/breaker skips
+    if len(plan) == 1:
+        return plan[0][2]
+    results = [entry[2].result for entry in plan if entry[2].result is not None]
+    if not results:
+        return CompanionStream.skipped(plan[0][2].skip_reason)
+    return CompanionStream.finished(COMPANION_JOINER.join(results))
+
+
+def _start_companions(user_text: str, auth_header: str, model: str, deadline: Deadline, trace,
+                      schedule: Callable, key: Optional[str] = None) -> CompanionStream:
+    shared = None
+    if key is not None:
+        shared = _reserve_shared(key)
+        if shared.joined:
+            return shared
+    stream = shared.stream if shared is not None else CompanionStream()
+    slot_taken = False
+    try:
+        plan = _plan_companions(user_text, model)
+        if all(entry[2] is not None for entry in plan):
+            finished = _finished_plan(plan)
+            if shared is None:
+                return finished
+            # Requests that joined the reservation get the same answer
+            _unshare(key, stream)
+            stream.skip_reason = finished.skip_reason
+            stream.finish(finished.result)
+            return shared
+        # Planning took a companion slot; _release_slot gives it back once the calls end
+        slot_taken = True
+        if len(plan) == 1:
+            spec, spec_model, _ = plan[0]
+            coro = _run_into(stream, spec, user_text, auth_header, spec_model, deadline, trace)
+        else:
+            coro = _run_pipeline(stream, plan, user_text, auth_header, deadline, trace)
+        try:
+            stream.future = schedule(coro)
+        except BaseException:
+            coro.close()
+            raise
+    except BaseException:
+        if slot_taken:
+            # schedule() failed (loop closed, executor shut down): the calls never run to release it
+            companion_limiter.release()
+        if shared is not None:
+            _unshare(key, stream)
+            stream.finish(None)
+        raise
+    stream.future.add_done_callback(_release_slot)
+    if shared is not None:
+        stream.future.add_done_callback(lambda future: _unshare(key, stream))
+        return shared
+    return stream
+
+
+def submit_companion_call(user_text: str, auth_header: str, model: str, deadline: Deadline,
+                          trace=NULL_TRACE, key: Optional[str] = None) -> CompanionStream:
+    """Schedule the configured companions for user_text on the companion loop from a handler thread.
+
+    Their outputs arrive on one stream, in COMPANIONS order. When nothing is
+    left to call (cache hits, or calls skipped because of an open circuit
+    breaker or admission control) the returned stream is already finished,
+    so the handler never waits. With a single-flight key, a request identical
+    to one whose calls are still running reads that request's stream instead.
+    """
+    return _start_companions(user_text, auth_header, model, deadline, trace,
+                             lambda coro: asyncio.run_coroutine_threadsafe(coro, get_companion_loop()), key)
+
+
+def start_companion_task(user_text: str, auth_header: str, model: str, deadline: Deadline,
+                         trace=NULL_TRACE, key: Optional[str] = None) -> CompanionStream:
+    """asyncio-engine counterpart of submit_companion_call; must be called on the running loop."""
+    return _start_companions(user_text, auth_header, model, deadline, trace, asyncio.ensure_future, key)
+
+
+def companion_trace_mark(companion: CompanionStream) -> str:
+    """Trace mark for a just-submitted companion call."""
+    if isinstance(companion, SharedCompanion) and companion.joined:
+        return 'companion_joined'
+    if not companion.done:
+        return 'companion_submitted'
+    if companion.skip_reason is not None:
+        return 'companion_' + companion.skip_reason
+    return 'companion_cache_hit'
+
+
+def release_companion(companion: Optional[CompanionStream], client_gone: bool = False) -> bool:
+    """Called when the handler has stopped waiting for companion output; True if the call was cancelled.
+
+    A call that is still running is cancelled under COMPANION_LATE_POLICY=cancel
+    or when the client has disconnected; under 'cache' it runs to its hard
+    deadline and its result is cached. A call shared by identical requests is
+    only given up when the last of them lets go of it.
+    """
+    if companion is None or companion.done:
+        return False
+    if isinstance(companion, SharedCompanion):
+        if companion.released or not _leave_shared(companion):
+            return False
+        companion = companion.stream
+    if companion.abandoned:
+        return False
+    companion.abandoned = True
+    if not client_gone:
+        companion_timeouts_total.labels('wait').inc()
+    if client_gone or settings.COMPANION_LATE_POLICY == 'cancel':
+        if companion.future is not None and companion.future.cancel():
+            if not client_gone:
+                _call_stats['late_cancelled'] += 1
+            return True
+    return False
+
+
+def _reset_after_fork():
+    # The loop thread does not survive fork; a worker starts its own on first use
+    global _loop, _loop_lock, _shared_lock
+    _loop = None
+    _loop_lock = threading.Lock()
+    _shared.clear()
+    _shared_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
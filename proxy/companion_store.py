@@ -0,0 +1,227 @@
+import fcntl
+import hashlib
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+from typing import List, Optional, Tuple
+
+from config import settings
+from .companions import COMPANIONS
+
+logger = logging.getLogger(__name__)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS companion_results (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL,
+    prompt_hash TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    created_at REAL NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS companion_results_last_used ON companion_results (last_used);
+"""
+
+# Compact after this many writes, and shrink to this fraction of max_bytes when over the cap
+_COMPACT_EVERY = 500
+_COMPACT_TARGET = 0.9
+
+
+def prompt_file_hash() -> str:
+    """Hash of the companion prompt templates; rows written under other templates are stale."""
+    return hashlib.sha256('\0'.join(spec.template for spec in COMPANIONS).encode('utf-8')).hexdigest()
+
+
+class CompanionStore:
+    """SQLite-backed companion results that survive restarts.
+
+    Reads run inline on read connections of their own, one per concurrent
+    reader taken from a small pool (a primary-key lookup on a local file;
+    WAL mode lets them run while a write is in progress, so they never wait
+    for the writer or for each other). Writes, last-used updates and
+    compaction happen on a background writer thread with its own connection,
+    in batches. Each
+    process opens its own connections, so worker processes can share one
+    file; one of them at a time does the maintenance.
+    """
+
+    def __init__(self, path: str, max_bytes: int, ttl: float, prompt_hash: str):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.prompt_hash = prompt_hash
+        self._readers = []
+        self._read_pid = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._queue = None
+        self._writes_since_compact = 0
+        self._hits = 0
+        self._misses = 0
+        self._invalidated = 0
+        self._compactions = 0
+        self._warm_loaded = 0
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=5, check_same_thread=False, isolation_level=None)
+        # Only takes effect on a new file: lets compaction hand freed pages back without a VACUUM
+        conn.execute('PRAGMA auto_vacuum=INCREMENTAL')
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.executescript(_SCHEMA)
+        return conn
+
+    def _read(self, sql: str, params=()) -> list:
+        if self._read_pid != os.getpid():
+            # Connections are not shared across fork
+            self._readers = []
+            self._read_pid = os.getpid()
+        readers = self._readers
+        try:
+            conn = readers.pop()
+        except IndexError:
+            conn = sqlite3.connect(self.path, timeout=5, check_same_thread=False, isolation_level=None)
+        try:
+            return conn.execute(sql, params).fetchall()
+        finally:
+            readers.append(conn)
+
+    def _ops(self) -> queue.Queue:
+        """This process's writer queue, starting the writer thread on first use."""
+        with self._lock:
+            if self._queue is None or self._pid != os.getpid():
+                self._queue = queue.Queue()
+                self._pid = os.getpid()
+                threading.Thread(target=self._writer_loop, args=(self._queue,), name='companion-store',
+                                 daemon=True).start()
+            return self._queue
+
+    def open(self):
+        """Open the store; the writer thread then drops rows from other prompt templates and compacts."""
+        self._connect().close()
+        self._ops().put(('open',))
+
+    def get(self, key: str) -> Optional[str]:
+        now = time.time()
+        rows = self._read(
+            'SELECT value FROM companion_results WHERE key = ? AND prompt_hash = ? AND created_at > ?',
+            (key, self.prompt_hash, now - self.ttl))
+        if not rows:
+            self._misses += 1
+            return None
+        self._hits += 1
+        self._ops().put(('touch', key, now))
+        return rows[0][0]
+
+    def put(self, key: str, value: str):
+        self._ops().put(('put', key, value))
+
+    def load_recent(self, limit: int) -> List[Tuple[str, str]]:
+        """Return up to limit (key, value) pairs, most recently used first."""
+        rows = self._read(
+            'SELECT key, value FROM companion_results WHERE prompt_hash = ? AND created_at > ? '
+            'ORDER BY last_used DESC LIMIT ?',
+            (self.prompt_hash, time.time() - self.ttl, limit))
+        self._warm_loaded += len(rows)
+        return rows
+
+    def _writer_loop(self, ops: queue.Queue):
+        conn = self._connect()
+        while True:
+            batch = [ops.get()]
+            try:
+                while len(batch) < 256:
+                    batch.append(ops.get_nowait())
+            except queue.Empty:
+                pass
+            try:
+                if batch[0][0] == 'open':
+                    batch.pop(0)
+                    self._maintain(conn, invalidate=True)
+                if batch:
+                    self._write_batch(conn, batch)
+            except Exception:
+                logger.exception('Failed to write companion results to %s', self.path)
+
+    def _write_batch(self, conn: sqlite3.Connection, batch):
+        now = time.time()
+        conn.execute('BEGIN')
+        try:
+            for op in batch:
+                if op[0] == 'put':
+                    _, key, value = op
+                    conn.execute(
+                        'INSERT OR REPLACE INTO companion_results (key, value, prompt_hash, size, created_at, last_used) '
+                        'VALUES (?, ?, ?, ?, ?, ?)',
+                        (key, value, self.prompt_hash, len(key) + len(value.encode('utf-8')), now, now))
+                    self._writes_since_compact += 1
+                elif op[0] == 'touch':
+                    _, key, used_at = op
+                    conn.execute('UPDATE companion_results SET last_used = ? WHERE key = ?', (used_at, key))
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        if self._writes_since_compact >= _COMPACT_EVERY:
+            self._maintain(conn)
+
+    def _maintain(self, conn: sqlite3.Connection, invalidate: bool = False):
+        """Compact (and on open drop stale templates' rows) unless another process sharing the file is at it."""
+        self._writes_since_compact = 0
+        with open(self.path + '.lock', 'a') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                return
+            if invalidate:
+                cur = conn.execute('DELETE FROM companion_results WHERE prompt_hash != ?', (self.prompt_hash,))
+                self._invalidated += cur.rowcount
+                if cur.rowcount:
+                    logger.info('Companion prompt changed; dropped %d stored companion results', cur.rowcount)
+            self._compact(conn)
+
+    def _compact(self, conn: sqlite3.Connection):
+        """Drop expired rows, then least recently used rows until under the size cap."""
+        conn.execute('DELETE FROM companion_results WHERE created_at <= ?', (time.time() - self.ttl,))
+        total = conn.execute('SELECT COALESCE(SUM(size), 0) FROM companion_results').fetchone()[0]
+        if total > self.max_bytes:
+            to_free = total - int(self.max_bytes * _COMPACT_TARGET)
+            count = freed = 0
+            for (size,) in conn.execute('SELECT size FROM companion_results ORDER BY last_used, key'):
+                freed += size
+                count += 1
+                if freed >= to_free:
+                    break
+            # By key, not by last_used: rows used at the same moment as the last one to go are kept
+            conn.execute('DELETE FROM companion_results WHERE key IN '
+                         '(SELECT key FROM companion_results ORDER BY last_used, key LIMIT ?)', (count,))
+            # Frees the deleted pages of files created with auto_vacuum; others reuse them for new rows
+            conn.execute('PRAGMA incremental_vacuum')
+        self._compactions += 1
+
+    def stats(self) -> dict:
+        entries, size = self._read('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM companion_results')[0]
+        return {
+            'path': self.path,
+            'entries': entries,
+            'bytes': size,
+            'max_bytes': self.max_bytes,
+            'hits': self._hits,
+            'misses': self._misses,
+            'warm_loaded': self._warm_loaded,
+            'invalidated': self._invalidated,
+            'compactions': self._compactions,
+        }
+
+
+companion_store = None
+if settings.COMPANION_DISK_CACHE_PATH:
+    companion_store = CompanionStore(
+        path=settings.COMPANION_DISK_CACHE_PATH,
+        max_bytes=settings.COMPANION_DISK_CACHE_MAX_BYTES,
+        ttl=settings.COMPANION_DISK_CACHE_TTL,
+        prompt_hash=prompt_file_hash(),
+    )
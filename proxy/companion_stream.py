@@ -0,0 +1,129 @@
+import asyncio
+import threading
+import time
+from typing import Optional, Tuple
+
+
+class CompanionStream:
+    """Companion output as it arrives, readable from handler threads and coroutines.
+
+    Written only from the event loop that runs the companion call (feed/finish).
+    Handler threads wait on a condition; coroutines on that same loop wait on an
+    asyncio.Event. Readers keep their own offset into the text, so text that
+    has already been relayed is never sent twice.
+    """
+
+    def __init__(self):
+        self._parts = []
+        self._cond = threading.Condition()
+        self._changed: Optional[asyncio.Event] = None
+        self.done = False
+        self.result: Optional[str] = None
+        self.future = None  # the running companion call, if any
+        self.abandoned = False  # set once the handler stopped waiting for it
+        self.skip_reason: Optional[str] = None  # why no call was made, for a stream finished on submit
+
+    @classmethod
+    def finished(cls, result: Optional[str]) -> 'CompanionStream':
+        stream = cls()
+        stream.done = True
+        stream.result = result
+        return stream
+
+    @classmethod
+    def skipped(cls, reason: str) -> 'CompanionStream':
+        stream = cls.finished(None)
+        stream.skip_reason = reason
+        return stream
+
+    def feed(self, delta: str):
+        with self._cond:
+            self._parts.append(delta)
+            self._cond.notify_all()
+        self._wake()
+
+    def finish(self, result: Optional[str]):
+        with self._cond:
+            self.done = True
+            self.result = result
+            self._cond.notify_all()
+        self._wake()
+
+    def _wake(self):
+        if self._changed is not None:
+            self._changed.set()
+            self._changed = None
+
+    def _text(self) -> str:
+        # A finished call's result replaces the deltas (segment merges and cache hits have none)
+        if self.done and self.result is not None:
+            return self.result
+        return ''.join(self._parts)
+
+    def _snapshot(self, offset: int) -> Tuple[str, bool]:
+        with self._cond:
+            return self._text()[offset:], self.done
+
+    def read(self, offset: int, timeout: float) -> Tuple[str, bool]:
+        """Wait up to timeout for text past offset; return (new text, whether the call is finished)."""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while not self.done and len(self._text()) <= offset:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            return self._text()[offset:], self.done
+
+    async def aread(self, offset: int, timeout: float) -> Tuple[str, bool]:
+        """Coroutine counterpart of read; must run on the loop that feeds this stream."""
+        text, done = self._snapshot(offset)
+        if text or done or timeout <= 0:
+            return text, done
+        if self._changed is None:
+            self._changed = asyncio.Event()
+        try:
+            await asyncio.wait_for(self._changed.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        return self._snapshot(offset)
+
+    def wait(self, timeout: float) -> Optional[str]:
+        """Wait up to timeout for the complete result; None if it failed or is late."""
+        with self._cond:
+            self._cond.wait_for(lambda: self.done, timeout)
+            return self.result if self.done else None
+
+    async def await_result(self, timeout: float) -> Optional[str]:
+        """Coroutine counterpart of wait; must run on the loop that feeds this stream."""
+        deadline = time.monotonic() + timeout
+        while not self.done:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            if self._changed is None:
+                self._changed = asyncio.Event()
+            try:
+                await asyncio.wait_for(self._changed.wait(), remaining)
+            except asyncio.TimeoutError:
+                return None
+        return self.result
+
+
+class SharedCompanion:
+    """One request's handle on a CompanionStream that identical concurrent requests share.
+
+    Reads go to the shared stream; released makes release_companion count
+    each request once, so the call is only given up when the last one leaves.
+    """
+
+    __slots__ = ('stream', 'key', 'joined', 'released')
+
+    def __init__(self, stream: CompanionStream, key: str, joined: bool):
+        self.stream = stream
+        self.key = key
+        self.joined = joined  # attached to a call started by an earlier request
+        self.released = False
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
@@ -0,0 +1,63 @@
+"""Registry of the companions that run on every request, in output order."""
+from typing import List, Optional
+
+from config import settings
+
+# Between the outputs of consecutive companions
+COMPANION_JOINER = '\n\n'
+
+
+class CompanionSpec:
+    """One configured companion: its prompt template and call parameters.
+
+    model None means the request's own model. ok_exit: the prompt's "no change"
+    answer is an exact 'OK', so a call can stop reading once it has that answer.
+    """
+
+    __slots__ = ('name', 'template', 'model', 'temperature', 'timeout', 'ok_exit')
+
+    def __init__(self, name: str, template: str, model: Optional[str], temperature, timeout: float,
+                 ok_exit: bool = False):
+        self.name = name
+        self.template = template
+        self.model = model
+        self.temperature = temperature
+        self.timeout = timeout
+        self.ok_exit = ok_exit
+
+    def model_for(self, request_model: str) -> str:
+        return self.model or request_model
+
+    def latency_key(self, model: str) -> str:
+        # The unnamed default companion keeps plain model keys in /stats
+        return model if self.name == 'default' else '%s/%s' % (self.name, model)
+
+
+def _ok_exit(value: str, template: str) -> bool:
+    if value == 'auto':
+        return '"OK"' in template or "'OK'" in template
+    return value == '1'
+
+
+def load_companions() -> List[CompanionSpec]:
+    """Companions named in COMPANIONS, or the single COMPANION_PROMPT_FILE companion."""
+    if not settings.COMPANIONS:
+        return [CompanionSpec('default', settings.COMPANION_PROMPT, None, settings.COMPANION_TEMPERATURE,
+                              settings.COMPANION_TIMEOUT,
+                              _ok_exit(settings.COMPANION_OK_EXIT, settings.COMPANION_PROMPT))]
+    specs = []
+    for name in settings.COMPANIONS:
+        prompt_file = settings.companion_setting(name, 'PROMPT_FILE')
+        if not prompt_file:
+            raise ValueError('COMPANION_%s_PROMPT_FILE is not set for companion %r' % (name.upper(), name))
+        with open(prompt_file) as f:
+            template = f.read().strip()
+        specs.append(CompanionSpec(
+            name, template, settings.companion_setting(name, 'MODEL'),
+            settings.companion_setting(name, 'TEMPERATURE', settings.COMPANION_TEMPERATURE),
+            float(settings.companion_setting(name, 'TIMEOUT', settings.COMPANION_TIMEOUT)),
+            _ok_exit(settings.companion_setting(name, 'OK_EXIT', settings.COMPANION_OK_EXIT), template)))
+    return specs
+
+
+COMPANIONS = load_companions()
@@ -0,0 +1,66 @@
+import collections
+import threading
+import time
+from typing import Optional
+
+
+class Deadline:
+    """Time budget for one request, shared by the handler and its companion call.
+
+    wait_at is when the handler stops waiting for companion output; hard_at is
+    when the companion call itself is abandoned.
+    """
+
+    __slots__ = ('start', 'wait_at', 'hard_at')
+
+    def __init__(self, wait_budget: float, hard_budget: float, start: Optional[float] = None):
+        self.start = time.monotonic() if start is None else start
+        self.wait_at = self.start + wait_budget
+        self.hard_at = self.start + max(hard_budget, wait_budget)
+
+    def wait_remaining(self) -> float:
+        return max(0.0, self.wait_at - time.monotonic())
+
+    def hard_remaining(self) -> float:
+        return max(0.0, self.hard_at - time.monotonic())
+
+    def elapsed(self) -> float:
+        return time.monotonic() - self.start
+
+
+class LatencyTracker:
+    """Rolling window of recent latencies per key (e.g. model), with percentiles."""
+
+    def __init__(self, window: int):
+        self.window = window
+        self._samples = {}  # key -> deque of seconds
+        self._lock = threading.Lock()
+
+    def record(self, key: str, seconds: float):
+        with self._lock:
+            samples = self._samples.get(key)
+            if samples is None:
+                samples = self._samples[key] = collections.deque(maxlen=self.window)
+            samples.append(seconds)
+
+    def percentile(self, key: str, pct: float) -> Optional[float]:
+        """pct-th percentile of the recent samples for key, or None with no samples yet."""
+        with self._lock:
+            samples = self._samples.get(key)
+            if not samples:
+                return None
+            ordered = sorted(samples)
+        index = min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))
+        return ordered[index]
+
+    def stats(self) -> dict:
+        with self._lock:
+            keys = list(self._samples)
+        out = {}
+        for key in keys:
+            out[key] = {
+                'samples': len(self._samples[key]),
+                'p50': round(self.percentile(key, 50), 4),
+                'p95': round(self.percentile(key, 95), 4),
+            }
+        return out
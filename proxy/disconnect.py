@@ -0,0 +1,130 @@
+import logging
+import os
+import selectors
+import socket
+import threading
+from typing import Callable, Optional
+
+from config import settings
+from .metrics import client_disconnects_total, upstream_work_cancelled_total
+
+logger = logging.getLogger(__name__)
+
+_PEEK_FLAGS = socket.MSG_PEEK | getattr(socket, 'MSG_DONTWAIT', 0)
+
+_stats = {'client_disconnects': 0, 'main_streams_aborted': 0, 'companion_calls_cancelled': 0,
+          'companion_seconds_saved': 0.0}
+_stats_lock = threading.Lock()
+
+
+def disconnect_stats() -> dict:
+    """Client disconnects noticed mid-request and the upstream work dropped because of them.
+
+    companion_seconds_saved sums the hard-deadline budget left on each
+    cancelled companion call, an upper bound on the companion time saved.
+    """
+    with _stats_lock:
+        out = dict(_stats)
+    out['companion_seconds_saved'] = round(out['companion_seconds_saved'], 3)
+    return out
+
+
+def record_disconnect(main_aborted: bool, companion_cancelled: bool, companion_budget: float = 0.0):
+    with _stats_lock:
+        _stats['client_disconnects'] += 1
+        if main_aborted:
+            _stats['main_streams_aborted'] += 1
+        if companion_cancelled:
+            _stats['companion_calls_cancelled'] += 1
+            _stats['companion_seconds_saved'] += companion_budget
+    client_disconnects_total.inc()
+    if main_aborted:
+        upstream_work_cancelled_total.labels('main').inc()
+    if companion_cancelled:
+        upstream_work_cancelled_total.labels('companion').inc()
+
+
+class DisconnectWatcher:
+    """Notices client sockets closing while their handler thread is busy elsewhere.
+
+    A handler streaming from upstream or waiting for the companion does not
+    read from its client, so a disconnect would only show up as a failed write.
+    One background thread watches all registered sockets with a selector; when
+    one becomes readable and the peek fails (a reset), its callback runs on
+    that thread. A socket that turns out to carry data (a pipelined request)
+    or EOF is dropped from the watch list: EOF may only be the client
+    half-closing after its body, and it still reads the response. A client
+    that closed for good shows up on the handler's next write.
+    """
+
+    def __init__(self, poll_interval: float):
+        self.poll_interval = poll_interval
+        self._selector = selectors.DefaultSelector()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def watch(self, sock: socket.socket, callback: Callable[[], None]):
+        with self._lock:
+            try:
+                self._selector.register(sock, selectors.EVENT_READ, callback)
+            except (KeyError, ValueError, OSError):
+                return
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='disconnect-watcher', daemon=True)
+                self._thread.start()
+
+    def unwatch(self, sock: socket.socket):
+        with self._lock:
+            try:
+                self._selector.unregister(sock)
+            except (KeyError, ValueError, OSError):
+                pass
+
+    def _run(self):
+        while True:
+            try:
+                events = self._selector.select(self.poll_interval)
+            except OSError:
+                logger.exception('Disconnect watcher select failed')
+                continue
+            for key, _ in events:
+                sock = key.fileobj
+                try:
+                    sock.recv(1, _PEEK_FLAGS)
+                    gone = False
+                except (BlockingIOError, InterruptedError):
+                    continue
+                except OSError:
+                    gone = True
+                self.unwatch(sock)
+                if gone:
+                    try:
+                        key.data()
+                    except Exception:
+                        logger.exception('Disconnect callback failed')
+
+
+_watcher: Optional[DisconnectWatcher] = None
+_watcher_lock = threading.Lock()
+
+
+def get_disconnect_watcher() -> Optional[DisconnectWatcher]:
+    """Return the process-wide watcher, or None when DISCONNECT_POLL_INTERVAL is 0."""
+    global _watcher
+    if settings.DISCONNECT_POLL_INTERVAL <= 0:
+        return None
+    if _watcher is None:
+        with _watcher_lock:
+            if _watcher is None:
+                _watcher = DisconnectWatcher(settings.DISCONNECT_POLL_INTERVAL)
+    return _watcher
+
+
+def _reset_after_fork():
+    # The watcher thread and its selector are not inherited; a worker creates its own
+    global _watcher, _watcher_lock
+    _watcher = None
+    _watcher_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
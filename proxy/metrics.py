@@ -0,0 +1,294 @@
+"""Prometheus-style metrics for the proxy's hot path, served on GET /metrics.
+
+Counters, gauges and fixed-bucket histograms without a client library.
+Recording a sample costs one uncontended lock acquire plus a bisect, so the
+instrumentation stays on in production. Each worker process keeps its own
+values; scrape every worker (or run a single one) for complete numbers.
+"""
+import bisect
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, Sequence, Tuple
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Seconds; spans sub-millisecond connects to companion calls near their hard timeout
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class _Registry:
+    def __init__(self):
+        self._metrics = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+
+    def render(self) -> bytes:
+        """All registered metrics in the Prometheus text exposition format."""
+        with self._lock:
+            metrics = list(self._metrics)
+        lines = []
+        for metric in metrics:
+            lines.append('# HELP %s %s' % (metric.name, metric.documentation))
+            lines.append('# TYPE %s %s' % (metric.name, metric.type))
+            lines.extend(metric.samples())
+        return ('\n'.join(lines) + '\n').encode('utf-8')
+
+
+REGISTRY = _Registry()
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    if float(value).is_integer():
+        return '%d' % value
+    return repr(float(value))
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _label_text(names: Sequence[str], values: Sequence[str], extra: str = '') -> str:
+    pairs = ['%s="%s"' % (n, _escape(v)) for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{%s}' % ','.join(pairs) if pairs else ''
+
+
+class _Metric:
+    type = ''
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children: Dict[Tuple[str, ...], object] = {}
+        self._lock = threading.Lock()
+        if not self.labelnames:
+            self._default = self._children[()] = self._new_child()
+        REGISTRY.register(self)
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def labels(self, *values):
+        """The child metric for these label values (created on first use)."""
+        key = tuple(str(v) for v in values)
+        child = self._children.get(key)
+        if child is None:
+            if len(key) != len(self.labelnames):
+                raise ValueError('%s expects labels %s' % (self.name, self.labelnames))
+            with self._lock:
+                child = self._children.setdefault(key, self._new_child())
+        return child
+
+    def _items(self) -> List[Tuple[Tuple[str, ...], object]]:
+        with self._lock:
+            return sorted(self._children.items())
+
+    def samples(self) -> List[str]:
+        return ['%s%s %s' % (self.name, _label_text(self.labelnames, key), _format_value(child.get()))
+                for key, child in self._items()]
+
+
+class _Value:
+    __slots__ = ('_value', '_lock')
+
+    def __init__(self):
+        self._value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1):
+        with self._lock:
+            self._value += amount
+
+    def dec(self, amount: float = 1):
+        with self._lock:
+            self._value -= amount
+
+    def set(self, value: float):
+        self._value = value
+
+    def get(self) -> float:
+        return self._value
+
+
+class _FunctionValue:
+    __slots__ = ('_fn',)
+
+    def __init__(self, fn: Callable[[], float]):
+        self._fn = fn
+
+    def get(self) -> float:
+        return self._fn()
+
+
+class Counter(_Metric):
+    type = 'counter'
+
+    def _new_child(self):
+        return _Value()
+
+    def inc(self, amount: float = 1):
+        self._default.inc(amount)
+
+
+class Gauge(_Metric):
+    type = 'gauge'
+
+    def _new_child(self):
+        return _Value()
+
+    def inc(self, amount: float = 1):
+        self._default.inc(amount)
+
+    def dec(self, amount: float = 1):
+        self._default.dec(amount)
+
+    def set(self, value: float):
+        self._default.set(value)
+
+    def set_function(self, fn: Callable[[], float]):
+        """Report fn() at scrape time instead of a stored value."""
+        self._default = self._children[()] = _FunctionValue(fn)
+
+
+class _HistogramValue:
+    __slots__ = ('_bounds', '_counts', '_sum', '_lock')
+
+    def __init__(self, bounds: Tuple[float, ...]):
+        self._bounds = bounds
+        self._counts = [0] * (len(bounds) + 1)  # the last slot is +Inf
+        self._sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        i = bisect.bisect_left(self._bounds, value)
+        with self._lock:
+            self._counts[i] += 1
+            self._sum += value
+
+    def time(self) -> '_Timer':
+        """Context manager observing the seconds spent in its block."""
+        return _Timer(self)
+
+    def snapshot(self) -> Tuple[List[int], float]:
+        with self._lock:
+            return list(self._counts), self._sum
+
+
+class _Timer:
+    __slots__ = ('_hist', '_start')
+
+    def __init__(self, hist: _HistogramValue):
+        self._hist = hist
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self._hist.observe(time.perf_counter() - self._start)
+
+
+class Histogram(_Metric):
+    type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames)
+
+    def _new_child(self):
+        return _HistogramValue(self.buckets)
+
+    def observe(self, value: float):
+        self._default.observe(value)
+
+    def time(self) -> _Timer:
+        return self._default.time()
+
+    def samples(self) -> List[str]:
+        out = []
+        for key, child in self._items():
+            counts, total = child.snapshot()
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = 'le="%s"' % _format_value(bound)
+                out.append('%s_bucket%s %d' % (self.name, _label_text(self.labelnames, key, le), cumulative))
+            labels = _label_text(self.labelnames, key)
+            out.append('%s_sum%s %s' % (self.name, labels, _format_value(total)))
+            out.append('%s_count%s %d' % (self.name, labels, cumulative))
+        return out
+
+
+def render_metrics() -> bytes:
+    return REGISTRY.render()
+
+
+# -- Proxy metrics ------------------------------------------------------
+
+requests_total = Counter(
+    'proxy_requests_total', 'Chat completion requests received', ['mode'])
+upstream_connect_seconds = Histogram(
+    'proxy_upstream_connect_seconds', 'Time to open a new upstream connection, including TLS', ['client'])
+upstream_ttfb_seconds = Histogram(
+    'proxy_upstream_ttfb_seconds', 'Time from sending an upstream request to its response headers', ['call'])
+main_stream_seconds = Histogram(
+    'proxy_main_stream_seconds', 'Time spent relaying the main stream, from upstream headers to its end')
+companion_latency_seconds = Histogram(
+    'proxy_companion_latency_seconds', 'Time from request start to the companion result')
+companion_wait_seconds = Histogram(
+    'proxy_companion_wait_seconds', 'Time a response was blocked waiting for companion output')
+companion_timeouts_total = Counter(
+    'proxy_companion_timeouts_total',
+    'Companion calls that hit their timeout (call) or were not finished when the response gave up waiting (wait)',
+    ['stage'])
+companion_failures_total = Counter(
+    'proxy_companion_failures_total', 'Companion calls that failed or timed out')
+companion_cache_hits_total = Counter(
+    'proxy_companion_cache_hits_total', 'Companion results served from the cache, per whole message or segment',
+    ['level'])
+relayed_bytes_total = Counter(
+    'proxy_relayed_bytes_total', 'Bytes of main stream relayed to clients')
+active_streams = Gauge(
+    'proxy_active_streams', 'Streaming responses currently being relayed')
+client_disconnects_total = Counter(
+    'proxy_client_disconnects_total', 'Clients that disconnected while their request was still in progress')
+upstream_work_cancelled_total = Counter(
+    'proxy_upstream_work_cancelled_total', 'Upstream main streams and companion calls stopped because the client left',
+    ['call'])
+shed_total = Counter(
+    'proxy_shed_total', 'Work refused under load: requests rejected (queue full, queue timeout) and companion calls skipped',
+    ['reason'])
+requests_in_flight = Gauge(
+    'proxy_requests_in_flight', 'Chat completion requests holding a concurrency slot')
+requests_queued = Gauge(
+    'proxy_requests_queued', 'Chat completion requests waiting for a concurrency slot')
+companion_calls_in_flight = Gauge(
+    'proxy_companion_calls_in_flight', 'Companion calls holding a concurrency slot')
+companion_breaker_state = Gauge(
+    'proxy_companion_breaker_state', 'Companion circuit breaker per model: 0 closed, 1 half-open, 2 open', ['model'])
+companion_breaker_skipped_total = Counter(
+    'proxy_companion_breaker_skipped_total', 'Companion calls skipped because their circuit breaker was open',
+    ['model'])
+companion_batch_size = Histogram(
+    'proxy_companion_batch_size', 'Companion checks sent together in one batched upstream call',
+    buckets=(2, 3, 4, 6, 8, 12, 16, 24, 32))
+companion_tokens_total = Counter(
+    'proxy_companion_tokens_total', 'Companion tokens reported by upstream usage: prompt, cached (part of prompt), completion',
+    ['kind'])
+companion_ttfb_by_prefix_cache = Histogram(
+    'proxy_companion_ttfb_by_prefix_cache_seconds',
+    'Companion time to response headers, by whether upstream reported cached prompt tokens', ['prefix_cache'])
+coalesced_requests_total = Counter(
+    'proxy_coalesced_requests_total', 'Requests that attached to identical work in flight: companion calls or a main stream',
+    ['kind'])
+companion_prefilter_total = Counter(
+    'proxy_companion_prefilter_total', 'Prefilter decisions per companion: pass, or the reason the call was skipped',
+    ['companion', 'decision'])
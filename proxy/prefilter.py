@@ -0,0 +1,239 @@
+"""Local checks that skip the companion call for text a companion cannot improve.
+
+"ok", "continue", one-word replies, pasted code, stack traces, URLs and JSON
+would otherwise each cost a full companion round trip (and the wait for
+it). A check takes (spec, text) and returns why the text should be skipped,
+or None. The checks a companion runs are named in COMPANION_PREFILTERS (or
+COMPANION_<NAME>_PREFILTERS), in order; the first reason wins, and none run
+unless configured. Besides the built-in names below, an entry may be
+'package.module:function' or a name added with register_prefilter().
+"""
+import collections
+import functools
+import importlib
+import json
+import logging
+import re
+import threading
+import unicodedata
+from typing import Callable, Dict, List, Optional, Tuple
+
+from config import settings
+from .companions import CompanionSpec
+from .metrics import companion_prefilter_total
+
+logger = logging.getLogger(__name__)
+
+# Skip reason of the recent_ok check: the answer is known to be 'OK' rather than unknown
+RECENT_OK = 'recent_ok'
+
+# Kana and Han characters are words of their own (those scripts do not separate words with spaces)
+_WORD_RE = re.compile(r'[぀-ヿ㐀-鿿豈-﫿]|[^\s぀-ヿ㐀-鿿豈-﫿]+')
+_FENCED_RE = re.compile(r'```.*?(?:```|$)|~~~.*?(?:~~~|$)', re.S)
+_INLINE_CODE_RE = re.compile(r'`[^`\n]+`')
+_URL_RE = re.compile(r'\b(?:https?|ftp)://\S+|\bwww\.\S+', re.I)
+_STACK_TRACE_RE = re.compile(
+    r'Traceback \(most recent call last\)|^\s*File "[^"]+", line \d+|^\s+at [\w$.<>/]+\(.*\)\s*$'
+    r'|^\s*at .+:\d+:\d+\)?\s*$|^goroutine \d+ \[', re.M)
+_TAG_RE = re.compile(r'</?[A-Za-z][\w:-]*(?:\s[^<>]*)?/?>')
+_CODE_LINE_RE = re.compile(r'[;{}]\s*$|^\s*(?:def|class|import|from|function|const|let|var|return|#include)\b')
+
+
+def _words(text: str) -> int:
+    return len(_WORD_RE.findall(text))
+
+
+def _min_words(spec: CompanionSpec) -> int:
+    return int(settings.companion_setting(spec.name, 'MIN_WORDS', settings.COMPANION_PREFILTER_MIN_WORDS))
+
+
+def check_length(spec: CompanionSpec, text: str) -> Optional[str]:
+    """Fewer than MIN_WORDS words, or more than COMPANION_PREFILTER_MAX_CHARS characters."""
+    if _words(text) < _min_words(spec):
+        return 'too_short'
+    if settings.COMPANION_PREFILTER_MAX_CHARS and len(text) > settings.COMPANION_PREFILTER_MAX_CHARS:
+        return 'too_long'
+    return None
+
+
+def _is_json(text: str) -> bool:
+    if not text or text[0] not in '{[' or text[-1] not in '}]':
+        return False
+    try:
+        json.loads(text)
+    except ValueError:
+        return False
+    return True
+
+
+def check_code(spec: CompanionSpec, text: str) -> Optional[str]:
+    """Text that is mostly code, a stack trace, URLs, JSON or markup, with too little prose around it."""
+    stripped = text.strip()
+    if _is_json(stripped):
+        return 'json'
+    if _STACK_TRACE_RE.search(text):
+        return 'stack_trace'
+    min_words = max(_min_words(spec), 1)
+    prose = _FENCED_RE.sub(' ', text)
+    if prose != text and _words(_INLINE_CODE_RE.sub(' ', prose)) < min_words:
+        return 'code'
+    without_urls = _URL_RE.sub(' ', prose)
+    if without_urls != prose and _words(without_urls) < min_words:
+        return 'url'
+    if stripped.startswith('<') and stripped.endswith('>') and len(_TAG_RE.findall(stripped)) >= 2:
+        return 'markup'
+    lines = [line for line in stripped.splitlines() if line.strip()]
+    if len(lines) >= 3 and sum(1 for line in lines if _CODE_LINE_RE.search(line)) * 2 >= len(lines):
+        return 'code'
+    return None
+
+
+@functools.lru_cache(maxsize=4096)
+def _script(ch: str) -> Optional[str]:
+    """Unicode script of a letter, from the first word of its name (LATIN, CYRILLIC, CJK, ...)."""
+    if not ch.isalpha():
+        return None
+    try:
+        name = unicodedata.name(ch)
+    except ValueError:
+        return None
+    script = name.split(' ', 1)[0].lower()
+    return 'han' if script == 'cjk' else script
+
+
+def _scripts(spec: CompanionSpec) -> frozenset:
+    value = settings.companion_setting(spec.name, 'SCRIPTS', settings.COMPANION_PREFILTER_SCRIPTS)
+    return frozenset(s.strip().lower() for s in (value or '').split(',') if s.strip())
+
+
+def check_script(spec: CompanionSpec, text: str) -> Optional[str]:
+    """Text whose letters are mostly in scripts the companion is not for (SCRIPTS; unset = any).
+
+    An English grammar check or a translation from English sets 'latin': a
+    message already written in Cyrillic or kana gains nothing from it.
+    """
+    allowed = _scripts(spec)
+    if not allowed:
+        return None
+    letters = [script for script in map(_script, text) if script is not None]
+    if letters and sum(1 for script in letters if script in allowed) * 2 < len(letters):
+        return 'script'
+    return None
+
+
+class RecentOK:
+    """Bounded LRU set of texts a companion recently answered 'OK', per companion.
+
+    Texts match exactly unless normalize is set; then case, spacing and a
+    final period are ignored, which suits only prompts that ignore them too.
+    """
+
+    def __init__(self, max_entries: int, normalize: bool = False):
+        self.max_entries = max_entries
+        self.normalize = normalize
+        self._entries = collections.OrderedDict()  # (companion, text) -> None
+        self._lock = threading.Lock()
+
+    def _key(self, spec: CompanionSpec, text: str) -> Tuple[str, str]:
+        if self.normalize:
+            text = ' '.join(text.casefold().split()).rstrip('.')
+        return spec.name, text
+
+    def add(self, spec: CompanionSpec, text: str):
+        if self.max_entries <= 0:
+            return
+        key = self._key(spec, text)
+        with self._lock:
+            self._entries[key] = None
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def __contains__(self, item: Tuple[CompanionSpec, str]) -> bool:
+        key = self._key(*item)
+        with self._lock:
+            if key not in self._entries:
+                return False
+            self._entries.move_to_end(key)
+            return True
+
+
+recent_ok = RecentOK(settings.COMPANION_PREFILTER_RECENT_OK, settings.COMPANION_PREFILTER_RECENT_OK_NORMALIZE)
+
+
+def check_recent_ok(spec: CompanionSpec, text: str) -> Optional[str]:
+    """Text the companion recently answered 'OK' for (see RecentOK)."""
+    return RECENT_OK if (spec, text) in recent_ok else None
+
+
+def remember_result(spec: CompanionSpec, text: str, result: Optional[str]):
+    """Called with every companion result; an 'OK' makes text a recent_ok skip."""
+    if result is not None and result.strip() == 'OK':
+        recent_ok.add(spec, text)
+
+
+PREFILTERS: Dict[str, Callable[[CompanionSpec, str], Optional[str]]] = {
+    'length': check_length,
+    'code': check_code,
+    'script': check_script,
+    'recent_ok': check_recent_ok,
+}
+
+
+def register_prefilter(name: str, check: Callable[[CompanionSpec, str], Optional[str]]):
+    """Make check available to COMPANION_PREFILTERS under name."""
+    PREFILTERS[name] = check
+
+
+def _resolve(name: str) -> Callable[[CompanionSpec, str], Optional[str]]:
+    if name in PREFILTERS:
+        return PREFILTERS[name]
+    if ':' in name:
+        module, attr = name.split(':', 1)
+        return getattr(importlib.import_module(module), attr)
+    raise ValueError('Unknown companion prefilter %r' % name)
+
+
+_checks: Dict[str, List[Callable]] = {}
+
+
+def _checks_for(spec: CompanionSpec) -> List[Callable]:
+    checks = _checks.get(spec.name)
+    if checks is None:
+        names = settings.companion_setting(spec.name, 'PREFILTERS', settings.COMPANION_PREFILTERS)
+        checks = _checks[spec.name] = [_resolve(n.strip()) for n in names.split(',') if n.strip()]
+    return checks
+
+
+_stats: Dict[str, dict] = {}
+_stats_lock = threading.Lock()
+
+
+def prefilter(spec: CompanionSpec, text: str) -> Optional[str]:
+    """Why companion spec should not be called for text, or None to call it."""
+    reason = None
+    for check in _checks_for(spec):
+        try:
+            reason = check(spec, text)
+        except Exception:
+            # A broken check must not cost the companion output
+            logger.exception('Companion prefilter %r failed', check)
+            reason = None
+        if reason:
+            break
+    with _stats_lock:
+        stats = _stats.setdefault(spec.name, {'checked': 0, 'skipped': 0, 'reasons': {}})
+        stats['checked'] += 1
+        if reason:
+            stats['skipped'] += 1
+            stats['reasons'][reason] = stats['reasons'].get(reason, 0) + 1
+    companion_prefilter_total.labels(spec.name, reason or 'pass').inc()
+    return reason or None
+
+
+def prefilter_stats() -> dict:
+    """Decisions per companion, with the share of texts skipped."""
+    with _stats_lock:
+        return {name: dict(stats, reasons=dict(stats['reasons']),
+                           skip_rate=round(stats['skipped'] / stats['checked'], 3) if stats['checked'] else 0.0)
+                for name, stats in _stats.items()}
@@ -0,0 +1,48 @@
+import re
+from typing import List, Optional
+
+_PARAGRAPH_RE = re.compile(r'\n\s*\n')
+_SENTENCE_END_RE = re.compile(r'(?<=[.!?…])\s+')
+
+
+def split_segments(text: str, max_chars: int) -> List[str]:
+    """Split text into paragraphs, further splitting paragraphs longer than
+    max_chars into runs of whole sentences.
+
+    Segments follow paragraph boundaries so that editing one paragraph of a
+    resent message leaves the other segments (and their cached results)
+    unchanged.
+    """
+    segments = []
+    for para in _PARAGRAPH_RE.split(text):
+        para = para.strip()
+        if not para:
+            continue
+        if len(para) <= max_chars:
+            segments.append(para)
+            continue
+        current = ''
+        for sentence in _SENTENCE_END_RE.split(para):
+            if current and len(current) + 1 + len(sentence) > max_chars:
+                segments.append(current)
+                current = sentence
+            else:
+                current = current + ' ' + sentence if current else sentence
+        if current:
+            segments.append(current)
+    return segments
+
+
+def merge_segment_results(results: List[Optional[str]]) -> Optional[str]:
+    """Merge per-segment companion outputs into one block.
+
+    'OK' answers are dropped, so a message whose segments are all fine
+    collapses to a single 'OK'. Returns None if any segment failed, since a
+    partial check would misreport the missing segments as fine.
+    """
+    if any(r is None for r in results):
+        return None
+    changed = [r.strip() for r in results if r.strip() != 'OK']
+    if not changed:
+        return 'OK'
+    return '\n\n'.join(changed)
@@ -1,37 +1,90 @@
+import contextlib
 import json
-import threading
 import logging
+import signal
+import threading
 from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
-from urllib.parse import urlparse
+from urllib.parse import urlparse, parse_qs
 import requests
 import time
 from typing import Optional
-import os
 import socket
 
 from config import settings
-from utils.logger import setup_logger
-from .companion_builder import extract_last_user_message, build_companion_prompt
-from .companion_processor import call_companion_model
-
-logger = setup_logger(settings.LOG_LEVEL)
-
-COMPANION_SEPARATOR = '\n⸻✎⸻\n'
+from utils.logger import setup_logger, log_stats
+from .admission import ADMITTED, request_limiter, admission_stats, record_rejection, overload_response
+from .async_upstream import async_pool_stats
+from .capture import capture_enabled, capture_request, capture_stats
+from .circuit_breaker import breaker_stats
+from .chat_completions import (
+    INITIAL_ROLE_CHUNK, DONE_CHUNK, strip_companion_history, mask_headers,
+    build_upstream_headers, extract_text_from_response_json, merge_companion_text, companion_chunk,
+    RELAY_DONE, RELAY_FINISH, iter_relay_segments,
+)
+from .companion_builder import extract_last_user_message
+from .companion_cache import companion_cache
+from .companion_processor import (
+    submit_companion_call, companion_trace_mark, warm_companion_cache, segment_stats, call_stats, companion_deadline,
+    release_companion, companion_latency, batch_stats, usage_stats,
+)
+from .companion_store import companion_store
+from .companion_stream import CompanionStream
+from .deadline import Deadline
+from .disconnect import get_disconnect_watcher, record_disconnect, disconnect_stats
+from .metrics import (
+    CONTENT_TYPE as METRICS_CONTENT_TYPE, render_metrics, requests_total, upstream_ttfb_seconds, main_stream_seconds,
+    companion_wait_seconds, relayed_bytes_total, active_streams,
+)
+from .prefilter import prefilter_stats
+from .singleflight import request_key, join_main_stream, coalesce_stats
+from .sse import iter_sse_chunks
+from .tracing import start_trace, finish_trace, recent_traces, trace_limit, bind_trace, unbind_trace
+from .upstream import get_upstream_client
+
+logger = setup_logger(settings.LOG_LEVEL, settings.LOG_FORMAT, settings.LOG_QUEUE_SIZE, settings.LOG_DEBUG_SAMPLE,
+                      settings.LOG_RATE_LIMIT)
+
+
+def get_stats() -> dict:
+    """Counters served on GET /stats by both server engines."""
+    return {
+        'upstream_pool': get_upstream_client().stats(),
+        'async_upstream_pool': async_pool_stats(),
+        'companion_cache': companion_cache.stats(),
+        'companion_store': companion_store.stats() if companion_store is not None else None,
+        'companion_calls': call_stats(),
+        'companion_latency': companion_latency.stats(),
+        'companion_segments': segment_stats(),
+        'companion_batches': batch_stats(),
+        'companion_usage': usage_stats(),
+        'logging': log_stats(),
+        'disconnects': disconnect_stats(),
+        'admission': admission_stats(),
+        'companion_breakers': breaker_stats(),
+        'coalescing': coalesce_stats(),
+        'companion_prefilter': prefilter_stats(),
+        'capture': capture_stats(),
+    }
+
+
+def _abort_upstream(resp: requests.Response) -> bool:
+    """Shut down the socket under a streaming response so a read blocked on it returns."""
+    conn = getattr(resp.raw, 'connection', None)
+    sock = getattr(conn, 'sock', None)
+    if sock is None:
+        return False
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except OSError:
+        return False
+    return True
 
 
-def _extract_text_from_response_json(data: dict) -> Optional[str]:
-    """Extract text content from OpenAI/OpenRouter response format."""
-    try:
-        if 'choices' in data and data['choices']:
-            choice = data['choices'][0]
-            if 'message' in choice and isinstance(choice['message'], dict):
-                return choice['message'].get('content')
-            if 'text' in choice:
-                return choice['text']
-        return data.get('text')
-    except Exception:
-        logger.exception('Error extracting text from response')
-    return None
+def _wait_companion(companion: Optional[CompanionStream], timeout: float) -> Optional[str]:
+    """Wait up to timeout for the companion result; None if it is missing, failed or late."""
+    if companion is None:
+        return None
+    return companion.wait(timeout)
 
 
 class ProxyHandler(BaseHTTPRequestHandler):
@@ -48,12 +101,97 @@ class ProxyHandler(BaseHTTPRequestHandler):
             logger.exception('Failed to parse JSON body')
             return None
 
+    def log_message(self, format, *args):
+        # Access log lines go through the proxy logger (and its writer thread) rather than straight to stderr
+        logger.info('%s - %s', self.address_string(), format % args)
+
     def handle(self):
         try:
             super().handle()
         except ConnectionResetError:
             pass  # Client disconnected between requests - that's fine
 
+    def _send_json(self, status: int, obj):
+        out = json.dumps(obj).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(out)))
+        self.end_headers()
+        self.wfile.write(out)
+
+    def _send_companion_chunk(self, companion_text: str, first: bool = True) -> bool:
+        s_chunk = companion_chunk(companion_text, first)
+        try:
+            self.request.sendall(s_chunk)
+            logger.debug('WROTE companion chunk to client (len=%d)', len(s_chunk))
+            return True
+        except Exception as e:
+            logger.exception('Failed to send companion chunk: %s', e)
+            return False
+
+    def _relay_companion(self, companion: Optional[CompanionStream], offset: int, deadline: Deadline) -> int:
+        """Send companion text past offset as it arrives; returns the new offset.
+
+        Waits for companion output to start until the request's wait deadline,
+        but once it has started relays it to the end (bounded by the hard
+        deadline) instead of cutting the answer off mid-sentence.
+        """
+        if companion is None:
+            return offset
+        while True:
+            budget = deadline.hard_remaining() if offset else deadline.wait_remaining()
+            start = time.perf_counter()
+            text, done = companion.read(offset, budget)
+            self.companion_wait += time.perf_counter() - start
+            if text:
+                if offset == 0:
+                    logger.debug('Sending companion chunk')
+                    self.trace.mark('companion_output_start')
+                if not self._send_companion_chunk(text, first=offset == 0):
+                    return offset
+                offset += len(text)
+            if done or not text:
+                return offset
+
+    def _await_companion(self, companion: Optional[CompanionStream], timeout: float) -> Optional[str]:
+        start = time.perf_counter()
+        try:
+            return _wait_companion(companion, timeout)
+        finally:
+            self.companion_wait += time.perf_counter() - start
+            self.trace.mark('companion_wait_end')
+
+    def do_GET(self):
+        parsed = urlparse(self.path)
+        if parsed.path == '/stats':
+            self._send_json(200, get_stats())
+            return
+        if parsed.path == '/metrics':
+            out = render_metrics()
+            self.send_response(200)
+            self.send_header('Content-Type', METRICS_CONTENT_TYPE)
+            self.send_header('Content-Length', str(len(out)))
+            self.end_headers()
+            self.wfile.write(out)
+            return
+        if parsed.path == '/traces':
+            # Timelines reveal request timing and models; only serve them to local clients
+            if self.client_address[0] not in ('127.0.0.1', '::1'):
+                self._send_json(403, {'error': 'traces are only available locally'})
+                return
+            query = parse_qs(parsed.query)
+            try:
+                limit = trace_limit(query)
+            except ValueError:
+                self._send_json(400, {'error': 'limit must be a non-negative integer'})
+                return
+            self._send_json(200, recent_traces(slow=query.get('slow', ['0'])[0] == '1', limit=limit))
+            return
+        self.send_response(404)
+        self.send_header('Content-Length', '9')
+        self.end_headers()
+        self.wfile.write(b'Not Found')
+
     def do_POST(self):
         parsed = urlparse(self.path)
         if parsed.path != '/v1/chat/completions':
@@ -62,35 +200,238 @@ class ProxyHandler(BaseHTTPRequestHandler):
             self.wfile.write(b'Not Found')
             return
 
+        self.trace = start_trace(engine='threading')
+        token = bind_trace(self.trace, 'main')
+        # Replay timings, kept only when this request is captured
+        self.capture = capture_enabled()
+        self.arrived, self.started = time.time(), time.perf_counter()
+        self.chunk_times = [] if self.capture else None
+        self.req_json = None
+        self.status = None
+        self.companion_mark = None
+        self.companion_wait = 0.0
+        # State shared with the disconnect watcher thread
+        self._gone_lock = threading.Lock()
+        self._watcher = None
+        self.client_gone = False
+        self.companion = None
+        self.deadline = None
+        self.upstream_resp = None
+        self.main_sub = None
+        try:
+            outcome = request_limiter.acquire(settings.REQUEST_QUEUE_TIMEOUT)
+            if outcome != ADMITTED:
+                self._reject(outcome)
+                return
+            self.trace.mark('admitted')
+            try:
+                self._chat_completions()
+            finally:
+                request_limiter.release()
+        finally:
+            self._stop_watching()
+            unbind_trace(token)
+            finish_trace(self.trace)
+            if self.capture and self.req_json is not None:
+                capture_request(self.req_json, self.headers.get('Authorization'), 'threading', self.arrived,
+                                self.started, self.status, self.chunk_times, self.companion_mark,
+                                self.companion_wait, self.trace)
+
+    def send_response(self, code, message=None):
+        self.status = code
+        super().send_response(code, message)
+
+    def _reject(self, outcome: str):
+        """Answer a request admission control turned away, without reading more than its body."""
+        record_rejection(outcome)
+        self.trace.mark(outcome)
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        status, body = overload_response(outcome)
+        out = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(out)))
+        self.send_header('Retry-After', str(settings.OVERLOAD_RETRY_AFTER))
+        self.end_headers()
+        self.wfile.write(out)
+        logger.warning('Rejected request: %s', outcome)
+
+    def _stop_watching(self):
+        # Called before the last bytes of a response: a client closing after them is not a disconnect
+        if self._watcher is not None:
+            self._watcher.unwatch(self.request)
+            with self._gone_lock:
+                self._watcher = None
+
+    def _on_client_gone(self):
+        """Runs on the watcher thread when the client closes its connection mid-request."""
+        with self._gone_lock:
+            if self._watcher is None:
+                return
+            self.client_gone = True
+            main_aborted = self.upstream_resp is not None and _abort_upstream(self.upstream_resp)
+        if self.main_sub is not None:
+            # Stops a shared main stream only if this was the last request relaying it
+            main_aborted = self.main_sub.leave() or main_aborted
+        budget = self.deadline.hard_remaining() if self.deadline is not None else 0.0
+        companion_cancelled = release_companion(self.companion, client_gone=True)
+        record_disconnect(main_aborted, companion_cancelled, budget)
+        self.trace.mark('client_disconnected')
+        logger.info('Client disconnected mid-request; cancelled upstream stream: %s, companion call: %s',
+                    main_aborted, companion_cancelled)
+
+    @contextlib.contextmanager
+    def _tracked_upstream(self, resp: requests.Response):
+        """Make a streaming upstream response abortable by the disconnect watcher while in use."""
+        with self._gone_lock:
+            self.upstream_resp = resp
+            if self.client_gone:
+                _abort_upstream(resp)
+        try:
+            yield resp
+        finally:
+            # Detach before the connection can go back to the pool; a shared stream is closed by its flight
+            with self._gone_lock:
+                owned = self.upstream_resp is resp
+                self.upstream_resp = None
+            if owned:
+                resp.close()
+
+    def _relay_sse(self, chunks, companion: Optional[CompanionStream], deadline: Deadline):
+        """Relay the main stream's SSE chunks to the client, with companion output before finish_reason."""
+        trace = self.trace
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Connection', 'keep-alive')
+        self.end_headers()
+        self.streaming = True
+        active_streams.inc()
+        stream_start = time.perf_counter()
+
+        # Send initial assistant role delta so clients start rendering incremental content
+        try:
+            self.request.sendall(INITIAL_ROLE_CHUNK)
+            logger.debug('WROTE initial assistant role chunk')
+        except Exception:
+            logger.exception('Failed to write initial role chunk')
+
+        companion_offset = 0  # How much companion text has been sent
+        first_chunk = True
+        chunk_times = self.chunk_times
+
+        # Forward upstream bytes as they arrive; only finish_reason and [DONE] are handled
+        try:
+            for kind, out in iter_relay_segments(chunks, settings.STREAM_RELAY_MODE):
+                if chunk_times is not None:
+                    chunk_times.append(time.perf_counter())
+                if first_chunk:
+                    trace.mark('upstream_first_chunk')
+                    first_chunk = False
+                if kind == RELAY_DONE:
+                    trace.mark('upstream_done')
+                    # Stream companion output as it arrives
+                    companion_offset = self._relay_companion(companion, companion_offset, deadline)
+                    self._stop_watching()
+                    # Now send DONE
+                    try:
+                        self.request.sendall(out)
+                        self.relayed_bytes += len(out)
+                        logger.debug('WROTE DONE chunk to client (len=%d)', len(out))
+                    except BrokenPipeError:
+                        # this is probably fine, some clients disconnect
+                        # after finish_reason 'done'
+                        logger.info('Client disconnected before DONE')
+                        return
+                    except Exception as e:
+                        logger.exception('Failed to send DONE chunk: %s', e)
+                    break
+                if kind == RELAY_FINISH:
+                    # This is the finish_reason chunk - don't send it yet
+                    # Stream companion content as it arrives first, then finish_reason
+                    trace.mark('finish_reason_held')
+                    companion_offset = self._relay_companion(companion, companion_offset, deadline)
+                    trace.mark('finish_reason_sent')
+                    # Now send the finish_reason chunk
+                    try:
+                        self.request.sendall(out)
+                        self.relayed_bytes += len(out)
+                        logger.debug('WROTE finish_reason chunk to client (len=%d)', len(out))
+                    except BrokenPipeError:
+                        logger.warning('Client disconnected while streaming')
+                        return
+                    except Exception:
+                        logger.exception('Error writing finish_reason chunk to client (socket sendall)')
+                        return
+                else:
+                    # Send normal chunks unchanged
+                    try:
+                        self.request.sendall(out)
+                        self.relayed_bytes += len(out)
+                        logger.debug('WROTE chunk to client (len=%d)', len(out))
+                    except BrokenPipeError:
+                        logger.warning('Client disconnected while streaming')
+                        return
+                    except Exception:
+                        logger.exception('Error writing chunk to client (socket sendall)')
+                        return
+        except Exception:
+            if not self.client_gone:
+                logger.exception('Error reading from upstream stream')
+        # Relay time excluding the time the finish_reason chunk was held for the companion
+        main_stream_seconds.observe(time.perf_counter() - stream_start - self.companion_wait)
+        trace.mark('main_stream_end')
+        if self.client_gone:
+            return
+
+        # Main stream finished
+        # Relay whatever companion output is still to come within the deadline
+        logger.debug('About to wait for companion result')
+        companion_offset = self._relay_companion(companion, companion_offset, deadline)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('Companion result: %r', _wait_companion(companion, 0))
+
+        # send DONE event
+        self._stop_watching()
+        try:
+            self.wfile.write(DONE_CHUNK)
+            self.wfile.flush()
+        except BrokenPipeError:
+            logger.info('Client disconnected after DONE')
+
+    def _chat_completions(self):
+        trace = self.trace
         req_json = self._read_json_body()
+        trace.mark('body_read')
         if req_json is None:
             self.send_response(400)
             self.end_headers()
             self.wfile.write(b'Bad Request')
             return
 
-        # Strip companion responses from conversation history so the main model
-        # doesn't see (and mimic) prior grammar-check outputs.
-        for msg in req_json.get('messages') or []:
-            if msg.get('role') == 'assistant' and isinstance(msg.get('content'), str):
-                sep_idx = msg['content'].find(COMPANION_SEPARATOR)
-                if sep_idx != -1:
-                    msg['content'] = msg['content'][:sep_idx]
+        watcher = get_disconnect_watcher()
+        if watcher is not None:
+            with self._gone_lock:
+                self._watcher = watcher
+            watcher.watch(self.request, self._on_client_gone)
+
+        strip_companion_history(req_json)
+        self.req_json = req_json
 
         logger.info('Incoming request for chat.completions')
-        # Log headers but mask sensitive ones
-        headers_copy = dict(self.headers)
-        if 'Authorization' in headers_copy:
-            headers_copy['Authorization'] = headers_copy['Authorization'][:20] + '...' if len(headers_copy['Authorization']) > 20 else '***masked***'
-        logger.info('Incoming headers: %s', headers_copy)
+        if logger.isEnabledFor(logging.DEBUG):
+            # Log headers but mask sensitive ones
+            logger.debug('Incoming headers: %s', mask_headers(self.headers))
 
         # Normalize stream flag
         stream = bool(req_json.get('stream', False))
-        logger.info('Stream flag: %s', stream)
+        logger.debug('Stream flag: %s', stream)
+        requests_total.labels('stream' if stream else 'json').inc()
+        trace.set('stream', stream)
 
         # Log the model being used for this request if specified
         if 'model' in req_json:
-            logger.info('Model used for request: %s', req_json['model'])
+            logger.debug('Model used for request: %s', req_json['model'])
 
         # Disable Nagle (send small packets immediately) on the client socket to reduce buffering
         try:
@@ -98,7 +439,7 @@ class ProxyHandler(BaseHTTPRequestHandler):
         except Exception:
             logger.exception('Failed to set TCP_NODELAY on client socket')
 
-        # Start companion processing in a background thread
+        # Start companion processing on the shared companion event loop
         user_text = ''
         messages = req_json.get('messages') or []
         try:
@@ -106,58 +447,55 @@ class ProxyHandler(BaseHTTPRequestHandler):
         except Exception:
             logger.exception('Failed to extract last user message')
             user_text = ''
-
-        companion_prompt = build_companion_prompt(user_text) if user_text else ''
-        if companion_prompt:
-            logger.info('Companion prompt to be sent: %s', companion_prompt)
-        companion_result_holder = {'text': None}
-
-        def companion_runner():
-            try:
-                if companion_prompt:
-                    logger.info('Starting companion processing task')
-                    # call_companion_model is async; run it in a new event loop
-                    import asyncio
-                    auth_header = self.headers.get('Authorization')
-                    model = req_json.get('model', 'openai/gpt-4o')
-                    processed = asyncio.run(call_companion_model(companion_prompt, auth_header, model))
-                    companion_result_holder['text'] = processed
-                    logger.info('Companion processing finished')
-            except Exception:
-                logger.exception('Companion processing runner failed')
-                companion_result_holder['text'] = None
-
-        companion_thread = threading.Thread(target=companion_runner, daemon=True)
-        companion_thread.start()
-
-        # Build headers to forward to upstream: preserve useful client headers but override content-type
-        main_headers = {}
-        for h in ('Accept', 'User-Agent', 'Connection', 'Authorization'):
-            v = self.headers.get(h)
-            if v:
-                main_headers[h] = v
-        # Force no compression so clients can stream incrementally
-        main_headers['Accept-Encoding'] = 'identity'
-        # Ensure JSON content-type
-        main_headers['Content-Type'] = 'application/json'
-        # Log headers but mask sensitive ones
-        headers_copy = dict(main_headers)
-        if 'Authorization' in headers_copy:
-            headers_copy['Authorization'] = headers_copy['Authorization'][:20] + '...' if len(headers_copy['Authorization']) > 20 else '***masked***'
-        logger.info('Forwarding headers to upstream: %s', headers_copy)
+        trace.mark('user_message_extracted')
+
+        model = req_json.get('model', 'openai/gpt-4o')
+        trace.set('model', model)
+        deadline = self.deadline = companion_deadline(model)
+        flight_key = None
+        if settings.COALESCE_COMPANIONS or settings.COALESCE_MAIN_STREAMS:
+            flight_key = request_key(req_json, self.headers.get('Authorization'))
+        companion = None
+        if user_text:
+            logger.debug('Starting companion processing task')
+            companion = self.companion = submit_companion_call(
+                user_text, self.headers.get('Authorization'), model, deadline, trace,
+                flight_key if settings.COALESCE_COMPANIONS else None)
+            self.companion_mark = companion_trace_mark(companion)
+            trace.mark(self.companion_mark)
+
+        main_headers = build_upstream_headers(self.headers)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('Forwarding headers to upstream: %s', mask_headers(main_headers))
 
         main_url = settings.API_BASE + '/v1/chat/completions'
 
+        self.companion_wait = 0.0  # seconds this response spent blocked on the companion
+        self.relayed_bytes = 0
+        self.streaming = False
         try:
-            # Use a session that does not inherit environment proxy settings
-            s = requests.Session()
-            s.trust_env = False
+            # Shared keep-alive client; does not inherit environment proxy settings
+            s = get_upstream_client()
+
+            if stream and settings.COALESCE_MAIN_STREAMS:
+                self.main_sub = join_main_stream(flight_key)
+                if not self.main_sub.leader:
+                    if self.main_sub.wait_started(60):
+                        trace.mark('main_stream_joined')
+                        self._relay_sse(self.main_sub.chunks(), companion, deadline)
+                        return
+                    # The identical request did not stream: send this one upstream itself
+                    self.main_sub.fall_back()
+                    self.main_sub = None
 
             if stream:
                 # Stream main provider and proxy chunks
                 # open upstream response as a stream and inspect its headers to confirm streaming
-                with s.post(main_url, headers=main_headers, json=req_json, stream=True, timeout=60) as resp:
-                    logger.info('Upstream responded: status=%s content-type=%s', resp.status_code, resp.headers.get('Content-Type'))
+                with self._tracked_upstream(s.post(main_url, headers=main_headers, json=req_json, stream=True,
+                                                   timeout=60)) as resp:
+                    upstream_ttfb_seconds.labels('main').observe(resp.elapsed.total_seconds())
+                    trace.mark('upstream_headers')
+                    logger.debug('Upstream responded: status=%s content-type=%s', resp.status_code, resp.headers.get('Content-Type'))
                     if resp.status_code != 200:
                         try:
                             body_preview = resp.text
@@ -167,6 +505,9 @@ class ProxyHandler(BaseHTTPRequestHandler):
                     # If upstream returned a non-streaming JSON payload, handle it with non-streaming path
                     ctype = (resp.headers.get('Content-Type') or '').lower()
                     if resp.status_code != 200 or 'application/json' in ctype:
+                        if self.main_sub is not None:
+                            # Identical requests waiting on this one send their own
+                            self.main_sub.leave()
                         try:
                             data = resp.json()
                         except Exception:
@@ -178,221 +519,32 @@ class ProxyHandler(BaseHTTPRequestHandler):
 
                         # If upstream returned an error, return it directly without companion processing
                         if resp.status_code >= 400:
-                            out = json.dumps(data).encode('utf-8')
-                            self.send_response(resp.status_code)
-                            self.send_header('Content-Type', 'application/json')
-                            self.send_header('Content-Length', str(len(out)))
-                            self.end_headers()
-                            self.wfile.write(out)
+                            self._send_json(resp.status_code, data)
                             return
 
-                        main_text = _extract_text_from_response_json(data) or ''
-
-                        # Wait briefly for companion task to finish
-                        companion_thread.join(timeout=5)
-                        companion_text = companion_result_holder.get('text')
-                        if companion_text:
-                            combined = main_text + COMPANION_SEPARATOR + companion_text
-                        else:
-                            combined = main_text
-
-                        if 'choices' in data and data['choices']:
-                            first = data['choices'][0]
-                            if 'message' in first and isinstance(first['message'], dict):
-                                first['message']['content'] = combined
-                            elif 'text' in first:
-                                first['text'] = combined
-                            else:
-                                first['message'] = {'role': 'assistant', 'content': combined}
-                            data['choices'][0] = first
-                        else:
-                            data = {'choices': [{'message': {'role': 'assistant', 'content': combined}}]}
-
-                        out = json.dumps(data).encode('utf-8')
-                        self.send_response(200)
-                        self.send_header('Content-Type', 'application/json')
-                        self.send_header('Content-Length', str(len(out)))
-                        self.end_headers()
-                        self.wfile.write(out)
-                        return
-                    # else: proceed with streaming handling (existing code)
-                    logger.info('Main provider responded with status %s', resp.status_code)
-                    self.send_response(200)
-                    self.send_header('Content-Type', 'text/event-stream')
-                    self.send_header('Cache-Control', 'no-cache')
-                    self.send_header('Connection', 'keep-alive')
-                    self.end_headers()
-
-                    # Send initial assistant role delta so clients start rendering incremental content
-                    try:
-                        init_role = 'data: ' + json.dumps({'choices': [{'delta': {'role': 'assistant'}}]}) + '\n\n'
-                        self.request.sendall(init_role.encode('utf-8'))
-                        logger.info('WROTE initial assistant role chunk')
-                    except Exception:
-                        logger.exception('Failed to write initial role chunk')
-
-                    main_text_parts = []
-                    companion_sent = False  # Track if companion text has been sent
-
-                    # Read from raw stream incrementally to avoid buffering
-                    buffer = b''
-                    while True:
-                        try:
-                            chunk = resp.raw.read(1)  # Read byte by byte
-                            if not chunk:
-                                break
-                            buffer += chunk
-
-                            # Check if we have a complete SSE line (ends with \n\n)
-                            if buffer.endswith(b'\n\n'):
-                                line = buffer.decode('utf-8').strip()
-                                buffer = b''  # Reset buffer
-
-                                if not line:
-                                    continue
-
-                                # Log and write line through to client (preserve exact line format)
-                                preview = (line[:120] + '...') if len(line) > 120 else line
-                                logger.debug('Writing chunk to client: %s', preview)
-
-                                if line == 'data: [DONE]':
-                                    # Wait for companion
-                                    companion_thread.join(timeout=5)
-                                    companion_text = companion_result_holder.get('text')
-                                    if companion_text and not companion_sent:
-                                        logger.info('Sending companion chunk before DONE')
-                                        appended = COMPANION_SEPARATOR + companion_text
-                                        synthetic = {'choices': [{'delta': {'content': appended}}]}
-                                        s_chunk = 'data: ' + json.dumps(synthetic) + '\n\n'
-                                        try:
-                                            self.request.sendall(s_chunk.encode('utf-8'))
-                                            logger.debug('WROTE companion chunk to client (len=%d)', len(s_chunk))
-                                            companion_sent = True
-                                        except Exception as e:
-                                            logger.exception('Failed to send companion chunk: %s', e)
-                                    # Now send DONE
-                                    out = (line + '\n\n').encode('utf-8')
-                                    try:
-                                        self.request.sendall(out)
-                                        logger.debug('WROTE DONE chunk to client (len=%d)', len(out))
-                                    except BrokenPipeError:
-                                        # this is probably fine, some clients disconnect
-                                        # after finish_reason 'done'
-                                        logger.info('Client disconnected before DONE')
-                                        return
-                                    except Exception as e:
-                                        logger.exception('Failed to send DONE chunk: %s', e)
-                                    break
-                                else:
-                                    # Check if this chunk contains finish_reason
-                                    finish_reason_chunk = None
-                                    payload = line
-                                    if payload.startswith('data: '):
-                                        payload = payload[len('data: '):]
-                                    try:
-                                        obj = json.loads(payload)
-                                        if 'choices' in obj and obj['choices']:
-                                            choice = obj['choices'][0]
-                                            if choice.get('finish_reason'):
-                                                finish_reason_chunk = line
-                                    except Exception:
-                                        pass
-
-                                    if finish_reason_chunk:
-                                        # This is the finish_reason chunk - don't send it yet
-                                        # Wait for companion and send companion content first, then finish_reason
-                                        companion_thread.join(timeout=5)
-                                        companion_text = companion_result_holder.get('text')
-                                        if companion_text and not companion_sent:
-                                            logger.info('Sending companion chunk before finish_reason')
-                                            appended = COMPANION_SEPARATOR + companion_text
-                                            synthetic = {'choices': [{'delta': {'content': appended}}]}
-                                            s_chunk = 'data: ' + json.dumps(synthetic) + '\n\n'
-                                            try:
-                                                self.request.sendall(s_chunk.encode('utf-8'))
-                                                logger.debug('WROTE companion chunk to client (len=%d)', len(s_chunk))
-                                                companion_sent = True
-                                            except Exception as e:
-                                                logger.exception('Failed to send companion chunk: %s', e)
-                                        # Now send the finish_reason chunk
-                                        out = (finish_reason_chunk + '\n\n').encode('utf-8')
-                                        try:
-                                            self.request.sendall(out)
-                                            logger.debug('WROTE finish_reason chunk to client (len=%d) ts=%f', len(out), time.time())
-                                        except BrokenPipeError:
-                                            logger.warning('Client disconnected while streaming')
-                                            return
-                                        except Exception:
-                                            logger.exception('Error writing finish_reason chunk to client (socket sendall)')
-                                            return
-                                    else:
-                                        # Send normal chunks
-                                        out = (line + '\n\n').encode('utf-8')
-                                        try:
-                                            self.request.sendall(out)
-                                            logger.debug('WROTE chunk to client (len=%d) ts=%f', len(out), time.time())
-                                        except BrokenPipeError:
-                                            logger.warning('Client disconnected while streaming')
-                                            return
-                                        except Exception:
-                                            logger.exception('Error writing chunk to client (socket sendall)')
-                                            return
-
-                                # Try to parse JSON after removing possible 'data: ' prefix
-                                payload = line
-                                if payload.startswith('data: '):
-                                    payload = payload[len('data: '):]
-                                try:
-                                    obj = json.loads(payload)
-                                    # extract any delta content from choices
-                                    if 'choices' in obj:
-                                        for c in obj['choices']:
-                                            delta = c.get('delta') or {}
-                                            content = delta.get('content')
-                                            if content:
-                                                main_text_parts.append(content)
-                                except Exception:
-                                    # Not JSON or unexpected format; append raw
-                                    main_text_parts.append(line)
-                        except Exception:
-                            logger.exception('Error reading from upstream stream')
-                            break
-
-                    # Main stream finished
-                    main_text = ''.join(main_text_parts)
-
-                    # Wait briefly for companion task to finish (non-blocking long wait)
-                    logger.info('About to join companion thread')
-                    companion_thread.join(timeout=2)
-                    companion_text = companion_result_holder.get('text')
-                    logger.info('Companion result: %r', companion_text)
-                    logger.info('About to check if companion_text: type=%s, len=%s', type(companion_text), len(companion_text) if companion_text else 'N/A')
-
-                    if companion_text and not companion_sent:
-                        logger.info('Sending companion chunk, companion_text is truthy: %r', bool(companion_text))
-                        appended = COMPANION_SEPARATOR + companion_text
-                        # send a synthetic chunk in OpenAI streaming format
-                        synthetic = {'choices': [{'delta': {'content': appended}}]}
-                        s_chunk = 'data: ' + json.dumps(synthetic) + '\n\n'
-                        logger.info('Companion chunk content: %r', s_chunk[:200])
-                        try:
-                            self.request.sendall(s_chunk.encode('utf-8'))
-                            logger.info('WROTE companion chunk to client (len=%d)', len(s_chunk))
-                        except Exception as e:
-                            logger.exception('Failed to send companion chunk: %s', e)
-
-                    # send DONE event
-                    try:
-                        done = 'data: [DONE]\n\n'
-                        self.wfile.write(done.encode('utf-8'))
-                        self.wfile.flush()
-                    except BrokenPipeError:
-                        logger.info('Client disconnected after DONE')
+                        main_text = extract_text_from_response_json(data) or ''
 
+                        # Wait for the companion until the request's wait deadline
+                        companion_text = self._await_companion(companion, deadline.wait_remaining())
+                        self._stop_watching()
+                        self._send_json(200, merge_companion_text(data, main_text, companion_text))
+                        return
+                    logger.debug('Main provider responded with status %s', resp.status_code)
+                    chunks = iter_sse_chunks(resp)
+                    if self.main_sub is not None:
+                        with self._gone_lock:
+                            if not self.client_gone and self.main_sub.flight.start(
+                                    chunks, lambda: _abort_upstream(resp), resp.close):
+                                # The flight closes the stream once no identical request is reading it
+                                self.upstream_resp = None
+                                chunks = self.main_sub.chunks()
+                    self._relay_sse(chunks, companion, deadline)
                 return
             else:
                 # Non-streaming: wait for full main response
                 resp = s.post(main_url, headers=main_headers, json=req_json, timeout=60)
+                upstream_ttfb_seconds.labels('main').observe(resp.elapsed.total_seconds())
+                trace.mark('upstream_response')
                 if resp.status_code >= 400:
                     try:
                         body_preview = resp.text
@@ -401,40 +553,18 @@ class ProxyHandler(BaseHTTPRequestHandler):
                     logger.error('Main provider returned HTTP %s: %s', resp.status_code, body_preview)
                 resp.raise_for_status()
                 data = resp.json()
-                main_text = _extract_text_from_response_json(data) or ''
-
-                # Wait for companion thread to finish but cap wait
-                companion_thread.join(timeout=5)
-                companion_text = companion_result_holder.get('text')
-
-                if companion_text:
-                    combined = main_text + COMPANION_SEPARATOR + companion_text
-                else:
-                    combined = main_text
-
-                # Try to preserve original response structure but replace the message content
-                if 'choices' in data and data['choices']:
-                    first = data['choices'][0]
-                    if 'message' in first and isinstance(first['message'], dict):
-                        first['message']['content'] = combined
-                    elif 'text' in first:
-                        first['text'] = combined
-                    else:
-                        # fallback: add message
-                        first['message'] = {'role': 'assistant', 'content': combined}
-                    data['choices'][0] = first
-                else:
-                    data['choices'] = [{'message': {'role': 'assistant', 'content': combined}}]
-
-                out = json.dumps(data).encode('utf-8')
-                self.send_response(200)
-                self.send_header('Content-Type', 'application/json')
-                self.send_header('Content-Length', str(len(out)))
-                self.end_headers()
-                self.wfile.write(out)
+                main_text = extract_text_from_response_json(data) or ''
+
+                # Wait for the companion until the request's wait deadline
+                if self.client_gone:
+                    return
+                companion_text = self._await_companion(companion, deadline.wait_remaining())
+                self._stop_watching()
+                self._send_json(200, merge_companion_text(data, main_text, companion_text))
                 return
 
         except requests.RequestException as e:
+            trace.set('error', type(e).__name__)
             logger.exception('Request to main provider failed: %s', e)
             # If main request fails, return 502
             self.send_response(502)
@@ -442,19 +572,74 @@ class ProxyHandler(BaseHTTPRequestHandler):
             self.wfile.write(b'Main provider error')
             return
         except Exception as e:
+            trace.set('error', type(e).__name__)
             logger.exception('Unexpected server error: %s', e)
             self.send_response(500)
             self.end_headers()
             self.wfile.write(b'Internal Server Error')
             return
+        finally:
+            release_companion(companion, client_gone=self.client_gone)
+            if self.main_sub is not None:
+                self.main_sub.leave()
+            if self.streaming:
+                active_streams.dec()
+                relayed_bytes_total.inc(self.relayed_bytes)
+            if companion is not None:
+                companion_wait_seconds.observe(self.companion_wait)
+
+
+class ProxyHTTPServer(ThreadingHTTPServer):
+    """ThreadingHTTPServer that can share its port with other workers and drain in-flight connections."""
+
+    # socketserver's default listen backlog of 5 resets connections under bursts of concurrent clients
+    request_queue_size = 1024
+
+    def __init__(self, server_address, handler_class, reuse_port: bool = False):
+        self.reuse_port = reuse_port
+        self._active = 0
+        self._active_cond = threading.Condition()
+        super().__init__(server_address, handler_class)
+
+    def server_bind(self):
+        if self.reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        super().server_bind()
+
+    def process_request_thread(self, request, client_address):
+        with self._active_cond:
+            self._active += 1
+        try:
+            super().process_request_thread(request, client_address)
+        finally:
+            with self._active_cond:
+                self._active -= 1
+                self._active_cond.notify_all()
+
+    def drain(self, timeout: float) -> bool:
+        """Wait up to timeout for in-flight connections to finish; False if some are still open."""
+        with self._active_cond:
+            return self._active_cond.wait_for(lambda: self._active == 0, timeout)
 
 
-def run_server(host: str = '0.0.0.0', port: int = None):
+def run_server(host: str = '0.0.0.0', port: int = None, reuse_port: bool = False):
     port = port or int(settings.PROXY_PORT)
-    server = ThreadingHTTPServer((host, port), ProxyHandler)
+    warm_companion_cache()
+    server = ProxyHTTPServer((host, port), ProxyHandler, reuse_port=reuse_port)
+
+    def _graceful_stop(signum, frame):
+        # shutdown() blocks until serve_forever returns, so it cannot run in the signal handler itself
+        threading.Thread(target=server.shutdown, daemon=True).start()
+
+    signal.signal(signal.SIGTERM, _graceful_stop)
     logger.info('Starting LiteLLM Splitter Proxy on %s:%s', host, port)
     try:
         server.serve_forever()
     except KeyboardInterrupt:
         logger.info('Shutting down server')
         server.shutdown()
+    finally:
+        # Stop accepting, then let in-flight streams finish
+        server.server_close()
+        if not server.drain(settings.DRAIN_TIMEOUT):
+            logger.warning('Drain timed out after %ss with connections still open', settings.DRAIN_TIMEOUT)
@@ -0,0 +1,307 @@
+"""Single-flight coalescing of identical in-flight chat completion requests.
+
+Clients that retry on a slow first token, and users with several tabs open,
+send byte-identical bodies seconds apart. Requests are keyed on a hash of
+the normalized body (companion history already stripped) and the caller's
+Authorization header. Duplicates share the companion work still running for
+the first one (see companion_processor); with COALESCE_MAIN_STREAMS=1 they
+also share its main upstream SSE stream, which every subscriber replays from
+the start at its own pace.
+"""
+import asyncio
+import hashlib
+import json
+import os
+import threading
+from typing import AsyncIterator, Callable, Dict, Iterator, Optional
+
+from .metrics import coalesced_requests_total
+
+PENDING = 'pending'
+STREAMING = 'streaming'
+DECLINED = 'declined'
+
+_stats = {'companion_joins': 0, 'main_streams': 0, 'main_stream_joins': 0, 'main_stream_fallbacks': 0}
+_stats_lock = threading.Lock()
+
+
+def request_key(req_json: dict, auth_header: Optional[str]) -> str:
+    """Single-flight key of a normalized request body and the credentials it is sent with."""
+    body = json.dumps(req_json, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+    digest = hashlib.sha256(body.encode('utf-8'))
+    digest.update(b'\0' + (auth_header or '').encode('utf-8'))
+    return digest.hexdigest()
+
+
+def record_join(kind: str):
+    """Count a request that attached to work already in flight (kind: companion or main_stream)."""
+    with _stats_lock:
+        _stats[kind + '_joins'] += 1
+    coalesced_requests_total.labels(kind).inc()
+
+
+def coalesce_stats() -> dict:
+    with _flights_lock:
+        in_flight = len(_flights)
+    with _stats_lock:
+        return dict(_stats, main_streams_in_flight=in_flight)
+
+
+class StreamFlight:
+    """One main upstream SSE stream, relayed to every identical request that joins while it runs.
+
+    The first request (the leader) opens the upstream stream and hands it over
+    with start(). Upstream chunks are kept for the flight's lifetime and each
+    subscriber reads them from its own offset, so a late joiner replays the
+    stream from its first byte. Whichever subscriber has read everything pulls
+    the next chunk from upstream, at most one at a time; a subscriber whose
+    client is slow or gone holds nobody back. Handler threads wait on a
+    condition, coroutines on an asyncio.Event of the loop that runs them; a
+    flight is only used by one engine.
+    """
+
+    def __init__(self, key: str):
+        self.key = key
+        self.state = PENDING
+        self.subscribers = 0
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self._chunks = []
+        self._source = None
+        self._stop: Optional[Callable[[], None]] = None
+        self._close: Optional[Callable[[], None]] = None
+        self._pumping = False
+        self._cond = threading.Condition()
+        self._changed: Optional[asyncio.Event] = None
+
+    def _notify(self):
+        # Called with the condition held
+        self._cond.notify_all()
+        if self._changed is not None:
+            self._changed.set()
+            self._changed = None
+
+    def start(self, source, stop: Callable[[], None], close: Callable[[], None]) -> bool:
+        """Hand over the leader's upstream chunk iterator; False if every subscriber has already left.
+
+        stop cuts the upstream stream short (the last subscriber left); close
+        releases it once it is over.
+        """
+        with self._cond:
+            if self.state != PENDING:
+                return False
+            self._source, self._stop, self._close = source, stop, close
+            self.state = STREAMING
+            self._notify()
+        return True
+
+    def wait_started(self, sub: 'StreamSubscriber', timeout: float) -> bool:
+        """Wait up to timeout for the leader's stream; False if it did not stream (error, JSON reply, gone)."""
+        with self._cond:
+            self._cond.wait_for(lambda: self.state != PENDING or sub.left, timeout)
+            return self.state == STREAMING and not sub.left
+
+    async def await_started(self, sub: 'StreamSubscriber', timeout: float) -> bool:
+        """Coroutine counterpart of wait_started."""
+        try:
+            await asyncio.wait_for(self._until_started(sub), timeout)
+        except asyncio.TimeoutError:
+            pass
+        return self.state == STREAMING and not sub.left
+
+    async def _until_started(self, sub: 'StreamSubscriber'):
+        while self.state == PENDING and not sub.left:
+            if self._changed is None:
+                self._changed = asyncio.Event()
+            await self._changed.wait()
+
+    def _take(self, sub: 'StreamSubscriber'):
+        # Called with the condition held: (chunk, False), (None, False) at the end, or (None, True) to pull
+        index = sub.offset
+        if sub.left:
+            return None, False
+        if index < len(self._chunks):
+            return self._chunks[index], False
+        if self.done:
+            if self.error is not None:
+                raise self.error
+            return None, False
+        if not self._pumping:
+            self._pumping = True
+            return None, True
+        return None, None
+
+    def _pulled(self, chunk: Optional[bytes], error: Optional[BaseException] = None):
+        with self._cond:
+            self._pumping = False
+            # A flight stopped while this chunk was being pulled is over as well
+            over = chunk is None or self.done
+            if not over:
+                self._chunks.append(chunk)
+            elif not self.done:
+                self.done = True
+                self.error = error
+            self._notify()
+        if over:
+            self._close()
+            _forget(self)
+
+    def next_chunk(self, sub: 'StreamSubscriber') -> Optional[bytes]:
+        """sub's next chunk, pulled from upstream if nobody else is; None at the end or once sub has left."""
+        while True:
+            with self._cond:
+                while True:
+                    chunk, pull = self._take(sub)
+                    if pull is not None:
+                        break
+                    self._cond.wait()
+            if not pull:
+                return chunk
+            try:
+                chunk = next(self._source, None)
+            except Exception as e:
+                self._pulled(None, e)
+                raise
+            self._pulled(chunk)
+
+    async def anext_chunk(self, sub: 'StreamSubscriber') -> Optional[bytes]:
+        """Coroutine counterpart of next_chunk for an async upstream chunk iterator."""
+        while True:
+            with self._cond:
+                chunk, pull = self._take(sub)
+                if pull is None:
+                    if self._changed is None:
+                        self._changed = asyncio.Event()
+                    changed = self._changed
+            if pull is None:
+                await changed.wait()
+                continue
+            if not pull:
+                return chunk
+            try:
+                chunk = await self._source.__anext__()
+            except StopAsyncIteration:
+                chunk = None
+            except BaseException as e:
+                # A cancelled puller must not hand its CancelledError to the other subscribers
+                self._pulled(None, e if isinstance(e, Exception) else ConnectionError('Shared upstream stream interrupted'))
+                raise
+            self._pulled(chunk)
+
+    def _leave(self, leader: bool) -> bool:
+        with _flights_lock:
+            self.subscribers -= 1
+            last = self.subscribers == 0
+            if last or (leader and self.state == PENDING):
+                # Nobody joins a flight that is stopping or whose leader never streamed
+                _forget_locked(self)
+        with self._cond:
+            if leader and self.state == PENDING:
+                self.state = DECLINED
+            stopping = last and not self.done and self.state == STREAMING
+            if stopping:
+                self.done = True
+            pumping = self._pumping
+            # Wakes the leaving request itself if it is waiting on the flight
+            self._notify()
+        if not stopping:
+            return False
+        self._stop()
+        if not pumping:
+            # A puller closes the stream itself once its read fails
+            self._close()
+        return True
+
+
+class StreamSubscriber:
+    """One request's place in a StreamFlight: whether it leads, how far it has read, whether it has left."""
+
+    __slots__ = ('flight', 'leader', 'offset', 'left')
+
+    def __init__(self, flight: StreamFlight, leader: bool):
+        self.flight = flight
+        self.leader = leader
+        self.offset = 0
+        self.left = False
+
+    def wait_started(self, timeout: float) -> bool:
+        return self.flight.wait_started(self, timeout)
+
+    async def await_started(self, timeout: float) -> bool:
+        return await self.flight.await_started(self, timeout)
+
+    def chunks(self) -> Iterator[bytes]:
+        """Upstream chunks from this subscriber's offset on, until the stream ends or it leaves."""
+        while True:
+            chunk = self.flight.next_chunk(self)
+            if chunk is None:
+                return
+            self.offset += 1
+            yield chunk
+
+    async def achunks(self) -> AsyncIterator[bytes]:
+        while True:
+            chunk = await self.flight.anext_chunk(self)
+            if chunk is None:
+                return
+            self.offset += 1
+            yield chunk
+
+    def leave(self) -> bool:
+        """Stop relaying the flight (idempotent); True if that cut the upstream stream short.
+
+        The upstream stream is stopped only when its last subscriber leaves
+        before the end. A leader leaving before it called start() releases
+        the requests waiting on it to send their own upstream requests.
+        """
+        if self.left:
+            return False
+        self.left = True
+        return self.flight._leave(self.leader)
+
+    def fall_back(self):
+        """Leave a flight whose leader did not stream, before sending this request upstream itself."""
+        with _stats_lock:
+            _stats['main_stream_fallbacks'] += 1
+        self.leave()
+
+
+_flights: Dict[str, StreamFlight] = {}
+_flights_lock = threading.Lock()
+
+
+def join_main_stream(key: str) -> StreamSubscriber:
+    """Subscribe to the main stream in flight for key, or lead a new one."""
+    with _flights_lock:
+        flight = _flights.get(key)
+        leader = flight is None
+        if leader:
+            flight = _flights[key] = StreamFlight(key)
+        flight.subscribers += 1
+    if leader:
+        with _stats_lock:
+            _stats['main_streams'] += 1
+    else:
+        record_join('main_stream')
+    return StreamSubscriber(flight, leader)
+
+
+def _forget_locked(flight: StreamFlight):
+    if _flights.get(flight.key) is flight:
+        del _flights[flight.key]
+
+
+def _forget(flight: StreamFlight):
+    with _flights_lock:
+        _forget_locked(flight)
+
+
+def _reset_after_fork():
+    # In-flight streams belong to the parent's handlers
+    global _flights_lock, _stats_lock
+    _flights.clear()
+    _flights_lock = threading.Lock()
+    _stats_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
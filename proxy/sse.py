@@ -0,0 +1,167 @@
+from typing import AsyncIterator, Iterator, List, Optional, Tuple
+
+READ_CHUNK_SIZE = 64 * 1024
+
+
+class SSEEvent:
+    """A single server-sent event as received from upstream."""
+
+    __slots__ = ('raw', '_data')
+
+    def __init__(self, raw: bytes):
+        # Event bytes without the terminating blank line
+        self.raw = raw
+        self._data = None
+
+    @property
+    def data(self) -> Optional[str]:
+        """Return the joined value of all 'data:' fields, or None for comment-only events."""
+        if self._data is None:
+            values = []
+            for line in self.raw.splitlines():
+                if line.startswith(b'data:'):
+                    value = line[5:]
+                    if value.startswith(b' '):
+                        value = value[1:]
+                    values.append(value)
+            if not values:
+                return None
+            self._data = b'\n'.join(values).decode('utf-8', errors='replace')
+        return self._data
+
+    @property
+    def is_done(self) -> bool:
+        return self.data == '[DONE]'
+
+    def encode(self) -> bytes:
+        """Return the event framed for writing to a client."""
+        return self.raw + b'\n\n'
+
+
+class SSEParser:
+    """Incremental text/event-stream parser.
+
+    Bytes are appended to a single reusable buffer and scanned line by line;
+    an event is emitted as soon as its terminating blank line arrives, so
+    no latency is added on top of the upstream read. Lines may end in
+    either '\\n' or '\\r\\n'.
+    """
+
+    def __init__(self):
+        self._buf = bytearray()
+        self._scan = 0  # offset of the first line not yet scanned
+        self._event_start = 0
+
+    def feed(self, chunk: bytes) -> List[SSEEvent]:
+        buf = self._buf
+        buf += chunk
+        events = []
+        pos = self._scan
+        event_start = self._event_start
+        while True:
+            nl = buf.find(b'\n', pos)
+            if nl == -1:
+                break
+            if nl == pos or (nl == pos + 1 and buf[pos] == 0x0D):
+                # Blank line terminates the current event
+                if pos > event_start:
+                    end = pos - 1
+                    if end > event_start and buf[end - 1] == 0x0D:
+                        end -= 1
+                    events.append(SSEEvent(bytes(buf[event_start:end])))
+                event_start = nl + 1
+            pos = nl + 1
+        if event_start:
+            # Drop consumed bytes in place so the buffer is reused
+            del buf[:event_start]
+            pos -= event_start
+            event_start = 0
+        self._scan = pos
+        self._event_start = event_start
+        return events
+
+    def flush(self) -> List[SSEEvent]:
+        """Return a trailing event that was not terminated by a blank line."""
+        raw = bytes(self._buf).strip()
+        self._buf.clear()
+        self._scan = self._event_start = 0
+        return [SSEEvent(raw)] if raw else []
+
+
+def _blank_line_after(data, pos: int, end: int) -> int:
+    """Offset just past the first blank line at or after pos, or -1."""
+    a = data.find(b'\n\n', pos, end)
+    b = data.find(b'\n\r\n', pos, end)
+    if a == -1:
+        return b + 3 if b != -1 else -1
+    if b == -1 or a < b:
+        return a + 2
+    return b + 3
+
+
+def event_bounds(data, pos: int, end: int):
+    """(start, stop) of the event containing offset pos, stop including its blank line."""
+    a = data.rfind(b'\n\n', 0, pos)
+    b = data.rfind(b'\n\r\n', 0, pos)
+    start = max(a + 2 if a != -1 else 0, b + 3 if b != -1 else 0)
+    stop = _blank_line_after(data, pos, end)
+    return start, stop if stop != -1 else end
+
+
+class SSESplitter:
+    """Cuts an SSE byte stream at event boundaries without parsing events.
+
+    feed() returns (data, end) where data[:end] holds the complete events
+    received so far. When a read ends on an event boundary (the usual case)
+    data is the chunk itself, so nothing is copied; only an event straddling
+    two reads is buffered.
+    """
+
+    def __init__(self):
+        self._rest = bytearray()
+
+    def feed(self, chunk: bytes) -> Tuple[bytes, int]:
+        if self._rest:
+            data = bytes(self._rest) + chunk
+            self._rest.clear()
+        else:
+            data = chunk
+        a = data.rfind(b'\n\n')
+        b = data.rfind(b'\n\r\n')
+        end = max(a + 2 if a != -1 else 0, b + 3 if b != -1 else 0)
+        if end < len(data):
+            self._rest += memoryview(data)[end:]
+        return data, end
+
+    def flush(self) -> bytes:
+        """Return trailing bytes that were not terminated by a blank line."""
+        rest = bytes(self._rest)
+        self._rest.clear()
+        return rest if rest.strip() else b''
+
+
+def iter_sse_chunks(resp, chunk_size: int = READ_CHUNK_SIZE) -> Iterator[bytes]:
+    """Yield body bytes from a streaming requests.Response as soon as they are available."""
+    read1 = getattr(resp.raw, 'read1', None)
+    if read1 is not None:
+        # read1 returns whatever is already available instead of waiting for chunk_size bytes
+        return iter(lambda: read1(chunk_size), b'')
+    return resp.iter_content(chunk_size=None)
+
+
+def iter_sse_events(resp, chunk_size: int = READ_CHUNK_SIZE) -> Iterator[SSEEvent]:
+    """Yield SSE events from a streaming requests.Response as they arrive."""
+    parser = SSEParser()
+    for chunk in iter_sse_chunks(resp, chunk_size):
+        yield from parser.feed(chunk)
+    yield from parser.flush()
+
+
+async def aiter_sse_events(chunks: AsyncIterator[bytes]) -> AsyncIterator[SSEEvent]:
+    """Async counterpart of iter_sse_events for an async iterator of body chunks."""
+    parser = SSEParser()
+    async for chunk in chunks:
+        for event in parser.feed(chunk):
+            yield event
+    for event in parser.flush():
+        yield event
@@ -0,0 +1,124 @@
+"""Pre-fork supervisor for running several worker processes on one port.
+
+Each worker is a full proxy process (its own GIL, upstream pools and
+companion state) that binds PROXY_PORT with SO_REUSEPORT, so the kernel
+spreads incoming connections across workers.
+"""
+import logging
+import os
+import signal
+import socket
+import time
+
+from config import settings
+from utils.logger import stop_log_writer
+
+logger = logging.getLogger('proxy')
+
+# A worker that exits sooner than this after starting counts as crash-looping
+_MIN_HEALTHY_UPTIME = 5.0
+_MAX_RESTART_DELAY = 30.0
+
+
+def _run_worker(engine: str, host: str, port: int):
+    # Undo the supervisor's handlers; each engine installs its own graceful SIGTERM handling
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+    if engine == 'asyncio':
+        from .async_server import run_async_server
+        run_async_server(host, port, reuse_port=True)
+    else:
+        from .server import run_server
+        run_server(host, port, reuse_port=True)
+
+
+class Supervisor:
+    def __init__(self, workers: int, engine: str, host: str, port: int):
+        self.workers = workers
+        self.engine = engine
+        self.host = host
+        self.port = port
+        self._children = {}  # pid -> (slot, start time)
+        self._restart_delay = {}  # slot -> seconds to wait before the next restart
+        self._stopping = False
+
+    def _spawn(self, slot: int):
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                _run_worker(self.engine, self.host, self.port)
+            except Exception:
+                logger.exception('Worker %d failed', slot)
+                code = 1
+            finally:
+                # os._exit skips atexit: drain the log queue first, or the lines above are lost
+                stop_log_writer()
+                logging.shutdown()
+                os._exit(code)
+        self._children[pid] = (slot, time.monotonic())
+        logger.info('Started worker %d (pid %d)', slot, pid)
+
+    def _handle_stop(self, signum, frame):
+        self._stopping = True
+
+    def _reap(self):
+        """Collect exited workers and restart them unless we are shutting down."""
+        while self._children:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            slot, started = self._children.pop(pid, (None, None))
+            if slot is None or self._stopping:
+                continue
+            logger.warning('Worker %d (pid %d) exited with status %s; restarting', slot, pid, status)
+            if time.monotonic() - started < _MIN_HEALTHY_UPTIME:
+                delay = min(self._restart_delay.get(slot, 0.5) * 2, _MAX_RESTART_DELAY)
+            else:
+                delay = 0.0
+            self._restart_delay[slot] = max(delay, 0.5)
+            if delay:
+                time.sleep(delay)
+            if not self._stopping:
+                self._spawn(slot)
+
+    def _shutdown(self):
+        logger.info('Draining %d workers', len(self._children))
+        for pid in list(self._children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        deadline = time.monotonic() + settings.DRAIN_TIMEOUT + 5
+        while self._children and time.monotonic() < deadline:
+            self._reap()
+            time.sleep(0.1)
+        for pid in list(self._children):
+            logger.warning('Worker pid %d did not drain in time; killing', pid)
+            try:
+                os.kill(pid, signal.SIGKILL)
+                os.waitpid(pid, 0)
+            except (ProcessLookupError, ChildProcessError):
+                pass
+        self._children.clear()
+
+    def run(self):
+        if not hasattr(socket, 'SO_REUSEPORT'):
+            raise RuntimeError('--workers requires SO_REUSEPORT, which this platform does not support')
+        signal.signal(signal.SIGTERM, self._handle_stop)
+        signal.signal(signal.SIGINT, self._handle_stop)
+        logger.info('Starting %d %s workers on %s:%s', self.workers, self.engine, self.host, self.port)
+        for slot in range(self.workers):
+            self._spawn(slot)
+        while not self._stopping:
+            self._reap()
+            time.sleep(0.2)
+        self._shutdown()
+        logger.info('All workers stopped')
+
+
+def run_workers(workers: int, engine: str, host: str = '0.0.0.0', port: int = None):
+    Supervisor(workers, engine, host, port or int(settings.PROXY_PORT)).run()
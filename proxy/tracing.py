@@ -0,0 +1,156 @@
+"""Per-request timelines: where the time went between request and response.
+
+A Trace collects named marks and spans (offsets from the request start) on
+the handler and in its companion call. Finished traces go to a ring buffer
+served on GET /traces; those slower than TRACE_SLOW_MS are also kept in a
+separate buffer and appended to TRACE_SLOW_LOG as JSONL.
+"""
+import collections
+import contextvars
+import itertools
+import os
+import threading
+import time
+from typing import List, Optional
+
+from config import settings
+from .capture import JsonlWriter
+
+
+class Trace:
+    """Timeline of one request. Marks are plain list appends, safe from any thread."""
+
+    __slots__ = ('id', 'wall_start', 'start', 'end', 'attrs', 'marks', 'spans')
+
+    def __init__(self, trace_id: str):
+        self.id = trace_id
+        self.wall_start = time.time()
+        self.start = time.perf_counter()
+        self.end = None
+        self.attrs = {}
+        self.marks = []  # (name, seconds from start)
+        self.spans = []  # (name, seconds from start, duration)
+
+    def mark(self, name: str):
+        self.marks.append((name, time.perf_counter() - self.start))
+
+    def set(self, key: str, value):
+        self.attrs[key] = value
+
+    def add_span(self, name: str, started: float, duration: float):
+        """Record a span that began at perf_counter() value started."""
+        self.spans.append((name, started - self.start, duration))
+
+    def duration(self) -> float:
+        return (self.end if self.end is not None else time.perf_counter()) - self.start
+
+    def to_dict(self) -> dict:
+        return {
+            'id': self.id,
+            'start': self.wall_start,
+            'duration_ms': round(self.duration() * 1000, 2),
+            'attrs': dict(self.attrs),
+            'marks': [{'name': n, 'at_ms': round(t * 1000, 2)} for n, t in sorted(self.marks, key=lambda m: m[1])],
+            'spans': [{'name': n, 'start_ms': round(t * 1000, 2), 'duration_ms': round(d * 1000, 2)}
+                      for n, t, d in sorted(self.spans, key=lambda s: s[1])],
+        }
+
+
+class _NullTrace:
+    """Stands in for a Trace when tracing is disabled."""
+
+    id = None
+
+    def mark(self, name: str):
+        pass
+
+    def set(self, key: str, value):
+        pass
+
+    def add_span(self, name: str, started: float, duration: float):
+        pass
+
+
+NULL_TRACE = _NullTrace()
+
+_ids = itertools.count(1)
+_lock = threading.Lock()
+_recent = collections.deque(maxlen=max(1, settings.TRACE_BUFFER_SIZE))
+_slow = collections.deque(maxlen=max(1, settings.TRACE_BUFFER_SIZE))
+
+# Slow traces are appended to TRACE_SLOW_LOG by a background thread, off the handlers and event loops
+_SLOW_LOG_QUEUE_SIZE = 1000
+_slow_log = JsonlWriter(settings.TRACE_SLOW_LOG, 0, 0, _SLOW_LOG_QUEUE_SIZE) if settings.TRACE_SLOW_LOG else None
+
+# (trace, phase) of the code running now, for hooks that cannot be passed a trace (connection setup)
+_current = contextvars.ContextVar('proxy_trace', default=None)
+
+
+def start_trace(**attrs):
+    """Start the timeline of a new request (NULL_TRACE if tracing is disabled)."""
+    if settings.TRACE_BUFFER_SIZE <= 0:
+        return NULL_TRACE
+    trace = Trace('%d-%d' % (os.getpid(), next(_ids)))
+    trace.attrs.update(attrs)
+    return trace
+
+
+def finish_trace(trace):
+    """Close the trace and file it; slow ones are also written to TRACE_SLOW_LOG."""
+    if trace is NULL_TRACE:
+        return
+    trace.end = time.perf_counter()
+    slow = trace.duration() * 1000 >= settings.TRACE_SLOW_MS
+    with _lock:
+        _recent.append(trace)
+        if slow:
+            _slow.append(trace)
+    if slow and _slow_log is not None:
+        _slow_log.write(trace.to_dict())
+
+
+def trace_limit(query: dict) -> Optional[int]:
+    """The ?limit= of a GET /traces query (parse_qs form); ValueError unless it is a non-negative integer."""
+    if not query.get('limit'):
+        return None
+    limit = int(query['limit'][0])
+    if limit < 0:
+        raise ValueError('negative limit')
+    return limit
+
+
+def recent_traces(slow: bool = False, limit: Optional[int] = None) -> List[dict]:
+    """Finished timelines, newest first."""
+    with _lock:
+        traces = list(_slow if slow else _recent)
+    traces.reverse()
+    if limit is not None:
+        traces = traces[:limit]
+    return [t.to_dict() for t in traces]
+
+
+def bind_trace(trace, phase: str):
+    """Make trace current for this thread or task; phase prefixes spans recorded by hooks."""
+    return _current.set((trace, phase))
+
+
+def unbind_trace(token):
+    _current.reset(token)
+
+
+def record_current_span(name: str, started: float):
+    """Record a span ending now on the current trace, named '<phase>_<name>'."""
+    current = _current.get()
+    if current is not None:
+        trace, phase = current
+        trace.add_span('%s_%s' % (phase, name), started, time.perf_counter() - started)
+
+
+def _reset_after_fork():
+    # The writer thread does not survive fork; a worker starts its own on first use
+    global _slow_log
+    if _slow_log is not None:
+        _slow_log = JsonlWriter(settings.TRACE_SLOW_LOG, 0, 0, _SLOW_LOG_QUEUE_SIZE)
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
@@ -0,0 +1,209 @@
+import logging
+import os
+import threading
+import time
+from typing import Optional
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.util.connection import is_connection_dropped
+
+from config import settings
+from .metrics import upstream_connect_seconds
+from .tracing import record_current_span
+
+logger = logging.getLogger(__name__)
+
+_DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+
+def _record_connect(started: float):
+    upstream_connect_seconds.labels('sync').observe(time.perf_counter() - started)
+    record_current_span('connect', started)
+
+
+class _TimedHTTPConnection(HTTPConnection):
+    def connect(self):
+        started = time.perf_counter()
+        super().connect()
+        _record_connect(started)
+
+
+class _TimedHTTPSConnection(HTTPSConnection):
+    def connect(self):
+        started = time.perf_counter()
+        super().connect()
+        _record_connect(started)
+
+
+class _TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = _TimedHTTPConnection
+
+
+class _TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = _TimedHTTPSConnection
+
+
+class UpstreamClient:
+    """Keep-alive HTTP client shared by the main and companion upstream calls.
+
+    Connections are pooled per host by urllib3. A background maintenance
+    thread closes pools that have been idle for longer than idle_timeout and
+    drops pooled sockets the upstream has already closed, so requests on the
+    hot path never pay for a reconnect to a dead socket.
+    """
+
+    def __init__(self, pool_size: int, pool_hosts: int, idle_timeout: float, health_check_interval: float):
+        self.pool_size = pool_size
+        self.idle_timeout = idle_timeout
+        self.health_check_interval = health_check_interval
+
+        self._session = requests.Session()
+        # Do not inherit environment proxy settings
+        self._session.trust_env = False
+        self._adapter = HTTPAdapter(pool_connections=pool_hosts, pool_maxsize=pool_size, max_retries=0)
+        # Pools whose connections record their connect time in /metrics
+        self._adapter.poolmanager.pool_classes_by_scheme = {
+            'http': _TimedHTTPConnectionPool, 'https': _TimedHTTPSConnectionPool}
+        self._session.mount('http://', self._adapter)
+        self._session.mount('https://', self._adapter)
+
+        self._lock = threading.Lock()
+        self._last_used = {}  # (host, port) -> monotonic time of last request
+        self._evicted_pools = 0
+        self._evicted_connections = 0
+        self._evicted_requests = 0
+        self._dropped_connections = 0
+        self._maintenance_thread = None
+
+    def post(self, url: str, **kwargs) -> requests.Response:
+        parsed = urlparse(url)
+        host_key = (parsed.hostname, parsed.port or _DEFAULT_PORTS.get(parsed.scheme))
+        with self._lock:
+            self._last_used[host_key] = time.monotonic()
+            if self._maintenance_thread is None and self.health_check_interval > 0:
+                self._maintenance_thread = threading.Thread(target=self._maintenance_loop, name='upstream-pool', daemon=True)
+                self._maintenance_thread.start()
+        return self._session.post(url, **kwargs)
+
+    def _maintenance_loop(self):
+        while True:
+            time.sleep(self.health_check_interval)
+            try:
+                self.evict_idle()
+                self.check_health()
+            except Exception:
+                logger.exception('Upstream pool maintenance failed')
+
+    def evict_idle(self):
+        """Close pools for hosts that have not been used within idle_timeout."""
+        now = time.monotonic()
+        pools = self._adapter.poolmanager.pools
+        with self._lock:
+            stale = {k for k, ts in self._last_used.items() if now - ts > self.idle_timeout}
+            for host_key in stale:
+                del self._last_used[host_key]
+            if not stale:
+                return
+            for key in list(pools.keys()):
+                if (key.key_host, key.key_port) not in stale:
+                    continue
+                pool = pools.get(key)
+                if pool is None:
+                    continue
+                self._evicted_pools += 1
+                self._evicted_connections += pool.num_connections
+                self._evicted_requests += pool.num_requests
+                # Removing the pool from the container closes its idle sockets
+                del pools[key]
+        logger.debug('Evicted idle upstream pools for %s', sorted(stale))
+
+    def check_health(self):
+        """Drop pooled connections whose socket was closed by the upstream.
+
+        Idle connections are probed where they sit, under the pool queue's own
+        lock, so requests keep checking connections out of the pool meanwhile
+        and a connection a request has taken is never touched.
+        """
+        for key in list(self._adapter.poolmanager.pools.keys()):
+            pool = self._adapter.poolmanager.pools.get(key)
+            if pool is None or pool.pool is None:
+                continue
+            idle = pool.pool
+            dropped = 0
+            with idle.mutex:
+                for i, conn in enumerate(idle.queue):
+                    if conn is not None and is_connection_dropped(conn):
+                        conn.close()
+                        # An empty slot makes the pool open (and count) a fresh connection
+                        idle.queue[i] = None
+                        dropped += 1
+            if dropped:
+                with self._lock:
+                    self._dropped_connections += dropped
+
+    def stats(self) -> dict:
+        """Return pool hit/miss counters; a miss is a request that opened a new connection."""
+        with self._lock:
+            connections = self._evicted_connections
+            requests_total = self._evicted_requests
+            hosts = {}
+            for key in list(self._adapter.poolmanager.pools.keys()):
+                pool = self._adapter.poolmanager.pools.get(key)
+                if pool is None:
+                    continue
+                connections += pool.num_connections
+                requests_total += pool.num_requests
+                hosts['%s://%s:%s' % (key.key_scheme, key.key_host, key.key_port)] = {
+                    'requests': pool.num_requests,
+                    'connections_opened': pool.num_connections,
+                    'idle_connections': _count_idle(pool),
+                }
+            return {
+                'requests': requests_total,
+                'hits': max(requests_total - connections, 0),
+                'misses': connections,
+                'pool_size': self.pool_size,
+                'evicted_pools': self._evicted_pools,
+                'dropped_connections': self._dropped_connections,
+                'hosts': hosts,
+            }
+
+
+def _count_idle(pool) -> int:
+    # The pool queue is pre-filled with None placeholders for unopened slots
+    if pool.pool is None:
+        return 0
+    return sum(1 for conn in list(pool.pool.queue) if conn is not None)
+
+
+_client: Optional[UpstreamClient] = None
+_client_lock = threading.Lock()
+
+
+def get_upstream_client() -> UpstreamClient:
+    """Return the process-wide upstream client, creating it on first use."""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = UpstreamClient(
+                    pool_size=settings.UPSTREAM_POOL_SIZE,
+                    pool_hosts=settings.UPSTREAM_POOL_HOSTS,
+                    idle_timeout=settings.UPSTREAM_IDLE_TIMEOUT,
+                    health_check_interval=settings.UPSTREAM_HEALTH_CHECK_INTERVAL,
+                )
+    return _client
+
+
+def _reset_after_fork():
+    # Worker processes build their own pool; sockets and the maintenance thread are not inherited
+    global _client, _client_lock
+    _client = None
+    _client_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
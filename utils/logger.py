@@ -1,10 +1,176 @@
+import atexit
+import copy
+import json
 import logging
+import os
+import queue
+import time
+from logging.handlers import QueueHandler, QueueListener
 
-def setup_logger(level: str = 'INFO'):
+_TEXT_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+
+
+class SamplingFilter(logging.Filter):
+    """Thins out repetitive records per message template; WARNING and above always pass.
+
+    debug_sample keeps that share of DEBUG records of each template (every
+    Nth one). rate_limit caps records per template per second; the next record
+    that passes carries the number suppressed in between. Counters are plain
+    dict updates without a lock, so under concurrency they are approximate.
+    """
+
+    def __init__(self, debug_sample: float = 1.0, rate_limit: float = 0):
+        super().__init__()
+        self.every = max(1, round(1 / debug_sample)) if debug_sample > 0 else 0
+        self.rate_limit = rate_limit
+        self._seen = {}  # template -> DEBUG records seen
+        self._windows = {}  # template -> [second, passed in that second, suppressed since last pass]
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+        key = record.msg if isinstance(record.msg, str) else type(record.msg)
+        if record.levelno <= logging.DEBUG and self.every != 1:
+            if not self.every:
+                return False
+            seen = self._seen.get(key, 0)
+            self._seen[key] = seen + 1
+            if seen % self.every:
+                return False
+        if self.rate_limit > 0:
+            now = int(time.monotonic())
+            window = self._windows.get(key)
+            if window is None:
+                window = self._windows[key] = [now, 0, 0]
+            elif window[0] != now:
+                window[0] = now
+                window[1] = 0
+            if window[1] >= self.rate_limit:
+                window[2] += 1
+                return False
+            window[1] += 1
+            if window[2]:
+                record.suppressed = window[2]
+                window[2] = 0
+        return True
+
+
+class TextFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__(_TEXT_FORMAT)
+
+    def format(self, record: logging.LogRecord) -> str:
+        out = super().format(record)
+        if getattr(record, 'suppressed', 0):
+            out += ' [%d similar messages suppressed]' % record.suppressed
+        return out
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line: ts, level, logger, message, and exc/suppressed when present."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        out = {
+            'ts': round(record.created, 6),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            out['exc'] = record.exc_text
+        if getattr(record, 'suppressed', 0):
+            out['suppressed'] = record.suppressed
+        return json.dumps(out, ensure_ascii=False)
+
+
+class _NonBlockingQueueHandler(QueueHandler):
+    """Hands records to the writer thread; when its queue is full, drops them (and counts).
+
+    WARNING and above are never dropped: they go through fallback, the
+    writer's own handler, on the calling thread instead.
+    """
+
+    def __init__(self, q: queue.Queue, fallback: logging.Handler):
+        super().__init__(q)
+        self.fallback = fallback
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Merge args and render the traceback now (they may not outlive the call),
+        # but leave the rest of the formatting to the writer thread
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            if record.levelno >= logging.WARNING:
+                self.fallback.handle(record)
+            else:
+                self.dropped += 1
+
+
+_queue_handler = None
+_listener = None
+
+
+def log_stats() -> dict:
+    """Queue depth and INFO/DEBUG records dropped by the asynchronous handler (None when logging synchronously)."""
+    if _queue_handler is None:
+        return None
+    return {'queued': _queue_handler.queue.qsize(), 'dropped': _queue_handler.dropped}
+
+
+def setup_logger(level: str = 'INFO', fmt: str = 'text', queue_size: int = 0,
+                 debug_sample: float = 1.0, rate_limit: float = 0):
+    """Configure the 'proxy' logger once; later calls return it unchanged.
+
+    fmt is 'text' or 'json'. With queue_size > 0 records are written by a
+    background thread, so handlers never block on stderr; INFO and DEBUG
+    records that do not fit in the queue are dropped, warnings and errors are
+    written directly. debug_sample and rate_limit thin out
+    repetitive records (see SamplingFilter).
+    """
+    global _queue_handler, _listener
     logger = logging.getLogger('proxy')
-    logger.setLevel(getattr(logging, level.upper(), logging.INFO))
+    logger.setLevel(getattr(logging, (level or 'INFO').upper(), logging.INFO))
     if not logger.handlers:
         handler = logging.StreamHandler()
-        handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+        handler.setFormatter(JsonFormatter() if fmt == 'json' else TextFormatter())
+        if queue_size > 0:
+            _queue_handler = _NonBlockingQueueHandler(queue.Queue(queue_size), handler)
+            _listener = QueueListener(_queue_handler.queue, handler)
+            _listener.start()
+            atexit.register(stop_log_writer)
+            handler = _queue_handler
+        if debug_sample < 1 or rate_limit > 0:
+            handler.addFilter(SamplingFilter(debug_sample, rate_limit))
         logger.addHandler(handler)
-    return logger
\ No newline at end of file
+    return logger
+
+
+def stop_log_writer():
+    """Write out the queued records and stop the writer thread; for exits that skip atexit (os._exit)."""
+    if _listener is not None and _listener._thread is not None:
+        _listener.stop()
+
+
+def _restart_after_fork():
+    # The writer thread does not survive fork; a worker gets a fresh queue and thread
+    if _listener is None:
+        return
+    _queue_handler.queue = _listener.queue = queue.Queue(_queue_handler.queue.maxsize)
+    _queue_handler.dropped = 0
+    _listener._thread = None
+    _listener.start()
+
+
+os.register_at_fork(after_in_child=_restart_after_fork)